@@ -10,18 +10,28 @@
 # We use import ev3dev.ev3 instead of ev3dev.auto because we only use ev3 devices
 
 
-from multiprocessing import Process
-from threading import Thread
-from ev3dev.ev3 import *
+import os
+if os.environ.get("ROBOARM_BACKEND") == "sim":
+    from roboarmsim import *
+    world.set_platform("ev3")
+elif os.environ.get("ROBOARM_BACKEND") == "replay":
+    from roboarmtrace import *
+else:
+    from ev3dev.ev3 import *
+if os.environ.get("ROBOARM_TRACE"):
+    import roboarmtrace
+    roboarmtrace.install(globals(), os.environ["ROBOARM_TRACE"])
 from tornado import ioloop
 from tornado import web
-from tornado import gen
 from tornado import httpserver
 
 import logging
 import tornado
 import asyncio
 
+import roboarmasync
+import roboarmfeedback
+
 BASE_GEAR_RATIO = 12.0 / 36.0  # 12-tooth gear turn 36-tooth gear
 LIFT_ARM_LIMIT = 40            # reflected light value (units: %)
 LIFT_ARM_POS = 270             # vertical amount
@@ -33,6 +43,7 @@ TEMP_LIMIT = 300               # temp in C (no decimals) to stop arm fail simula
 logger = logging.getLogger(__name__)
 button = Button()
 sound = Sound()
+feedback = roboarmfeedback.Feedback(sound, Leds)
 
 
 # init logger
@@ -52,10 +63,10 @@ class LegoRoboArm:
         # variables init
         self.shutdown_flag = False
         self.temp_present = True
-        self.pro = Process(target=self.infinite_movement)
+        self.task = None            # the motion task running on the IOLoop
 
         time.sleep(2)
-        sound.speak("WEDO Robo Arm Initialiting")
+        feedback.speak("WEDO Robo Arm Initialiting")
 
         # setup the motors and sensors
         try:
@@ -123,171 +134,178 @@ class LegoRoboArm:
             logger.fatal("Position vars not inicialized")
             sys.exit(-1)
 
-    def lift_move(self, speed):
-        self.lift_motor.run_forever(speed_sp=speed)
-        while self.lift_limit_sensor.value(0) <= LIFT_ARM_LIMIT:
-            # logger.debug("sensor_luz: " + str(self.lift_limit_sensor.value(0)))
-            pass
-
-    def lift_move_calup(self, speed):
-        self.lift_motor.polarity = self.lift_motor.POLARITY_NORMAL
-        self.lift_motor.run_forever(speed_sp=speed)
-        while self.lift_limit_sensor.value(0) > LIFT_ARM_LIMIT:
-            pass
-        self.lift_motor.polarity = self.lift_motor.POLARITY_INVERSED
-
-    def lift_move_pos(self, speed, position):
+    async def lift_to_limit(self, speed):
+        # raise the lift until the light sensor sees it
+        with roboarmasync.running(self.lift_motor):
+            self.lift_motor.run_forever(speed_sp=speed)
+            await roboarmasync.until(lambda: self.lift_limit_sensor.value(0) > LIFT_ARM_LIMIT)
+
+    async def lift_below_limit(self, speed):
+        # lower the lift until the light sensor does not see it
+        with roboarmasync.running(self.lift_motor):
+            self.lift_motor.polarity = self.lift_motor.POLARITY_NORMAL
+            try:
+                self.lift_motor.run_forever(speed_sp=speed)
+                await roboarmasync.until(lambda: self.lift_limit_sensor.value(0) <= LIFT_ARM_LIMIT)
+            finally:
+                self.lift_motor.polarity = self.lift_motor.POLARITY_INVERSED
+
+    async def lift_by(self, speed, position):
         # self.lift_motor.run_to_abs_pos(speed_sp=speed, position_sp=position)
-        self.lift_motor.run_to_rel_pos(speed_sp=speed, position_sp=position)
-        while self.lift_motor.STATE_HOLDING not in self.lift_motor.state:
-            # logger.debug(str(self.lift_motor.state))
-            pass
+        with roboarmasync.running(self.lift_motor):
+            self.lift_motor.run_to_rel_pos(speed_sp=speed, position_sp=position)
+            await roboarmasync.until(lambda: self.lift_motor.STATE_HOLDING in self.lift_motor.state)
+
+    async def base_to(self, position, speed=SPEED_BASE):
+        with roboarmasync.running(self.base_motor):
+            self.base_motor.run_to_abs_pos(speed_sp=speed, position_sp=position)
+            await roboarmasync.until(lambda: self.base_motor.STATE_HOLDING in self.base_motor.state)
+
+    async def base_to_limit(self, speed=SPEED_BASE):
+        # turn the base until it presses the touch sensor
+        with roboarmasync.running(self.base_motor):
+            self.base_motor.run_forever(speed_sp=speed)
+            await roboarmasync.until(lambda: self.base_limit_sensor.value(0))
+
+    async def grab_close(self, seconds):
+        # close the grabber for seconds (it stalls on the object)
+        with roboarmasync.running(self.grab_motor):
+            self.grab_motor.run_forever(speed_sp=400)
+            await asyncio.sleep(seconds)
 
-    def initialize(self):
+    async def grab_open(self):
+        with roboarmasync.running(self.grab_motor):
+            self.grab_motor.run_to_rel_pos(speed_sp=600, position_sp=self.grab_position)
+            await roboarmasync.until(lambda: self.grab_motor.STATE_HOLDING in self.grab_motor.state)
+
+    async def initialize(self):
         try:
-            Leds.set_color(Leds.LEFT, Leds.AMBER)
+            feedback.set_color(Leds.LEFT, Leds.AMBER)
             if self.lift_limit_sensor.value(0) > LIFT_ARM_LIMIT:
-                Leds.set_color(Leds.LEFT, Leds.RED)
-                self.lift_move_calup(SPEED_LIFT)
+                feedback.set_color(Leds.LEFT, Leds.RED)
+                await self.lift_below_limit(SPEED_LIFT)
             else:
-                Leds.set_color(Leds.LEFT, Leds.BLACK)
-                self.lift_move(SPEED_LIFT)
+                feedback.set_color(Leds.LEFT, Leds.BLACK)
+                await self.lift_to_limit(SPEED_LIFT)
             self.lift_motor.stop()
             self.lift_initial_position = self.lift_motor.position
 
             print("Posicion Inicial: ", self.lift_initial_position)
-            Leds.set_color(Leds.LEFT, Leds.GREEN)
+            feedback.set_color(Leds.LEFT, Leds.GREEN)
 
             # Set the grabber to a known position by closing it all the way and then opening it
 
-            Leds.set_color(Leds.RIGHT, Leds.AMBER)
-            self.grab_motor.run_forever(speed_sp=400)
-            time.sleep(1)
+            feedback.set_color(Leds.RIGHT, Leds.AMBER)
+            await self.grab_close(1)
             self.grab_motor.run_to_rel_pos(speed_sp=600, position_sp=self.grab_position)
-            Leds.set_color(Leds.RIGHT, Leds.GREEN)
+            feedback.set_color(Leds.RIGHT, Leds.GREEN)
 
             # set the base rotation to a known position using the touch sensor as a limit switch
 
-            Leds.set_color(Leds.LEFT, Leds.AMBER)
-            self.base_motor.run_forever(speed_sp=SPEED_BASE)
-            while not self.base_limit_sensor.value(0):
-                pass
-            Leds.set_color(Leds.LEFT, Leds.RED)
+            feedback.set_color(Leds.LEFT, Leds.AMBER)
+            await self.base_to_limit(SPEED_BASE)
+            feedback.set_color(Leds.LEFT, Leds.RED)
             self.base_motor.stop()
             self.base_motor.position = self.base_position
-            self.base_motor.run_to_abs_pos(speed_sp=SPEED_BASE, position_sp=0)
-            while self.base_motor.STATE_RUNNING in self.base_motor.state:
-                pass
-            Leds.set_color(Leds.LEFT, Leds.GREEN)
-            time.sleep(1)
-            sound.speak("Arm Ready!")
+            await self.base_to(0)
+            feedback.set_color(Leds.LEFT, Leds.GREEN)
+            await asyncio.sleep(1)
+            feedback.speak("Arm Ready!")
+        except asyncio.CancelledError:
+            raise
         except:
             logger.fatal("Error: " + str(sys.exc_info()[0]))
             sys.exit(-1)
 
-    def move(self, direction):
+    async def move(self, direction):
         # rotate the base 90 degrees and wait for completion
         print("Posicion base agarrar:", self.base_position)
-        self.base_motor.run_to_abs_pos(speed_sp=SPEED_BASE, position_sp=direction * self.base_position)
-        while self.base_motor.STATE_HOLDING not in self.base_motor.state:
-            pass
+        await self.base_to(direction * self.base_position)
 
         # lower the lift arm and wait for completion
 
         print("Posicion sp: ", self.lift_motor.position_sp)
         print("Posicion brazo: ", -self.lift_position)
-        self.lift_move_pos(SPEED_LIFT, -self.lift_position)
+        await self.lift_by(SPEED_LIFT, -self.lift_position)
 
         # grab an object
 
         print("coge objeto")
-        self.grab_motor.run_forever(speed_sp=400)
-        time.sleep(1)
+        await self.grab_close(1)
         self.grab_motor.stop()
 
         # raise the lift to the limit
 
-        self.lift_move(SPEED_LIFT)
+        await self.lift_to_limit(SPEED_LIFT)
         self.lift_motor.stop()
 
         # rotate the base back to the center position and wait for completion
 
         print("posicion base soltar:", -self.base_position)
-        self.base_motor.run_to_abs_pos(speed_sp=SPEED_BASE, position_sp=direction * -self.base_position)
-        while self.base_motor.STATE_HOLDING not in self.base_motor.state:
-            pass
+        await self.base_to(direction * -self.base_position)
 
         # lower the lift arm and wait for completion
 
         print("Posicion brazo: ", -self.lift_position)
-        self.lift_move_pos(SPEED_LIFT, -self.lift_position)
+        await self.lift_by(SPEED_LIFT, -self.lift_position)
 
         # release the object
 
         print("suelta objeto")
-        self.grab_motor.run_to_rel_pos(speed_sp=600, position_sp=self.grab_position)
-        while self.grab_motor.STATE_HOLDING not in self.grab_motor.state:
-            pass
+        await self.grab_open()
 
         # raise the lift arm to the limit
 
-        self.lift_move(SPEED_LIFT)
+        await self.lift_to_limit(SPEED_LIFT)
         self.lift_motor.stop()
 
     def stop(self):
-        try:
-            if self.pro is not None:
-                print("no es NONE")
-                self.pro.terminate()
-        except:
-            logger.warning("Process terminated")
+        if self.task is not None:
+            self.task.cancel()
         self.lift_limit_sensor.mode = self.lift_limit_sensor.MODE_COL_REFLECT
         self.grab_motor.reset()
         self.lift_motor.reset()
         self.base_motor.reset()
 
-    def infinite_movement(self):
+    async def infinite_movement(self):
         while True:
-            self.move(1)
-            time.sleep(2)
-            self.move(-1)
-            time.sleep(1)
+            await self.move(1)
+            await asyncio.sleep(2)
+            await self.move(-1)
+            await asyncio.sleep(1)
             if self.temp_present:
                 print("TEMP: ", float(self.temperature_sensor.value()/10.0))
 
+    def start_task(self, coroutine):
+        # run coroutine() as the task of the arm on the IOLoop, unless one is running
+        if self.task is not None and not self.task.done():
+            logger.warning("Robo ARM busy, " + coroutine.__name__ + " not started")
+            return None
+        self.task = asyncio.ensure_future(coroutine())
+        return self.task
+
     def start_inf(self):
-        pth = Thread(target=self.start_infinite_movement())
-        pth.daemon = True
-        pth.start()
+        self.shutdown_flag = False
+        return self.start_task(self.start_infinite_movement)
 
-    def start_infinite_movement(self):
+    async def start_infinite_movement(self):
+        movement = asyncio.ensure_future(self.infinite_movement())
         try:
-            self.shutdown_flag = False
-            self.pro.start()
-            if not self.temp_present:
-                while "backspace" not in button.buttons_pressed:
-                    asyncio.sleep(2)
-                    if self.shutdown_flag:
-                        return
-            else:
-                while self.temperature_sensor.value() < TEMP_LIMIT and "backspace" not in button.buttons_pressed:
-                    asyncio.sleep(2)
-                    if self.shutdown_flag:
-                        return
-            if self.pro is not None:
-                self.pro.terminate()
-            self.pro = Process(target=self.infinite_movement)
-            time.sleep(1)
-            sound.speak("Warning. Warning. Failure Detected!")
-            time.sleep(1)
-        except KeyboardInterrupt:
-            self.stop()
-            time.sleep(1)
-            sound.speak("Good Bye!").wait()
+            while not movement.done() and "backspace" not in button.buttons_pressed:
+                if self.temp_present and self.temperature_sensor.value() >= TEMP_LIMIT:
+                    break
+                await asyncio.wait([movement], timeout=2)
+            if movement.done() and not movement.cancelled() and movement.exception() is not None:
+                logger.error("Infinite movement failed - " + str(movement.exception()))
+        finally:
+            movement.cancel()
+            await asyncio.gather(movement, return_exceptions=True)
+        feedback.speak("Warning. Warning. Failure Detected!")
 
     def shutdown_roboarm(self):
         self.shutdown_flag = True
-        # self.stop()
+        if self.task is not None:
+            self.task.cancel()
 
     def run(self):
         while True:
@@ -299,32 +317,24 @@ class LegoRoboArm:
 
 
 class StartMovement(tornado.web.RequestHandler):
-    @tornado.web.asynchronous
     def get(self):
         try:
             logger.debug("GET start_movement received!")
             self.set_header("Content-Type", "text/json")
             self.finish({"movement": "started"})
-            self.flush()
-            ioloop.IOLoop.current().spawn_callback(self.inf_movement_corutine())
+            roboarm.start_inf()
             logger.debug("Infinite movement LAUNCHED!")
             return
         except:
             logger.fatal("Start_movement error: " + str(sys.exc_info()))
 
-    @tornado.gen.coroutine
-    def inf_movement_corutine(self):
-        roboarm.start_inf()
-
 
 class StopMovement(tornado.web.RequestHandler):
-    @tornado.web.asynchronous
     def get(self):
         try:
             logger.debug("GET stop_movement received!")
             self.set_header("Content-Type", "text/json")
             self.finish({"movement": "stoped"})
-            self.flush()
             roboarm.shutdown_roboarm()
             return
         except:
@@ -332,14 +342,12 @@ class StopMovement(tornado.web.RequestHandler):
 
 
 class Initialize(tornado.web.RequestHandler):
-    @tornado.web.asynchronous
     def get(self):
         try:
             logger.debug("GET initialize received!")
             self.set_header("Content-Type", "text/json")
             self.finish({"command": "initialize"})
-            self.flush()
-            roboarm.initialize()
+            roboarm.start_task(roboarm.initialize)
             logger.debug("Initialize Robot Arm LAUNCHED!")
             return
         except:
@@ -364,8 +372,12 @@ if __name__ == "__main__":
         # start the web server
         try:
             logger.debug('Launching webserver')
-            ioloop.IOLoop.instance().start()
+            ioloop.IOLoop.current().start()
             logger.debug('Closing webserver')
+        except KeyboardInterrupt:
+            roboarm.stop()
+            feedback.speak("Good Bye!")
+            feedback.flush(roboarmfeedback.SPEECH_TIMEOUT)
         except:
             logger.error('Could not START REST API web server ' + str(sys.exc_info()))
             ioloop.IOLoop.current().stop()
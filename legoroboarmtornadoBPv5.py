@@ -9,36 +9,110 @@
 
 # We use import ev3dev.ev3 instead of ev3dev.auto because we only use ev3 devices
 
-from multiprocessing import Process, Event
+import os
+import roboarmstartup
+from multiprocessing import Process
 # from threading import Thread
 from _thread import start_new_thread
-from ev3dev.brickpi3 import *
+if os.environ.get("ROBOARM_BACKEND") == "sim":
+    from roboarmsim import *
+elif os.environ.get("ROBOARM_BACKEND") == "replay":
+    from roboarmtrace import *
+else:
+    from ev3dev.brickpi3 import *
+import roboarmbus
+# the bus scheduler arbitrates the SPI bus of the BrickPi3: on with the hardware,
+# ROBOARM_BUS=1 turns it on with the simulated or replayed devices (ROBOARM_BUS=0 off)
+if os.environ.get("ROBOARM_BUS", "0" if os.environ.get("ROBOARM_BACKEND") else "1") != "0":
+    roboarmbus.install(globals())
+if os.environ.get("ROBOARM_TRACE"):
+    import roboarmtrace
+    roboarmtrace.install(globals(), os.environ["ROBOARM_TRACE"])
+roboarmstartup.mark("hardware backend import")
 from tornado import web
 from tornado import ioloop
 from tornado import httpserver
 
+import asyncio
+import collections
+import math
 import tornado
 import logging
-import requests
+import roboarmcycles
+import roboarmdrift
+import roboarmmetrics
+import roboarmpolling
+import roboarmsampler
+import roboarmscheduler
+import roboarmsensors
+import roboarmstate
+import roboarmsupply
+import roboarmthermal
+import roboarmtracing
+import roboarmwatchdog
+
+# only needed for the IoT sends, which start after the hardware init
+requests = roboarmstartup.lazy_import("requests")
+# only needed with a fleet file, a tuning file, the profiler endpoint or the real-time mode
+roboarmfleet = roboarmstartup.lazy_import("roboarmfleet")
+roboarmprofiler = roboarmstartup.lazy_import("roboarmprofiler")
+roboarmrealtime = roboarmstartup.lazy_import("roboarmrealtime")
+roboarmtune = roboarmstartup.lazy_import("roboarmtune")
+roboarmstartup.mark("module imports")
 
 # URL requests to IOT JAVA
 URL_IOT_BASE = "http://localhost:8080/"
-URL_IOT_TEMP = URL_IOT_BASE + str("send_temp?bot=1&temp=")
+URL_IOT_TEMP = URL_IOT_BASE + str("send_temp?bot={bot}&temp=")
 URL_IOT_TIMEOUT = 0.5
 
 # while true loops timeout
 WHILE_LOOP_TIMEOUT = 5000
+# seconds a stopped movement process has to reach a safe point before it is terminated
+MOVEMENT_STOP_TIMEOUT = 2.0
 
 # Tornado HttpServer Port
 HTTP_SERVER_PORT = 8081
 
+# start the web server before the hardware init and find the ports in parallel
+FAST_START = bool(os.environ.get("ROBOARM_FAST_START"))
+# lift up to the encoder position of the light sensor limit learned by initialize(), the
+# sensor only checks where the lift stopped ("sensor": lift until the sensor sees the limit)
+LIFT_ENCODER_MODE = os.environ.get("ROBOARM_LIFT_MODE", "encoder") == "encoder"
+# power supply device of the voltage compensation (name of the ev3dev power_supply), default the first one
+POWER_SUPPLY = os.environ.get("ROBOARM_POWER_SUPPLY")
+# several arms in this process, listed in the fleet file (see roboarmfleet.py)
+FLEET_FILE = os.environ.get("ROBOARM_FLEET")
+# a core for the movement process alone (see roboarmrealtime.py)
+REALTIME = os.environ.get("ROBOARM_REALTIME", "0") != "0"
+# the debug endpoints are enabled with a token (see roboarmprofiler.py)
+DEBUG_TOKEN = bool(os.environ.get("ROBOARM_DEBUG_TOKEN"))
+# arm name of the commands for every arm of the fleet (roboarmfleet.ALL)
+ALL_ARMS = "all"
+
+# motor and sensor ports of an arm, the fleet file can give others
+PORTS = {"grab": OUTPUT_A, "lift": OUTPUT_B, "base": OUTPUT_D,
+         "color": INPUT_1, "temperature": INPUT_3, "touch": INPUT_4}
+
 BASE_GEAR_RATIO = 12.0 / 36.0  # 12-tooth gear turn 36-tooth gear
 LIFT_ARM_LIMIT = 40            # reflected light value (units: %)
 LIFT_ARM_POS = 270             # vertical amount
+LIFT_VERIFY_RANGE = 7          # reflected light over LIFT_ARM_LIMIT still accepted after an encoder lift (units: %)
 BASE_EXTRA = 0.03              # to account for slop in gears (units: rotations)
 SPEED_BASE = 150               # speed of base motor
 SPEED_LIFT = 150               # speed of lift motor
-TEMP_LIMIT = 300               # temp in C (no decimals) to stop arm fail simulation
+SPEED_GRAB_CLOSE = 180         # speed of grab motor closing (runs 0.8 seconds)
+SPEED_GRAB_OPEN = 600          # speed of grab motor opening
+TUNING_FILE = "roboarm_tuning.json"  # movement parameters found by roboarmtune.py
+STATE_FILE = "roboarm_state{name}.bin"  # pose and calibration kept for a restart without homing
+CYCLES_FILE = "roboarm_cycles.db"  # SQLite store of the move() cycles and their rollups, see /stats
+BASE_REHOME_MARGIN = 60        # tacho counts before the touch sensor where the base starts seeking it
+TEMP_SOFT_LIMIT = 270          # temp in C (no decimals) where the arm starts slowing down and pausing
+TEMP_LIMIT = 300               # temp in C (no decimals) where the arm halts until it cools under TEMP_SOFT_LIMIT
+
+# spans and arm durations are timed with the clock of the hardware backend
+roboarmtracing.clock = time
+roboarmmetrics.clock = time
+roboarmcycles.clock = time
 
 # keyboard control (keypress)
 button = ButtonBase()
@@ -57,159 +131,375 @@ logging.addLevelName(logging.WARNING, "\033[71m%s\033[0m" % logging.getLevelName
 
 
 class LegoRoboArm:
-    def __init__(self):
+    def __init__(self, name=None, bot=1, ports=None):
 
         # variables init
+        self.name = name
+        self.arm_label = name or roboarmmetrics.DEFAULT_ARM
+        self.ports = dict(PORTS, **(ports or {}))
+        self.iot_url = URL_IOT_TEMP.format(bot=bot)
+        self.state_file = STATE_FILE.format(name="_" + name if name else "")
         self.arm_in_movement = False
         self.temp_present = True
-        self.stop_event = Event()
+        self.stopping = False
+        self.scheduler = roboarmscheduler.Scheduler(time)
+        self.trace_context = None
+        # the movement processes answer a profile when the profiler was loaded before they started
+        self.profiled = False
+        self.thermal = roboarmthermal.ThermalGovernor(TEMP_SOFT_LIMIT, TEMP_LIMIT, arm=self.arm_label)
+        self.supply = roboarmsupply.SupplyMonitor(arm=self.arm_label)
         self.pro = Process(target=self.arm_movement)
         self.pro_iot = Process(target=self.send_information_to_iot)
 
-        time.sleep(2)
+        with roboarmstartup.stage("hardware settle"):
+            time.sleep(2)
 
         # setup the motors and sensors
+        self.start_pose = {}    # axis -> (position, polarity) the driver had before the reset
+        with roboarmstartup.stage("port discovery"):
+            roboarmstartup.discover([("grab motor", self.setup_grab_motor),
+                                     ("lift motor", self.setup_lift_motor),
+                                     ("base motor", self.setup_base_motor),
+                                     ("touch sensor", self.setup_touch_sensor),
+                                     ("color sensor", self.setup_color_sensor),
+                                     ("temperature sensor", self.setup_temperature_sensor),
+                                     ("power supply", self.setup_power_supply)], FAST_START)
+
+        # if all went OK then init position vars
+
         try:
-            self.grab_motor = LargeMotor(OUTPUT_A)
+            # movement parameters, replaced by the tuned ones when there is a TUNING_FILE
+            self.speed_base = SPEED_BASE
+            self.speed_lift = SPEED_LIFT
+            self.speed_grab_close = SPEED_GRAB_CLOSE
+            self.speed_grab_open = SPEED_GRAB_OPEN
+            self.base_extra = BASE_EXTRA
+            self.apply_tuning(roboarmtune.load(TUNING_FILE) if os.path.exists(TUNING_FILE) else {})
+            logger.info("POSITION VARS:")
+            logger.info("- BASE POSITION: " + str(self.base_position))
+            self.grab_position = int(self.grab_motor.count_per_rot * -0.25)  # 90 degrees
+            logger.info("- GRAB POSITION: " + str(self.grab_position))
+            self.lift_position = int(self.lift_motor.count_per_rot * LIFT_ARM_POS / 360.0)
+            logger.info("- LIFT POSITION: " + str(self.lift_position))
+            self.lift_initial_position = 0
+            # speed_sp limits of the supply voltage compensation
+            self.max_speed = {"lift": self.lift_motor.max_speed,
+                              "grab": self.grab_motor.max_speed,
+                              "base": self.base_motor.max_speed}
+        except:
+            logger.fatal("Position vars not inicialized")
+            sys.exit(-1)
+
+        # encoder drift seen at the base touch sensor and at the lift light sensor
+        self.base_landmark = roboarmdrift.Landmark("base", arm=self.arm_label)
+        self.lift_landmark = roboarmdrift.Landmark("lift", arm=self.arm_label)
+        self.lift_limit_position = None
+        self.base_touch_position = None
+        self.base_target = None
+
+        # stall / overload watchdog of the motors, running while the arm moves
+        self.watchdog = roboarmwatchdog.Watchdog({"lift": self.lift_motor,
+                                                  "grab": self.grab_motor,
+                                                  "base": self.base_motor}, self.motor_fault, time,
+                                                 arm=self.arm_label)
+
+        # resume from the pose saved by the last run when the arm has not moved since
+        self.homed = False
+        self.saved_pose = None
+        with roboarmstartup.stage("state resume"):
+            try:
+                self.state = roboarmstate.ArmState(self.state_file)
+                self.resume_state()
+            except (IOError, OSError, ValueError):
+                logger.error("[STATE] " + self.state_file + " not usable - " + str(sys.exc_info()[1]))
+                self.state = None
+        return
+
+    def pose(self):
+        # what the state file keeps: encoders, sensors and calibration
+        pose = {"touch": self.base_limit_sensor.value(0),
+                "reflect": self.lift_limit_reader.value(0),
+                "base_target": self.base_target,
+                "lift_initial_position": self.lift_initial_position,
+                "lift_limit_position": self.lift_limit_position,
+                "base_correction": self.base_landmark.correction,
+                "base_reference_up": self.base_landmark.reference.get(1),
+                "base_reference_down": self.base_landmark.reference.get(-1),
+                "lift_correction": self.lift_landmark.correction,
+                "lift_reference": self.lift_landmark.reference.get(1)}
+        for axis, motor in (("lift", self.lift_motor), ("grab", self.grab_motor), ("base", self.base_motor)):
+            pose[axis + "_position"] = motor.position
+            pose[axis + "_inversed"] = motor.polarity == motor.POLARITY_INVERSED
+        return pose
+
+    def save_state(self, moving=False):
+        roboarmmetrics.HOMED.set(1 if self.homed and not moving else 0, self.arm_label)
+        if self.state is None:
+            return
+        try:
+            # the pose saved with moving is not used on a restart, so the last one is kept
+            if not moving or self.saved_pose is None:
+                self.saved_pose = self.pose()
+                self.saved_pose["holding"] = roboarmstate.holding_mask({"lift": self.lift_motor,
+                                                                        "grab": self.grab_motor,
+                                                                        "base": self.base_motor})
+            self.state.save(homed=self.homed, moving=moving, **self.saved_pose)
+        except (IOError, OSError, ValueError):
+            logger.error("[STATE] save error: " + str(sys.exc_info()[1]))
+
+    def resume_state(self):
+        tic = time.time()
+        saved = self.state.load()
+        # what the encoders read before the reset of setup
+        observed = {"touch": self.base_limit_sensor.value(0), "reflect": self.lift_limit_reader.value(0)}
+        for axis, motor in (("lift", self.lift_motor), ("grab", self.grab_motor), ("base", self.base_motor)):
+            position, polarity = self.start_pose[axis]
+            observed[axis + "_position"] = position
+            observed[axis + "_inversed"] = polarity == motor.POLARITY_INVERSED
+        reason = roboarmstate.mismatch(saved, observed)
+        if reason is not None:
+            logger.info("[STATE] not resuming, homing needed: " + reason)
+            self.save_state()
+            return False
+        for axis, bit in roboarmstate.MOTOR_BITS:
+            motor = getattr(self, axis + "_motor")
+            if saved[axis + "_inversed"]:
+                motor.polarity = motor.POLARITY_INVERSED
+            motor.position = observed[axis + "_position"]
+            if saved["holding"] & bit:
+                motor.stop_action = motor.STOP_ACTION_HOLD
+                motor.stop()
+        self.base_target = saved["base_target"]
+        self.lift_initial_position = saved["lift_initial_position"]
+        self.lift_limit_position = saved["lift_limit_position"]
+        for landmark, references in ((self.base_landmark, ((1, "base_reference_up"), (-1, "base_reference_down"))),
+                                     (self.lift_landmark, ((1, "lift_reference"),))):
+            landmark.correction = saved[landmark.axis + "_correction"]
+            for direction, name in references:
+                if saved[name] is not None:
+                    landmark.reference[direction] = saved[name]
+        self.homed = True
+        self.save_state()
+        logger.info("[STATE] resumed the saved pose in " + str(round((time.time() - tic) * 1000, 1)) + " ms")
+        return True
+
+    def setup_grab_motor(self):
+        try:
+            self.grab_motor = LargeMotor(self.ports["grab"])
+            self.start_pose["grab"] = (self.grab_motor.position, self.grab_motor.polarity)
             self.grab_motor.reset()
             self.grab_motor.stop_action = self.grab_motor.STOP_ACTION_BRAKE
         except:
-            logger.fatal("Medium Motor (GRAB) not present in port A - " + str(sys.exc_info()[1]))
-            requests.get(URL_IOT_TEMP + str(-1), data='', timeout=URL_IOT_TIMEOUT)
+            logger.fatal("Medium Motor (GRAB) not present in port " + str(self.ports["grab"]) + " - " +
+                         str(sys.exc_info()[1]))
+            requests.get(self.iot_url + str(-1), data='', timeout=URL_IOT_TIMEOUT)
             sys.exit(-1)
 
+    def setup_lift_motor(self):
         try:
-            self.lift_motor = LargeMotor(OUTPUT_B)
+            self.lift_motor = LargeMotor(self.ports["lift"])
+            self.start_pose["lift"] = (self.lift_motor.position, self.lift_motor.polarity)
             self.lift_motor.reset()
             self.lift_motor.stop_action = self.lift_motor.STOP_ACTION_HOLD
             # using polarity="inversed" so that lifting up is the positive direction
             # self.lift_motor.polarity = self.lift_motor.POLARITY_INVERSED
         except:
-            logger.fatal("Large Motor (LIFT) not present in port B - " + str(sys.exc_info()[1]))
-            requests.get(URL_IOT_TEMP + str(-1), data='', timeout=URL_IOT_TIMEOUT)
+            logger.fatal("Large Motor (LIFT) not present in port " + str(self.ports["lift"]) + " - " +
+                         str(sys.exc_info()[1]))
+            requests.get(self.iot_url + str(-1), data='', timeout=URL_IOT_TIMEOUT)
             sys.exit(-1)
 
+    def setup_base_motor(self):
         try:
-            self.base_motor = LargeMotor(OUTPUT_D)
+            self.base_motor = LargeMotor(self.ports["base"])
+            self.start_pose["base"] = (self.base_motor.position, self.base_motor.polarity)
             self.base_motor.reset()
             self.base_motor.stop_action = self.base_motor.STOP_ACTION_HOLD
         except:
-            logger.fatal("Large Motor (BASE) not present in port D - " + str(sys.exc_info()[1]))
-            requests.get(URL_IOT_TEMP + str(-1), data='', timeout=URL_IOT_TIMEOUT)
+            logger.fatal("Large Motor (BASE) not present in port " + str(self.ports["base"]) + " - " +
+                         str(sys.exc_info()[1]))
+            requests.get(self.iot_url + str(-1), data='', timeout=URL_IOT_TIMEOUT)
             sys.exit(-1)
 
+    def setup_touch_sensor(self):
         try:
-            self.base_limit_sensor = TouchSensor(INPUT_4)
+            self.base_limit_sensor = TouchSensor(self.ports["touch"])
             self.base_limit_sensor.mode = "TOUCH"
         except:
             try:
-                logger.debug("TouchSensor not present in port S4 - creating sensor")
+                logger.debug("TouchSensor not present in port " + str(self.ports["touch"]) + " - creating sensor")
 
-                p = LegoPort(INPUT_4)
+                p = LegoPort(self.ports["touch"])
                 p.mode = "ev3-analog"
                 p.set_device = "lego-ev3-touch"
                 time.sleep(0.5)
-                self.base_limit_sensor = TouchSensor(INPUT_4)
+                self.base_limit_sensor = TouchSensor(self.ports["touch"])
                 self.base_limit_sensor.mode = "TOUCH"
             except:
-                logger.fatal("TouchSensor not present in port S4 - " + str(sys.exc_info()[1]))
-                requests.get(URL_IOT_TEMP + str(-1), data='', timeout=URL_IOT_TIMEOUT)
+                logger.fatal("TouchSensor not present in port " + str(self.ports["touch"]) + " - " +
+                             str(sys.exc_info()[1]))
+                requests.get(self.iot_url + str(-1), data='', timeout=URL_IOT_TIMEOUT)
                 sys.exit(-1)
+
+    def setup_color_sensor(self):
         try:
-            self.lift_limit_sensor = ColorSensor(INPUT_1)
+            self.lift_limit_sensor = ColorSensor(self.ports["color"])
             # Set the lift arm to a known position using the color sensor in reflect mode
             self.lift_limit_sensor.mode = "COL-REFLECT"
-            logger.debug("Sensor LUZ: " + str(self.lift_limit_sensor.value(0)))
+            self.lift_limit_reader = roboarmsensors.SensorReader(self.lift_limit_sensor, time)
+            logger.debug("Sensor LUZ: " + str(self.lift_limit_reader.value(0)))
         except:
             try:
-                logger.debug("ColorSensor not present in port S1 - creating sensor")
-                p = LegoPort(INPUT_1)
+                logger.debug("ColorSensor not present in port " + str(self.ports["color"]) + " - creating sensor")
+                p = LegoPort(self.ports["color"])
                 p.mode = "ev3-uart"
                 p.set_device = "lego-ev3-color"
                 time.sleep(0.5)
-                self.lift_limit_sensor = ColorSensor(INPUT_1)
+                self.lift_limit_sensor = ColorSensor(self.ports["color"])
                 self.lift_limit_sensor.mode = "COL-REFLECT"
+                self.lift_limit_reader = roboarmsensors.SensorReader(self.lift_limit_sensor, time)
             except:
-                logger.fatal("ColorSensor not present in port S1 - " + str(sys.exc_info()[1]))
-                requests.get(URL_IOT_TEMP + str(-1), data='', timeout=URL_IOT_TIMEOUT)
+                logger.fatal("ColorSensor not present in port " + str(self.ports["color"]) + " - " +
+                             str(sys.exc_info()[1]))
+                requests.get(self.iot_url + str(-1), data='', timeout=URL_IOT_TIMEOUT)
                 sys.exit(-1)
+
+    def setup_temperature_sensor(self):
         try:
-            self.temperature_sensor = Sensor(str(INPUT_3) + ':i2c76')
+            self.temperature_sensor = Sensor(str(self.ports["temperature"]) + ':i2c76')
             self.temperature_sensor.mode = "NXT-TEMP-C"
+            roboarmbus.set_priority(self.temperature_sensor, roboarmbus.TELEMETRY)
+            self.temperature_reader = roboarmsensors.SensorReader(self.temperature_sensor, time)
+            self.temperature_sampler = roboarmsampler.Sampler(self.temperature_reader)
             self.send_temperature_iot("[INIT]")
         except:
             try:
-                logger.debug("TemperatureSensor not present in port S3 - creating sensor")
-                p = LegoPort(INPUT_3)
+                logger.debug("TemperatureSensor not present in port " + str(self.ports["temperature"]) +
+                             " - creating sensor")
+                p = LegoPort(self.ports["temperature"])
                 p.mode = "nxt-i2c"
                 p.set_device = "lego-nxt-temp 0x4C"
                 time.sleep(0.5)
-                self.temperature_sensor = Sensor(str(INPUT_3) + ':i2c76')
+                self.temperature_sensor = Sensor(str(self.ports["temperature"]) + ':i2c76')
                 self.temperature_sensor.mode = "NXT-TEMP-C"
+                roboarmbus.set_priority(self.temperature_sensor, roboarmbus.TELEMETRY)
+                self.temperature_reader = roboarmsensors.SensorReader(self.temperature_sensor, time)
+                self.temperature_sampler = roboarmsampler.Sampler(self.temperature_reader)
                 time.sleep(0.5)
                 self.send_temperature_iot("[INIT]")
             except:
-                logger.warning("No Temperature Sensor on port S3 - " + str(sys.exc_info()[1]))
-                requests.get(URL_IOT_TEMP + str(-1), data='', timeout=URL_IOT_TIMEOUT)
+                logger.warning("No Temperature Sensor on port " + str(self.ports["temperature"]) + " - " +
+                               str(sys.exc_info()[1]))
+                requests.get(self.iot_url + str(-1), data='', timeout=URL_IOT_TIMEOUT)
                 self.temp_present = False
 
-        # if all went OK then init position vars
-
+    def setup_power_supply(self):
+        # the arm works without the voltage compensation
         try:
-            logger.info("POSITION VARS:")
-            self.base_position = int(self.base_motor.count_per_rot * (0.25 + BASE_EXTRA) / BASE_GEAR_RATIO)
-            logger.info("- BASE POSITION: " + str(self.base_position))
-            self.grab_position = int(self.grab_motor.count_per_rot * -0.25)  # 90 degrees
-            logger.info("- GRAB POSITION: " + str(self.grab_position))
-            self.lift_position = int(self.lift_motor.count_per_rot * LIFT_ARM_POS / 360.0)
-            logger.info("- LIFT POSITION: " + str(self.lift_position))
-            self.lift_initial_position = 0
+            self.power_supply = PowerSupply(POWER_SUPPLY)
+            roboarmbus.set_priority(self.power_supply, roboarmbus.TELEMETRY)
+            self.sample_supply()
         except:
-            logger.fatal("Position vars not inicialized")
-            sys.exit(-1)
-        return
+            logger.warning("No power supply to read the voltage from - " + str(sys.exc_info()[1]))
+            self.power_supply = None
 
+    def sample_supply(self):
+        # a supply voltage reading for the speed compensation
+        if self.power_supply is None:
+            return
+        low = self.supply.low
+        volts = self.supply.sample(self.power_supply.measured_volts)
+        logger.debug("[SUPPLY] voltage: " + str(round(volts, 2)) +
+                     " compensation: " + str(round(self.supply.factor(), 3)))
+        if self.supply.low and not low:
+            logger.warning("[SUPPLY] voltage " + str(round(volts, 2)) + " under " + str(roboarmsupply.LOW_VOLTS) +
+                           ", change the batteries")
+
+    def supply_speed(self, axis, speed):
+        # speed_sp turning the motor of the axis at speed with the supply voltage now
+        return self.supply.speed(speed, self.max_speed[axis])
+
+    def apply_tuning(self, parameters):
+        # parameters: {name: value} of roboarmtune.PARAMETERS, missing ones are kept
+        for name in (roboarmtune.PARAMETERS if parameters else ()):
+            if name in parameters:
+                setattr(self, name, parameters[name])
+                logger.info("[TUNING] " + name + ": " + str(parameters[name]))
+        self.base_position = int(self.base_motor.count_per_rot * (0.25 + self.base_extra) / BASE_GEAR_RATIO)
+
+    def tuning(self):
+        return dict((name, getattr(self, name)) for name in roboarmtune.PARAMETERS)
+
+    @roboarmtracing.traced()
+    @roboarmmetrics.phase("lift")
     def lift_move(self, speed, timeout=None):
+        timeout = self.supply.timeout(timeout)
         self.lift_motor.polarity = self.lift_motor.POLARITY_INVERSED
-        self.lift_motor.run_forever(speed_sp=speed)
+        self.lift_motor.run_forever(speed_sp=self.supply_speed("lift", speed))
         tic = time.time()
-        while self.lift_limit_sensor.value(0) <= LIFT_ARM_LIMIT \
-                and self.lift_motor.STATE_OVERLOADED not in self.lift_motor.state:
-            self.create_str_log_debug("[LIFT_MOVE] sensor value: ", str(self.lift_limit_sensor.value(0)) +
-                                      " status: " + str(self.lift_motor.state), tic, timeout)
+        # the light sensor is read slowly while the lift is far from where it crosses LIFT_ARM_LIMIT
+        poller = roboarmpolling.Poller(time, self.lift_motor.position,
+                                       self.lift_crossing(self.lift_motor.POLARITY_INVERSED), speed)
+        poller.wait(self.scheduler.sleep)
+        value = self.lift_limit_reader.value(0)
+        state = self.lift_motor.state
+        while value <= LIFT_ARM_LIMIT and self.lift_motor.STATE_OVERLOADED not in state:
+            roboarmmetrics.MOTION_LOOPS.inc(self.arm_label, "lift")
+            self.checkpoint()
+            self.create_str_log_debug("[LIFT_MOVE] sensor value: ", str(value) + " status: " + str(state),
+                                      tic, timeout)
             if timeout is not None and time.time() >= tic + timeout / 1000:
                 return False
+            poller.wait(self.scheduler.sleep)
+            value = self.lift_limit_reader.value(0)
+            state = self.lift_motor.state
+        # the light sensor just crossed LIFT_ARM_LIMIT: drift check of the lift
+        self.lift_landmark.observe(1, self.lift_motor.position)
         time.sleep(0.01)
-        self.create_str_log_debug("[LIFT_MOVE] sensor value: ", str(self.lift_limit_sensor.value(0)) +
+        self.create_str_log_debug("[LIFT_MOVE] sensor value: ", str(self.lift_limit_reader.value(0)) +
                                   " status: " + str(self.lift_motor.state), tic, timeout)
         return
 
+    @roboarmtracing.traced()
+    @roboarmmetrics.phase("lift")
     def lift_move_calup(self, speed, timeout=None):
+        timeout = self.supply.timeout(timeout)
         self.lift_motor.polarity = self.lift_motor.POLARITY_NORMAL
-        self.lift_motor.run_forever(speed_sp=speed)
+        self.lift_motor.run_forever(speed_sp=self.supply_speed("lift", speed))
         tic = time.time()
-        while self.lift_limit_sensor.value(0) > LIFT_ARM_LIMIT \
+        while self.lift_limit_reader.value(0) > LIFT_ARM_LIMIT \
                 and self.lift_motor.STATE_OVERLOADED not in self.lift_motor.state:
-            self.create_str_log_debug("[LIFT_UP] sensor value: ", str(self.lift_limit_sensor.value(0)) +
+            roboarmmetrics.MOTION_LOOPS.inc(self.arm_label, "lift")
+            self.checkpoint()
+            self.create_str_log_debug("[LIFT_UP] sensor value: ", str(self.lift_limit_reader.value(0)) +
                                       " status: " + str(self.lift_motor.state), tic, timeout)
             if timeout is not None and time.time() >= tic + timeout / 1000:
                 return False
         time.sleep(0.01)
-        self.create_str_log_debug("[LIFT_UP] sensor value: ", str(self.lift_limit_sensor.value(0)) +
+        self.create_str_log_debug("[LIFT_UP] sensor value: ", str(self.lift_limit_reader.value(0)) +
                                   " status: " + str(self.lift_motor.state), tic, timeout)
         return
 
+    @roboarmtracing.traced()
+    @roboarmmetrics.phase("grab")
     def grab_close(self, speed):
-        self.grab_motor.run_forever(speed_sp=speed)
-        time.sleep(0.8)
-        self.grab_motor.stop()
+        # closes against the object or the end stop, not a stall
+        with self.watchdog.expect_stall("grab"):
+            self.grab_motor.run_forever(speed_sp=self.supply_speed("grab", speed))
+            self.scheduler.sleep(self.supply.duration(0.8, speed, self.max_speed["grab"]))
+            self.grab_motor.stop()
         return
 
+    @roboarmtracing.traced()
+    @roboarmmetrics.phase("grab")
     def grab_open(self, speed, grab_position, timeout=None):
-        self.grab_motor.run_to_rel_pos(speed_sp=speed, position_sp=grab_position)
+        timeout = self.supply.timeout(timeout)
+        self.grab_motor.run_to_rel_pos(speed_sp=self.supply_speed("grab", speed), position_sp=grab_position)
         tic = time.time()
         while self.grab_motor.STATE_RUNNING in self.grab_motor.state \
                 and self.grab_motor.STATE_OVERLOADED not in self.grab_motor.state:
+            roboarmmetrics.MOTION_LOOPS.inc(self.arm_label, "grab")
+            self.checkpoint()
             self.create_str_log_debug("[GRAB_OPEN] status: ", str(self.grab_motor.state), tic, timeout)
             if timeout is not None and time.time() >= tic + timeout / 1000:
                 return False
@@ -217,82 +507,237 @@ class LegoRoboArm:
         self.create_str_log_debug("[GRAB_OPEN] FINAL status: ", str(self.grab_motor.state), tic, timeout)
         return
 
+    @roboarmtracing.traced()
+    @roboarmmetrics.phase("lift")
     def lift_move_pos(self, speed, position, timeout=None):
+        timeout = self.supply.timeout(timeout)
         # self.lift_motor.run_to_abs_pos(speed_sp=speed, position_sp=position)
         self.lift_motor.polarity = self.lift_motor.POLARITY_NORMAL
         logger.debug("[LIFT_MOVE] move to : " + str(position))
-        self.lift_motor.run_to_rel_pos(speed_sp=speed, position_sp=position)
+        self.lift_motor.run_to_rel_pos(speed_sp=self.supply_speed("lift", speed), position_sp=position)
         tic = time.time()
-        self.create_str_log_debug("[LIFT_DOWN] status: ", str(self.lift_motor.position) +
-                                  " sensor: " + str(self.lift_limit_sensor.value(0)) +
-                                  " state: " + str(self.lift_motor.state), tic, timeout)
-        while self.lift_motor.STATE_HOLDING not in self.lift_motor.state \
-                and self.lift_limit_sensor.value(0) <= (LIFT_ARM_LIMIT+7):
+        # the light sensor only guards the start, while the lift is near the LIFT_ARM_LIMIT crossing;
+        # the end of the move (holding) is still checked on every iteration
+        start = self.lift_motor.position
+        poller = roboarmpolling.Poller(time, start, self.lift_crossing(self.lift_motor.POLARITY_NORMAL), speed,
+                                       approaching=False)
+        poller.due()
+        value = self.lift_limit_reader.value(0)
+        state = self.lift_motor.state
+        self.create_str_log_debug("[LIFT_DOWN] status: ", str(start) +
+                                  " sensor: " + str(value) +
+                                  " state: " + str(state), tic, timeout)
+        while self.lift_motor.STATE_HOLDING not in state and value <= (LIFT_ARM_LIMIT+7):
+            roboarmmetrics.MOTION_LOOPS.inc(self.arm_label, "lift")
+            self.checkpoint()
             self.create_str_log_debug("[LIFT_DOWN] status: ", str(self.lift_motor.position) +
-                                      " sensor: " + str(self.lift_limit_sensor.value(0)) +
-                                      " state: " + str(self.lift_motor.state), tic, timeout)
+                                      " sensor: " + str(value) +
+                                      " state: " + str(state), tic, timeout)
             if timeout is not None and time.time() >= tic + timeout / 1000:
                 return False
+            state = self.lift_motor.state
+            if poller.due():
+                value = self.lift_limit_reader.value(0)
         time.sleep(0.01)
         self.create_str_log_debug("[LIFT_DOWN] status: ", str(self.lift_motor.position) +
-                                  " sensor: " + str(self.lift_limit_sensor.value(0)) +
+                                  " sensor: " + str(self.lift_limit_reader.value(0)) +
                                   " state: " + str(self.lift_motor.state), tic, timeout)
         return
 
+    @roboarmtracing.traced()
+    @roboarmmetrics.phase("lift")
+    def lift_move_abs(self, speed, position, timeout=None):
+        timeout = self.supply.timeout(timeout)
+        self.lift_motor.polarity = self.lift_motor.POLARITY_NORMAL
+        logger.debug("[LIFT_ABS] move to : " + str(position))
+        self.lift_motor.run_to_abs_pos(speed_sp=self.supply_speed("lift", speed), position_sp=position)
+        tic = time.time()
+        state = self.lift_motor.state
+        while self.lift_motor.STATE_RUNNING in state and self.lift_motor.STATE_OVERLOADED not in state:
+            roboarmmetrics.MOTION_LOOPS.inc(self.arm_label, "lift")
+            self.checkpoint()
+            self.create_str_log_debug("[LIFT_ABS] status: ", str(state), tic, timeout)
+            if timeout is not None and time.time() >= tic + timeout / 1000:
+                return False
+            state = self.lift_motor.state
+        # no settle time: the driver holds the lift at the position
+        self.create_str_log_debug("[LIFT_ABS] FINAL status: ", str(self.lift_motor.position) +
+                                  " state: " + str(self.lift_motor.state), tic, timeout)
+        return
+
+    @roboarmtracing.traced()
+    @roboarmmetrics.phase("base")
     def base_motor_touch(self, speed, timeout=None):
-        self.base_motor.run_forever(speed_sp=speed)
+        timeout = self.supply.timeout(timeout)
+        self.base_motor.run_forever(speed_sp=self.supply_speed("base", speed))
         tic = time.time()
         while not self.base_limit_sensor.value(0):
+            roboarmmetrics.MOTION_LOOPS.inc(self.arm_label, "base")
+            self.checkpoint()
             self.create_str_log_debug("[BASE_MOTOR_TOUCH] Touch value: ", str(self.base_motor.state), tic, timeout)
             if timeout is not None and time.time() >= tic + timeout / 1000:
                 return False
         self.base_motor.stop()
         self.create_str_log_debug("[BASE_MOTOR_TOUCH] FINAL Touch value: ", str(self.base_motor.state), tic, timeout)
 
-    def base_motor_to_position(self, speed, position, timeout=None):
-        self.base_motor.run_to_rel_pos(speed_sp=speed, position_sp=position)
+    @roboarmtracing.traced()
+    @roboarmmetrics.phase("base")
+    def base_motor_to_position(self, speed, position, timeout=None, touch=False):
+        timeout = self.supply.timeout(timeout)
+        self.base_motor.run_to_rel_pos(speed_sp=self.supply_speed("base", speed), position_sp=position)
         tic = time.time()
         logger.debug("[BASE_MOTOR_POS] Status: " + str(self.base_motor.state))
+        # with touch, base_touch_position is where the touch sensor closed on the way
+        self.base_touch_position = None
+        pressed = None
         while self.base_motor.STATE_HOLDING not in self.base_motor.state \
                 and self.base_motor.STATE_OVERLOADED not in self.base_motor.state:
+            roboarmmetrics.MOTION_LOOPS.inc(self.arm_label, "base")
+            self.checkpoint()
+            if touch:
+                touch_value = self.base_limit_sensor.value(0)
+                if touch_value and pressed is False and self.base_touch_position is None:
+                    self.base_touch_position = self.base_motor.position
+                pressed = bool(touch_value)
             self.create_str_log_debug("[BASE_MOTOR_POS] Status: ", str(self.base_motor.state), tic, timeout)
             if timeout is not None and time.time() >= tic + timeout / 1000:
                 return False
         self.create_str_log_debug("[BASE_MOTOR_POS] FINAL Status: ", str(self.base_motor.state), tic, timeout)
 
+    def base_to(self, speed, target):
+        # move the base to target (encoder position after homing, 0 is the center)
+        # corrected by the drift measured at the touch sensor on the previous passes
+        self.base_target = target
+        start = self.base_motor.position
+        relative = target + self.base_landmark.correction - start
+        direction = 1 if relative > 0 else -1
+        result = self.base_motor_to_position(speed, relative, WHILE_LOOP_TIMEOUT, touch=True)
+        if self.base_touch_position is not None:
+            self.base_landmark.observe(direction, self.base_touch_position)
+        elif result is not False:
+            self.base_landmark.passed(direction, start, start + relative)
+        return result
+
+    @roboarmtracing.traced()
+    def rehome_base(self):
+        # home the base alone: seek the touch sensor from below, as initialize() does
+        logger.warning("[REHOME_BASE] homing the base again, drift: " + str(self.base_landmark.drift))
+        self.base_motor.stop()
+        expected = self.base_landmark.expected(1)
+        if expected is not None:
+            # the sensor is about the last drift measured away from where it was
+            expected += self.base_landmark.drift
+            self.base_motor_to_position(SPEED_BASE, expected - BASE_REHOME_MARGIN - self.base_motor.position,
+                                        WHILE_LOOP_TIMEOUT)
+        if expected is None or self.base_limit_sensor.value(0) \
+                or self.base_motor_touch(SPEED_BASE, WHILE_LOOP_TIMEOUT) is False:
+            logger.error("[REHOME_BASE] touch sensor not found, full initialize")
+            self.initialize()
+            return
+        self.base_landmark.homed(1, self.base_motor.position)
+        self.base_to(SPEED_BASE, 0)
+        self.base_motor.stop()
+
+    @roboarmtracing.traced()
+    def lift_crossing(self, polarity):
+        # encoder position, in the given lift polarity, where the light sensor
+        # should cross LIFT_ARM_LIMIT; None when it is not known
+        expected = None if self.lift_landmark.lost else self.lift_landmark.expected(1)
+        if expected is None or polarity == self.lift_motor.POLARITY_INVERSED:
+            return expected
+        return -expected
+
+    def rehome_lift(self):
+        # home the lift alone at the light sensor, as initialize() does
+        logger.warning("[REHOME_LIFT] homing the lift again, drift: " + str(self.lift_landmark.drift))
+        self.lift_landmark.reset()
+        if self.lift_limit_reader.value(0) > LIFT_ARM_LIMIT:
+            self.lift_move_calup(SPEED_LIFT, WHILE_LOOP_TIMEOUT)
+        else:
+            self.lift_move(SPEED_LIFT, WHILE_LOOP_TIMEOUT)
+        self.lift_motor.stop()
+        self.learn_lift_limit()
+        roboarmmetrics.REHOMES.inc(self.arm_label, "lift")
+
+    def learn_lift_limit(self):
+        # encoder mode: after a sensor homing, the encoder position where the
+        # lifts of move() stop; the one where a sensor lift stops, so the light
+        # sensor reads there what it reads after lift_move()
+        if not LIFT_ENCODER_MODE:
+            return
+        if self.lift_limit_reader.value(0) <= LIFT_ARM_LIMIT:
+            # homed from above: cross the limit going up
+            self.lift_move(SPEED_LIFT, WHILE_LOOP_TIMEOUT)
+            self.lift_motor.stop()
+        self.lift_motor.polarity = self.lift_motor.POLARITY_NORMAL
+        self.lift_limit_position = self.lift_motor.position
+        logger.debug("[LIFT_LIMIT] encoder position: " + str(self.lift_limit_position))
+
+    def lift_up(self, speed):
+        # raise the lift to the limit; in encoder mode with the position control
+        # of the driver, then the light sensor checks it is at the limit
+        if not LIFT_ENCODER_MODE or self.lift_limit_position is None:
+            self.lift_move(speed, WHILE_LOOP_TIMEOUT)
+            self.lift_motor.stop()
+            return
+        self.lift_move_abs(speed, self.lift_limit_position, WHILE_LOOP_TIMEOUT)
+        value = self.lift_limit_reader.value(0)
+        if LIFT_ARM_LIMIT < value <= LIFT_ARM_LIMIT + LIFT_VERIFY_RANGE:
+            return
+        logger.warning("[LIFT_UP] light sensor reads " + str(value) + " at the encoder limit " +
+                       str(self.lift_limit_position) + ", homing the lift with the sensor")
+        roboarmmetrics.LIFT_FALLBACKS.inc(self.arm_label)
+        self.rehome_lift()
+
     def create_str_log_debug(self, str_base, str_status, tic=None, timeout=None):
         str_log = str_base + str_status
         if timeout is not None:
             str_log += " timeout: " + str(time.time() >= tic + timeout / 1000)
         logger.debug(str_log)
 
+    @roboarmtracing.traced()
     def send_temperature_iot(self, module):
         try:
-            temperature_value = self.temperature_sensor.value()
+            temperature_value, timestamp = self.temperature()
             if self.temp_present and temperature_value is not None and str(temperature_value):
+                roboarmmetrics.TEMPERATURE.set(temperature_value / 10.0, self.arm_label)
                 logger.debug(str(module) + "[TEMPERATURE]: " + str(float(temperature_value / 10.0)))
-                requests.get(URL_IOT_TEMP + str(float(temperature_value / 10.0)), data='', timeout=URL_IOT_TIMEOUT)
+                url = self.iot_url + str(float(temperature_value / 10.0)) + \
+                    "&throttle=" + str(round(self.thermal.level, 2)) + "&trend=" + str(self.thermal.trend_per_minute)
+                if self.thermal.time_to_limit is not None:
+                    url += "&time_to_limit=" + str(self.thermal.time_to_limit)
+                with roboarmmetrics.iot_send():
+                    requests.get(url, data='', timeout=URL_IOT_TIMEOUT)
         except:
             logger.error(str(module) + "[AMCS] Connection Error - " + str(sys.exc_info()[1]))
 
+    @roboarmtracing.traced()
+    @roboarmmetrics.timed(roboarmmetrics.INITIALIZE_SECONDS)
     def initialize(self):
         try:
             # Send Temp before initialize.
             self.send_temperature_iot("[INITIALIZE]")
+            self.sample_supply()
+            # the drift references are taken again after homing
+            self.base_landmark.reset()
+            self.lift_landmark.reset()
+            self.homed = False
+            self.save_state()
             # preparing arm moving.
             self.arm_in_movement = False
             # go to known position
-            if self.lift_limit_sensor.value(0) > LIFT_ARM_LIMIT:
+            if self.lift_limit_reader.value(0) > LIFT_ARM_LIMIT:
                 self.lift_move_calup(SPEED_LIFT, WHILE_LOOP_TIMEOUT)
             else:
                 self.lift_move(SPEED_LIFT, WHILE_LOOP_TIMEOUT)
             self.lift_motor.stop()
             self.lift_initial_position = self.lift_motor.position
+            self.learn_lift_limit()
 
             # Set the grabber to a known position by closing it all the way and then opening it
-            self.grab_close(180)
-            time.sleep(0.2)
-            self.grab_open(600, self.grab_position, WHILE_LOOP_TIMEOUT)
+            self.grab_close(self.speed_grab_close)
+            self.scheduler.sleep(0.2)
+            self.grab_open(self.speed_grab_open, self.grab_position, WHILE_LOOP_TIMEOUT)
 
             # set the base rotation to a known position using the touch sensor as a limit switch
             self.base_motor_touch(SPEED_BASE, WHILE_LOOP_TIMEOUT)
@@ -305,112 +750,183 @@ class LegoRoboArm:
             self.base_motor.stop()
             time.sleep(0.01)
             if self.base_motor.STATE_OVERLOADED in self.base_motor.state:
+                roboarmmetrics.OVERLOADS.inc(self.arm_label, "base")
+                roboarmcycles.overload()
                 logger.error("[INITIALIZE][BASE-MOTOR] Motor OVERLOADED!!")
                 self.stop()
             else:
-                time.sleep(0.5)
+                self.scheduler.sleep(0.5)
                 self.base_motor.reset()
                 self.base_motor.stop_action = self.base_motor.STOP_ACTION_HOLD
                 logger.debug("[INITIALIZE][BASE-MOTOR] Position   : " + str(self.base_motor.position))
                 logger.debug("[INITIALIZE][BASE-MOTOR] Stop action: " + str(self.base_motor.stop_action))
+                self.base_target = 0
+                self.homed = True
+                self.save_state()
+        except (roboarmscheduler.Preempted, roboarmwatchdog.MotorFault):
+            # the caller halts the arm and reports it
+            raise
         except:
             logger.fatal("[INITIALIZE] ERROR: " + str(sys.exc_info()[1]))
             sys.exit(-1)
         return
 
+    @roboarmtracing.traced()
+    @roboarmmetrics.timed(roboarmmetrics.CYCLE_SECONDS)
+    @roboarmcycles.recorded(lambda arm: arm.cycle_temperature())
     def move(self, direction):
+        # speeds slowed down by the thermal governor near the temperature limit
+        speed_base = self.thermal.speed(self.speed_base)
+        speed_lift = self.thermal.speed(self.speed_lift)
+        speed_grab = self.thermal.speed(self.speed_grab_open)
+        # a restart in the middle of the move has to home the arm
+        self.save_state(moving=True)
+
         # rotate the base 90 degrees and wait for completion
         logger.debug("[MOVE][MOTOR-BASE] MOVE_1 to : " + str(direction * self.base_position))
-        self.base_motor_to_position(SPEED_BASE, (direction * self.base_position), WHILE_LOOP_TIMEOUT)
+        self.base_to(speed_base, direction * self.base_position)
         self.base_motor.stop()
         time.sleep(0.01)
         if self.base_motor.STATE_OVERLOADED in self.base_motor.state:
+            roboarmmetrics.OVERLOADS.inc(self.arm_label, "base")
+            roboarmcycles.overload()
             logger.error("[INITIALIZE][BASE-MOTOR] Motor OVERLOADED!!")
             sys.exit(-1)
         else:
-            time.sleep(0.5)
+            self.scheduler.sleep(0.5)
             # lower the lift arm and wait for completion
             logger.debug("[MOVE][MOTOR-LIFT] MOVE_2... LIFT DOWN")
-            self.lift_move_pos(SPEED_LIFT, self.lift_position, WHILE_LOOP_TIMEOUT)
+            self.lift_move_pos(speed_lift, self.lift_position, WHILE_LOOP_TIMEOUT)
 
             # grab an object
             logger.debug("[MOVE][MOTOR-GRAB] MOVE_3 GRAB OBJECT")
-            self.grab_close(180)
+            self.grab_close(self.speed_grab_close)
 
             # raise the lift to the limit
             logger.debug("[MOVE][MOTOR-LIFT] MOVE_4... LIFT UP")
-            self.lift_move(SPEED_LIFT, WHILE_LOOP_TIMEOUT)
-            self.lift_motor.stop()
+            self.lift_up(speed_lift)
 
             # rotate the base back to the center position and wait for completion
-            logger.debug("[MOVE][MOTOR-BASE] MOVE_5 to : " + str(direction * -self.base_position))
-            self.base_motor_to_position(SPEED_BASE, (direction * -self.base_position), WHILE_LOOP_TIMEOUT)
+            logger.debug("[MOVE][MOTOR-BASE] MOVE_5 to : 0")
+            self.base_to(speed_base, 0)
             self.base_motor.stop()
             time.sleep(0.01)
             if self.base_motor.STATE_OVERLOADED in self.base_motor.state:
+                roboarmmetrics.OVERLOADS.inc(self.arm_label, "base")
+                roboarmcycles.overload()
                 logger.error("[MOVE][BASE-MOTOR] Motor OVERLOADED!!")
-                self.stop()
-                self.initialize()
+                # only the base lost its position
+                self.rehome_base()
             else:
                 # lower the lift arm and wait for completion
-                self.lift_move_pos(SPEED_LIFT, self.lift_position, WHILE_LOOP_TIMEOUT)
-                time.sleep(0.2)
+                self.lift_move_pos(speed_lift, self.lift_position, WHILE_LOOP_TIMEOUT)
+                self.scheduler.sleep(0.2)
                 # release the object
-                self.grab_open(600, self.grab_position, WHILE_LOOP_TIMEOUT)
+                self.grab_open(speed_grab, self.grab_position, WHILE_LOOP_TIMEOUT)
 
                 # raise the lift arm to the limit
-                time.sleep(0.5)
-                self.lift_move(SPEED_LIFT, WHILE_LOOP_TIMEOUT)
-                self.lift_motor.stop()
+                self.scheduler.sleep(0.5)
+                self.lift_up(speed_lift)
+
+        # home again only the axes that drifted too far, between cycles
+        if self.base_landmark.lost:
+            self.rehome_base()
+        if self.lift_landmark.lost:
+            self.rehome_lift()
+        self.save_state()
         return
 
+    def temperature(self):
+        # (tenths of C, timestamp) published by the temperature sampler, read
+        # from the sensor when the sampler has no fresh reading; (None, None)
+        # without a temperature sensor
+        if not self.temp_present:
+            return None, None
+        reading = self.temperature_sampler.latest()
+        if reading is not None:
+            return reading[0], reading[1]
+        values, timestamp = self.temperature_reader.read()
+        return values[0], timestamp
+
+    def cycle_temperature(self):
+        # degrees C for the cycle records, None without a temperature sensor
+        if not self.temp_present:
+            return None
+        return self.temperature()[0] / 10.0
+
     def send_information_to_iot(self):
         logger.debug("[SEND_INFORMATION_TO_IOT] start sending. ")
+        if self.profiled:
+            roboarmprofiler.listen()
+        roboarmtracing.attach(self.trace_context)
         while True:
             self.send_temperature_iot("[SEND_INFORMATION_TO_IOT]")
+            self.sample_supply()
             time.sleep(0.5)
 
     def arm_movement(self):
         logger.debug("[ARM_MOVEMENT] start arm movement. ")
-        while True:
-            self.move(1)
-            time.sleep(1)
-            self.move(-1)
-            time.sleep(1)
-
-    def infinite_movement(self):
-        log.debug("[INFINITE_MOVEMENT] preparing arm new process.")
+        # the control core, before the watchdog thread starts
+        if REALTIME:
+            roboarmrealtime.control()
+        if self.profiled:
+            roboarmprofiler.listen()
+        roboarmtracing.attach(self.trace_context)
+        # a more urgent command preempts the movement at the next safe point
+        self.scheduler.running = roboarmscheduler.MOTION
+        self.watchdog.start()
         try:
-            self.pro.daemon = True
-            self.pro_iot.daemon = True
-            self.pro_iot.start()
-            self.pro.start()
-
-            while not self.stop_event.is_set():
-                logger.debug("[INFINITE_MOVEMENT] loop temperature: " + str(self.temperature_sensor.value())
-                             + " temp limit: " + str(TEMP_LIMIT)
-                             + " temp<temp_limit: " + str(int(self.temperature_sensor.value()) < TEMP_LIMIT))
-                self.stop_event.wait(1)
-            logger.debug("[INFINITE_MOVEMENT] loop temperature: " + str(self.temperature_sensor.value())
-                         + " temp limit: " + str(TEMP_LIMIT)
-                         + " temp<temp_limit: " + str(int(self.temperature_sensor.value()) < TEMP_LIMIT))
-            if self.pro_iot is not None:
-                self.pro_iot.terminate()
-            if self.pro is not None:
-                self.pro.terminate()
-            self.stop()
-            logger.debug("[INFINITE_MOVEMENT] infinite movement terminated!")
-            # a new process is prepared to the roboarm to can be initialized again.
-            self.pro = Process(target=self.arm_movement)
-            self.pro_iot = Process(target=self.send_information_to_iot)
-            time.sleep(1)
-            # roboarom movement set to False and signal is cleared.
-            self.arm_in_movement = False
-            self.stop_event.clear()
-        except:
-            logger.error("[INFINITE_MOVEMENT] error: " + str(sys.exc_info()))
-        return
+            while True:
+                self.move(1)
+                self.thermal_pause()
+                self.move(-1)
+                self.thermal_pause()
+        except roboarmwatchdog.MotorFault:
+            logger.error("[ARM_MOVEMENT] movement aborted: " + str(sys.exc_info()[1]))
+        except roboarmscheduler.Preempted:
+            logger.info("[ARM_MOVEMENT] movement " + str(sys.exc_info()[1]))
+            self.halt()
+
+    def thermal_pause(self):
+        # 1 second between moves, plus the cool-down the thermal governor plans
+        # from the temperature trend
+        temperature_value, timestamp = self.temperature()
+        pause = 0.0
+        if temperature_value is not None:
+            pause = self.thermal.update(temperature_value, timestamp)
+        self.scheduler.sleep(1 + pause)
+        while self.thermal.halted:
+            logger.warning("[THERMAL_PAUSE] temperature limit reached, waiting to cool down: " +
+                           str(temperature_value))
+            self.scheduler.sleep(5)
+            temperature_value, timestamp = self.temperature()
+            if temperature_value is not None:
+                self.thermal.update(temperature_value, timestamp)
+
+    def motor_fault(self, fault):
+        # called from the watchdog thread, the faulty axis is already braked; the
+        # movement process ends and its supervisor stops the arm
+        logger.error("[MOTOR_FAULT] " + str(fault))
 
+    def checkpoint(self):
+        # safe point of the motion wait loops: motor faults and preemption by a more urgent command
+        self.watchdog.check()
+        self.scheduler.check()
+
+    def halt(self):
+        # stop every motor where it is
+        for motor in (self.grab_motor, self.lift_motor, self.base_motor):
+            motor.stop()
+
+    def infinite_movement(self, process):
+        # supervisor of the movement process: a movement that ends on its own
+        # (motor fault, error) stops the arm like a stop command
+        process.join()
+        if self.arm_in_movement and not self.stopping:
+            logger.warning("[INFINITE_MOVEMENT] movement process ended, stopping the arm")
+            self.scheduler.submit(roboarmscheduler.STOP, self.shutdown_roboarm)
+
+    @roboarmtracing.traced()
     def create_infinite_movement(self):
         result = ""
 
@@ -421,44 +937,104 @@ class LegoRoboArm:
             result = "arm moving, call discarted"
         else:
             self.arm_in_movement = True
+            self.stopping = False
             logger.debug("[INFINITE_MOVEMENT] status: " + str(self.arm_in_movement))
             result = "arm movement initialized"
             try:
-                start_new_thread(self.infinite_movement, ())
+                self.pro.daemon = True
+                self.pro_iot.daemon = True
+                # the movement processes continue the trace of this thread
+                roboarmtracing.share()
+                self.trace_context = roboarmtracing.current()
+                self.profiled = "roboarmprofiler" in sys.modules
+                with roboarmtracing.span("pro_iot.start"):
+                    self.pro_iot.start()
+                with roboarmtracing.span("pro.start"):
+                    self.pro.start()
+                start_new_thread(self.infinite_movement, (self.pro,))
             except:
                 logger.error("[INFINITE_MOVEMENT] Error: " + str(sys.exc_info()))
-            time.sleep(1)
         return result
 
+    @roboarmtracing.traced()
+    def end_movement(self, timeout=MOVEMENT_STOP_TIMEOUT):
+        # the movement process was preempted by the command calling this: wait
+        # until it reaches a safe point and ends, then stop the arm
+        self.stopping = True
+        self.pro.join(timeout)
+        if self.pro.is_alive():
+            logger.error("[END_MOVEMENT] movement process not stopping, terminating it")
+            self.pro.terminate()
+        if self.pro_iot is not None:
+            self.pro_iot.terminate()
+        self.stop()
+        self.pro.join(MOVEMENT_STOP_TIMEOUT)
+        if self.pro.is_alive():
+            logger.error("[END_MOVEMENT] movement process not terminated, killing it")
+            self.pro.kill()
+            self.pro.join(MOVEMENT_STOP_TIMEOUT)
+        logger.debug("[END_MOVEMENT] infinite movement terminated!")
+        # a new process is prepared to the roboarm to can be initialized again.
+        self.pro = Process(target=self.arm_movement)
+        self.pro_iot = Process(target=self.send_information_to_iot)
+        self.arm_in_movement = False
+
+    @roboarmtracing.traced()
     def create_initialize(self):
         result = ""
 
         logger.info("[CREATE_INITIALIZE] status: " + str(self.arm_in_movement))
         if self.arm_in_movement:
-            # if arm is moving, a second call could create problems
-            logger.info("[CREATE_INITIALIZE] arm moving, initialize arm call discard.")
-            result = "arm moving, initialize call discarted"
-        else:
-            logger.debug("[CREATE_INITIALIZE] status: " + str(self.arm_in_movement))
-            result = "initialized"
-            try:
-                self.initialize()
-            except:
-                logger.error("[CREATE_INITIALIZE] Error: " + str(sys.exc_info()))
-            time.sleep(1)
+            # initialize preempted the movement
+            logger.info("[CREATE_INITIALIZE] arm moving, stopping the movement first.")
+            self.end_movement()
+        logger.debug("[CREATE_INITIALIZE] status: " + str(self.arm_in_movement))
+        result = "initialized"
+        try:
+            self.watchdog.start()
+            self.initialize()
+        except roboarmscheduler.Preempted:
+            self.halt()
+            result = "initialize " + str(sys.exc_info()[1])
+        except roboarmwatchdog.MotorFault:
+            logger.error("[CREATE_INITIALIZE] initialize aborted: " + str(sys.exc_info()[1]))
+            self.halt()
+            result = "initialize aborted: " + str(sys.exc_info()[1])
+        except:
+            logger.error("[CREATE_INITIALIZE] Error: " + str(sys.exc_info()))
+            result = "initialize error"
+        self.watchdog.stop()
         return result
 
+    @roboarmtracing.traced()
     def shutdown_roboarm(self):
         logger.info("[SHUTDOWN_ROBOARM] Stopping robot.")
         if self.arm_in_movement:
-            # event signal to kill the process and stop the roboarm.
-            self.stop_event.set()
+            self.end_movement()
             result = "stopped"
         else:
             result = "arm not moving or initializing, stop ignored"
-        time.sleep(1)
         return result
 
+    @roboarmtracing.traced()
+    def brake(self):
+        # brake every motor at once, without waiting for a safe point; called
+        # by the emergency stop handler itself, before it queues emergency_stop()
+        logger.warning("[EMERGENCY_STOP] Braking all motors.")
+        for motor in (self.grab_motor, self.lift_motor, self.base_motor):
+            motor.stop_action = motor.STOP_ACTION_BRAKE
+            motor.stop()
+
+    @roboarmtracing.traced()
+    def emergency_stop(self):
+        # the command preempting the one running: brake again (it may have
+        # moved a motor since) and end the movement
+        self.brake()
+        if self.arm_in_movement:
+            self.end_movement(timeout=0)
+        return "emergency stopped"
+
+    @roboarmtracing.traced()
     def stop(self):
         try:
             if self.pro is not None:
@@ -479,6 +1055,7 @@ class LegoRoboArm:
 
             # reset motors and sensors to prepare to new initialize command.
             self.lift_limit_sensor.mode = self.lift_limit_sensor.MODE_COL_REFLECT
+            self.lift_limit_reader.reset()
             self.grab_motor.reset()
             # Reset lift_motor and set brake to hold
             self.lift_motor.reset()
@@ -486,80 +1063,280 @@ class LegoRoboArm:
             # Reset base_motor and set brake to hold
             self.base_motor.reset()
             self.base_motor.stop_action = self.base_motor.STOP_ACTION_HOLD
+            # the encoders lost the pose, and the positions learned in their old
+            # frame: the lift goes up with the sensor until the next homing
+            self.homed = False
+            self.lift_limit_position = None
+            self.base_target = None
+            self.base_landmark.reset()
+            self.lift_landmark.reset()
+            self.save_state()
         except:
             logger.error("[STOP] Error stopping roboarm" + str(sys.exc_info()))
 
+    @roboarmtracing.traced()
     def get_temperature(self):
-        logger.debug("[GET_TEMPERATURE] value: " + str(float(self.temperature_sensor.value() / 10.0)))
-        return str(float(self.temperature_sensor.value()/10.0))
+        if not self.temp_present:
+            return None
+        temperature_value = self.temperature()[0] / 10.0
+        roboarmmetrics.TEMPERATURE.set(temperature_value, self.arm_label)
+        logger.debug("[GET_TEMPERATURE] value: " + str(float(temperature_value)))
+        return str(float(temperature_value))
 
 
-class GetTemperature(tornado.web.RequestHandler):
-    def get(self):
+class TracedHandler(tornado.web.RequestHandler):
+    # one span per request, parent of the LegoRoboArm spans it causes, and the
+    # request count and latency metrics
+    def prepare(self):
+        self.span = roboarmtracing.start_span(self.request.method + " " + self.request.path)
+        if roboarm is None:
+            # ROBOARM_FAST_START: the hardware init is still running
+            self.set_status(503)
+            self.set_header("Content-Type", "text/json")
+            self.finish({"status": "initializing"})
+
+    def arm(self, name):
+        # the arm of a request: the first one of the fleet without a name
+        if name is None:
+            return roboarm
+        if name not in fleet:
+            raise tornado.web.HTTPError(404)
+        return fleet[name]
+
+    async def each_arm(self, name, command):
+        # await command(arm) for the arm of the request; for the "all" arm on
+        # every arm of the fleet at the same time, and {arm name: result}
+        if name == ALL_ARMS:
+            results = await asyncio.gather(*[command(arm) for arm in fleet.values()])
+            return dict(zip(fleet, results))
+        return await command(self.arm(name))
+
+    def on_finish(self):
+        self.span.args["status"] = self.get_status()
+        roboarmtracing.end_span(self.span)
+        roboarmmetrics.observe_request(type(self).__name__, self.get_status(), self.request.request_time())
+
+
+class GetTemperature(TracedHandler):
+    async def get(self, name=None):
         try:
             logger.info("GET Temperature received!")
             self.set_header("Content-Type", "text/json")
-            result = roboarm.get_temperature()
-            self.write({"temperature": result})
+
+            async def temperature(arm):
+                # the last reading of the sampler, from shared memory: not queued behind the arm commands
+                return {"temperature": arm.get_temperature(),
+                        "throttle": arm.thermal.level,
+                        "trend": arm.thermal.trend_per_minute,
+                        "time_to_limit": arm.thermal.time_to_limit}
+            self.write(await self.each_arm(name, temperature))
             self.flush()
             self.finish()
             logger.debug("GET Temperature sended!")
             return
+        except tornado.web.HTTPError:
+            raise
         except:
             logger.fatal("Start_movement error: " + str(sys.exc_info()))
 
 
-class StartMovement(tornado.web.RequestHandler):
-    async def get(self):
+class StartMovement(TracedHandler):
+    async def get(self, name=None):
         try:
             logger.info("GET start_movement received!")
             self.set_header("Content-Type", "text/json")
-            result = roboarm.create_infinite_movement()
+            result = await self.each_arm(name, lambda arm: arm.scheduler.run(roboarmscheduler.MOTION,
+                                                                              arm.create_infinite_movement))
             self.write({"movement": result})
             logger.debug("[STARTMOVEMENT] Thread infinite movement launched!")
             self.flush()
             self.finish()
             return
+        except tornado.web.HTTPError:
+            raise
         except:
             logger.fatal("Start_movement error: " + str(sys.exc_info()))
 
 
-class StopMovement(tornado.web.RequestHandler):
-    def get(self):
+class StopMovement(TracedHandler):
+    async def get(self, name=None):
         try:
             logger.info("GET stop_movement received!")
             self.set_header("Content-Type", "text/json")
-            result = roboarm.shutdown_roboarm()
+            result = await self.each_arm(name, lambda arm: arm.scheduler.run(roboarmscheduler.STOP,
+                                                                              arm.shutdown_roboarm))
             self.write({"movement": result})
             self.flush()
             self.finish()
             return
+        except tornado.web.HTTPError:
+            raise
         except:
             logger.fatal("Stop_movement error: " + str(sys.exc_info()))
 
 
-class Initialize(tornado.web.RequestHandler):
-    def get(self):
+class EmergencyStop(TracedHandler):
+    async def get(self, name=None):
+        try:
+            logger.info("GET emergency_stop received!")
+            self.set_header("Content-Type", "text/json")
+
+            async def emergency_stop(arm):
+                # the motors are braked here, the queued command ends what was running
+                arm.brake()
+                return await arm.scheduler.run(roboarmscheduler.EMERGENCY_STOP, arm.emergency_stop)
+
+            result = await self.each_arm(name, emergency_stop)
+            self.write({"movement": result})
+            self.flush()
+            self.finish()
+            return
+        except tornado.web.HTTPError:
+            raise
+        except:
+            logger.fatal("Emergency_stop error: " + str(sys.exc_info()))
+
+
+class Initialize(TracedHandler):
+    async def get(self, name=None):
         try:
             logger.info("GET initialize received!")
             self.set_header("Content-Type", "text/json")
-            result = roboarm.create_initialize()
+            result = await self.each_arm(name, lambda arm: arm.scheduler.run(roboarmscheduler.CONFIGURATION,
+                                                                              arm.create_initialize))
             self.write({"movement": result})
             self.flush()
             self.finish()
             return
+        except tornado.web.HTTPError:
+            raise
         except:
             logger.fatal("Initialize error: " + str(sys.exc_info()))
 
 
+class ProfileController(tornado.web.RequestHandler):
+    async def get(self):
+        try:
+            logger.info("GET debug profile received!")
+            if not DEBUG_TOKEN or not roboarmprofiler.authorized(self.get_argument("token", None)):
+                raise tornado.web.HTTPError(404)
+            seconds = min(float(self.get_argument("seconds", "10")), roboarmprofiler.MAX_SECONDS)
+            output_format = self.get_argument("format", "collapsed")
+            if output_format not in roboarmprofiler.FORMATS or seconds <= 0:
+                raise tornado.web.HTTPError(400)
+            profile = roboarmprofiler.Profile(fleet_processes(profiled=True))
+            try:
+                profile.start()
+            except RuntimeError:
+                raise tornado.web.HTTPError(409)
+            await tornado.gen.sleep(seconds)
+            counts = profile.stop()
+            if output_format == "pstats":
+                self.set_header("Content-Type", "application/octet-stream")
+                self.set_header("Content-Disposition", "attachment; filename=roboarm.pstats")
+            else:
+                self.set_header("Content-Type", "text/plain")
+            self.write(roboarmprofiler.render(counts, output_format))
+            self.finish()
+            logger.debug("GET debug profile sended!")
+        except tornado.web.HTTPError:
+            raise
+        except:
+            logger.fatal("Profile error: " + str(sys.exc_info()))
+
+
+class TraceController(tornado.web.RequestHandler):
+    def get(self):
+        try:
+            logger.info("GET debug trace received!")
+            if self.request.remote_ip not in ("127.0.0.1", "::1") \
+                    and not (DEBUG_TOKEN and roboarmprofiler.authorized(self.get_argument("token", None))):
+                raise tornado.web.HTTPError(404)
+            self.set_header("Content-Type", "application/json")
+            self.write(roboarmtracing.chrome_trace())
+            if self.get_argument("clear", None):
+                roboarmtracing.clear()
+            self.finish()
+            logger.debug("GET debug trace sended!")
+        except tornado.web.HTTPError:
+            raise
+        except:
+            logger.fatal("Trace error: " + str(sys.exc_info()))
+
+
+class MetricsController(tornado.web.RequestHandler):
+    def get(self):
+        try:
+            logger.debug("GET metrics received!")
+            processes = {"web": os.getpid()}
+            processes.update(fleet_processes())
+            self.set_header("Content-Type", roboarmmetrics.CONTENT_TYPE)
+            self.write(roboarmmetrics.exposition(dict((name, pid) for name, pid in processes.items() if pid)))
+            self.finish()
+        except:
+            logger.fatal("Metrics error: " + str(sys.exc_info()))
+
+
+class StatsController(TracedHandler):
+    def get(self):
+        # ?window=seconds up to now (default 1 hour) or ?since=&until= (times of the
+        # arm clock), ?arm=name (default all the arms), ?step=minute|hour for the series
+        try:
+            logger.debug("GET stats received!")
+            if roboarmcycles.store is None:
+                raise tornado.web.HTTPError(503)
+            arm = self.get_argument("arm", ALL_ARMS)
+            step = self.get_argument("step", None)
+            if arm != ALL_ARMS and arm not in fleet:
+                raise tornado.web.HTTPError(404)
+            if step not in (None,) + tuple(dict(roboarmcycles.ROLLUPS)):
+                raise tornado.web.HTTPError(400)
+            try:
+                until = float(self.get_argument("until", time.time()))
+                window = float(self.get_argument("window", "3600"))
+                since = float(self.get_argument("since", until - window))
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            if not all(math.isfinite(value) for value in (since, until, window)) or since >= until:
+                raise tornado.web.HTTPError(400)
+            self.write(roboarmcycles.store.stats(since, until, None if arm == ALL_ARMS else arm, step))
+            self.finish()
+        except tornado.web.HTTPError:
+            raise
+        except:
+            logger.fatal("Stats error: " + str(sys.exc_info()))
+
+
+def fleet_processes(profiled=False):
+    # {process name: pid} of the movement and IoT processes of the moving arms;
+    # profiled: only the ones that answer a profile (the others would die of its signal)
+    processes = {}
+    for name, arm in fleet.items():
+        if arm.arm_in_movement and (arm.profiled or not profiled):
+            suffix = "" if len(fleet) == 1 else "_" + name
+            processes["arm_movement" + suffix] = arm.pro.pid
+            processes["iot" + suffix] = arm.pro_iot.pid
+    return processes
+
+
 class MyApplication(tornado.web.Application):
     def __init__(self):
         try:
             # variables init
             handlers = [(r"/move_start/", StartMovement),
                         (r"/move_stop/", StopMovement),
+                        (r"/emergency_stop/", EmergencyStop),
                         (r"/initialize/", Initialize),
                         (r"/get_temperature/", GetTemperature),
+                        (r"/arms/([^/]+)/move_start/", StartMovement),
+                        (r"/arms/([^/]+)/move_stop/", StopMovement),
+                        (r"/arms/([^/]+)/emergency_stop/", EmergencyStop),
+                        (r"/arms/([^/]+)/initialize/", Initialize),
+                        (r"/arms/([^/]+)/get_temperature/", GetTemperature),
+                        (r"/debug/profile/", ProfileController),
+                        (r"/debug/trace/", TraceController),
+                        (r"/metrics", MetricsController),
+                        (r"/stats", StatsController),
                         ]
             super(MyApplication, self).__init__(handlers)
             logger.debug("Web Server Initialize.")
@@ -567,24 +1344,67 @@ class MyApplication(tornado.web.Application):
             logger.fatal("StartMovement Error" + str(sys.exc_info()))
 
 
+def create_arms():
+    # {name: LegoRoboArm} of the ROBOARM_FLEET file, or the one arm on the default ports
+    roboarmcycles.open_store(CYCLES_FILE)
+    with roboarmstartup.stage("hardware init"):
+        if FLEET_FILE:
+            arms = roboarmfleet.create(LegoRoboArm, roboarmfleet.load(FLEET_FILE, PORTS))
+        else:
+            arms = collections.OrderedDict([("arm", LegoRoboArm())])
+    for arm in arms.values():
+        arm.scheduler.start()
+        if arm.temp_present:
+            arm.temperature_sampler.start()
+    return arms
+
+
+def start_roboarm(loop):
+    # ROBOARM_FAST_START: hardware init in a thread while the web server answers "initializing"
+    global roboarm, fleet
+    try:
+        arms = create_arms()
+    except BaseException:
+        logger.fatal("Hardware init error: " + str(sys.exc_info()[1]))
+        loop.add_callback(loop.stop)
+        return
+    fleet = arms
+    roboarm = next(iter(arms.values()))
+    logger.info(roboarmstartup.report())
+
+
+roboarm = None                      # the first arm, of the routes without an arm name
+fleet = collections.OrderedDict()   # {name: LegoRoboArm}
+
 if __name__ == "__main__":
     try:
-        roboarm = LegoRoboArm()
+        # the web process and the ones it starts leave the control core
+        if REALTIME:
+            roboarmrealtime.serve()
+        if not FAST_START:
+            fleet = create_arms()
+            roboarm = next(iter(fleet.values()))
         app = MyApplication()
 
         # start the web server
         try:
             logger.info("Launching webserver port(" + str(HTTP_SERVER_PORT) + ")")
-            server = tornado.httpserver.HTTPServer(app)
-            server.bind(HTTP_SERVER_PORT)
-            server.start(1)  # Forks multiple sub-processes
+            with roboarmstartup.stage("web server listen"):
+                server = tornado.httpserver.HTTPServer(app)
+                server.bind(HTTP_SERVER_PORT)
+                server.start(1)  # Forks multiple sub-processes
+            if FAST_START:
+                start_new_thread(start_roboarm, (ioloop.IOLoop.current(),))
+            else:
+                logger.info(roboarmstartup.report())
             ioloop.IOLoop.current().start()
             logger.info("Closing webserver")
         except:
             logger.error('Could not START REST API web server ' + str(sys.exc_info()))
             ioloop.IOLoop.current().stop()
-            roboarm.shutdown_roboarm()
-            roboarm.stop()
+            for arm in fleet.values():
+                arm.shutdown_roboarm()
+                arm.stop()
             exit(-1)
     except:
         time.sleep(1)
@@ -9,10 +9,19 @@
 
 # We use import ev3dev.ev3 instead of ev3dev.auto because we only use ev3 devices
 
+import os
 from multiprocessing import Process, Event
 from threading import Thread
 from _thread import start_new_thread
-from ev3dev.brickpi3 import *
+if os.environ.get("ROBOARM_BACKEND") == "sim":
+    from roboarmsim import *
+elif os.environ.get("ROBOARM_BACKEND") == "replay":
+    from roboarmtrace import *
+else:
+    from ev3dev.brickpi3 import *
+if os.environ.get("ROBOARM_TRACE"):
+    import roboarmtrace
+    roboarmtrace.install(globals(), os.environ["ROBOARM_TRACE"])
 from tornado import web
 from tornado import ioloop
 from tornado import httpserver
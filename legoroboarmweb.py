@@ -10,12 +10,26 @@
 # We use import ev3dev.ev3 instead of ev3dev.auto because we only use ev3 devices
 
 
+import os
 from multiprocessing import Process
 from threading import Thread
-from ev3dev.ev3 import *
+if os.environ.get("ROBOARM_BACKEND") == "sim":
+    from roboarmsim import *
+    world.set_platform("ev3")
+elif os.environ.get("ROBOARM_BACKEND") == "replay":
+    from roboarmtrace import *
+else:
+    from ev3dev.ev3 import *
+if os.environ.get("ROBOARM_TRACE"):
+    import roboarmtrace
+    roboarmtrace.install(globals(), os.environ["ROBOARM_TRACE"])
 from web import application as web_application
 
 import logging
+import socket
+import time as walltime
+
+import roboarmfeedback
 
 
 BASE_GEAR_RATIO = 12.0 / 36.0  # 12-tooth gear turn 36-tooth gear
@@ -25,10 +39,13 @@ BASE_EXTRA = 0.06              # to account for slop in gears (units: rotations)
 SPEED_BASE = 150               # speed of base motor
 SPEED_LIFT = 150               # speed of lift motor
 TEMP_LIMIT = 300               # temp in C (no decimals) to stop arm fail simulation
+WEB_SERVER_PORT = 8080         # port of web.py, unless the command line gives one
+WEB_READY_TIMEOUT = 25         # seconds the web server has to start listening
 
 logger = logging.getLogger(__name__)
 button = Button()
 sound = Sound()
+feedback = roboarmfeedback.Feedback(sound, Leds)
 
 # init logger
 logging.basicConfig(filename='roboarm.log',
@@ -63,6 +80,18 @@ class RESTServer(Thread):
 
         self.www = web_application(tuple(urls), class_name_to_object)
 
+    def wait_ready(self, timeout=WEB_READY_TIMEOUT):
+        # True once the web server accepts connections (wall clock)
+        port = int(sys.argv[1].rsplit(":", 1)[-1]) if len(sys.argv) > 1 else WEB_SERVER_PORT
+        deadline = walltime.time() + timeout
+        while self.is_alive() and walltime.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.5).close()
+                return True
+            except (IOError, OSError):
+                walltime.sleep(0.1)
+        return False
+
     def run(self):
         # start the web server
         try:
@@ -110,7 +139,7 @@ class LegoRoboArm:
         self.pro = Process(target=self.infinite_movement)
 
         time.sleep(2)
-        sound.speak("WEDO Robo Arm Initialiting")
+        feedback.speak("WEDO Robo Arm Initialiting")
 
         # setup the motors and sensors
         try:
@@ -167,8 +196,10 @@ class LegoRoboArm:
             self.rest_server = RESTServer(self)
             self.rest_server.daemon = True
             self.rest_server.start()
-            time.sleep(25)
-            sound.speak("Web Server Ready!")
+            if self.rest_server.wait_ready():
+                feedback.speak("Web Server Ready!")
+            else:
+                logger.error("REST API not listening after " + str(WEB_READY_TIMEOUT) + " seconds")
         except:
             logger.fatal("REST API not available")
             sys.exit(-1)
@@ -210,42 +241,42 @@ class LegoRoboArm:
 
     def initialize(self):
         try:
-            Leds.set_color(Leds.LEFT, Leds.AMBER)
+            feedback.set_color(Leds.LEFT, Leds.AMBER)
             if self.lift_limit_sensor.value(0) > LIFT_ARM_LIMIT:
-                Leds.set_color(Leds.LEFT, Leds.RED)
+                feedback.set_color(Leds.LEFT, Leds.RED)
                 self.lift_move_calup(SPEED_LIFT)
             else:
-                Leds.set_color(Leds.LEFT, Leds.BLACK)
+                feedback.set_color(Leds.LEFT, Leds.BLACK)
                 self.lift_move(SPEED_LIFT)
             self.lift_motor.stop()
             self.lift_initial_position = self.lift_motor.position
 
             print("Posicion Inicial: ", self.lift_initial_position)
-            Leds.set_color(Leds.LEFT, Leds.GREEN)
+            feedback.set_color(Leds.LEFT, Leds.GREEN)
 
             # Set the grabber to a known position by closing it all the way and then opening it
 
-            Leds.set_color(Leds.RIGHT, Leds.AMBER)
+            feedback.set_color(Leds.RIGHT, Leds.AMBER)
             self.grab_motor.run_forever(speed_sp=400)
             time.sleep(1)
             self.grab_motor.run_to_rel_pos(speed_sp=600, position_sp=self.grab_position)
-            Leds.set_color(Leds.RIGHT, Leds.GREEN)
+            feedback.set_color(Leds.RIGHT, Leds.GREEN)
 
             # set the base rotation to a known position using the touch sensor as a limit switch
 
-            Leds.set_color(Leds.LEFT, Leds.AMBER)
+            feedback.set_color(Leds.LEFT, Leds.AMBER)
             self.base_motor.run_forever(speed_sp=SPEED_BASE)
             while not self.base_limit_sensor.value(0):
                 pass
-            Leds.set_color(Leds.LEFT, Leds.RED)
+            feedback.set_color(Leds.LEFT, Leds.RED)
             self.base_motor.stop()
             self.base_motor.position = self.base_position
             self.base_motor.run_to_abs_pos(speed_sp=SPEED_BASE, position_sp=0)
             while self.base_motor.STATE_RUNNING in self.base_motor.state:
                 pass
-            Leds.set_color(Leds.LEFT, Leds.GREEN)
+            feedback.set_color(Leds.LEFT, Leds.GREEN)
             time.sleep(1)
-            sound.speak("Arm Ready!")
+            feedback.speak("Arm Ready!")
         except:
             logger.fatal("Error: " + str(sys.exc_info()[0]))
             sys.exit(-1)
@@ -339,12 +370,13 @@ class LegoRoboArm:
             self.pro.terminate()
             self.pro = Process(target=self.infinite_movement)
             time.sleep(1)
-            sound.speak("Warning. Warning. Failure Detected!")
+            feedback.speak("Warning. Warning. Failure Detected!")
             time.sleep(1)
         except KeyboardInterrupt:
             self.stop()
             time.sleep(1)
-            sound.speak("Good Bye!").wait()
+            feedback.speak("Good Bye!")
+            feedback.flush(roboarmfeedback.SPEECH_TIMEOUT)
 
     def shutdown_roboarm(self):
         self.shutdown_flag = True
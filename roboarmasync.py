@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# Coroutine flavor of the Robot Arm motion waits, for the Tornado IOLoop.
+#
+# The blocking motion primitives spin on a device attribute until the motion
+# is done ("while ...: pass"), so a Tornado script needs threads or processes
+# to keep serving while the arm moves. until() awaits the same conditions from
+# a coroutine: the condition is checked every PERIOD seconds and the IOLoop
+# (the asyncio loop, with Tornado 6) runs the request handlers in between, so
+# a single IOLoop thread drives the arm and serves HTTP.
+#
+# The waits poll: the ev3dev sensor values are not notified, and the motor
+# state notifies POLLPRI only, which the IOLoop handlers do not wait on.
+#
+# Cancellation is the one of the asyncio tasks: task.cancel() raises
+# CancelledError at the await the coroutine is in. running() stops the motors
+# of a primitive cancelled (or failed) in the middle of a motion, and lets the
+# error through.
+#
+# The pauses are on the wall clock of the loop: the simulated backend needs
+# ROBOARM_SIM_SPEEDUP for the motors to move while the loop waits.
+#
+
+import asyncio
+import contextlib
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+PERIOD = 0.01               # seconds between two checks of a motion condition
+
+
+async def until(condition, period=PERIOD):
+    # await condition() being true
+    while not condition():
+        await asyncio.sleep(period)
+
+
+@contextlib.contextmanager
+def running(*motors):
+    # the motors a primitive runs, stopped when it does not end normally
+    try:
+        yield
+    except BaseException:
+        for motor in motors:
+            try:
+                motor.stop()
+            except Exception:
+                logger.warning("[ASYNC] motor not stopped - " + str(sys.exc_info()[1]))
+        raise
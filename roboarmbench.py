@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+#
+# Benchmark suite for the Robot Arm H25 controllers, run against the simulated
+# hardware backend (roboarmsim.py).
+#
+# Scenarios:
+#    initialize  - duration of LegoRoboArm.initialize()
+#    move        - duration of move() cycles and cycles per hour
+#    stop        - latency from GET /move_stop/ until the motors are halted
+#    temperature - GET /get_temperature/ latency and throughput under load
+#    thermal     - sustained cycles per hour with motors that heat up quickly
+#    sensors     - cost of a sensor reading through bin_data and through the
+#                  text values (roboarmsensors.py)
+#    jitter      - periods of a control loop while the other processes keep
+#                  the cores busy, under the default scheduler and in the
+#                  real-time mode (roboarmrealtime.py, wall clock; the
+#                  ROBOARM_CONTROL_CPU and ROBOARM_FIFO_PRIORITY settings)
+#
+# Durations of the arm are measured on the simulated clock (what the real arm
+# would take); "wall" values are the CPU cost of the controller code itself.
+#
+# Usage:
+#    python3 roboarmbench.py --script legoroboarmtornadoBPv5 --output bpv5.json
+#    python3 roboarmbench.py --script legoroboarmtornadoBrickPi3 --output bp3.json
+#    python3 roboarmbench.py --compare bpv5.json bp3.json
+#    sudo ROBOARM_FIFO_PRIORITY=40 python3 roboarmbench.py --scenarios jitter
+#
+
+import os
+
+os.environ["ROBOARM_BACKEND"] = "sim"
+
+import argparse
+import importlib
+import inspect
+import json
+import logging
+import multiprocessing
+import platform
+import sys
+import time as walltime
+
+import roboarmrealtime
+import roboarmsensors
+import roboarmsim
+
+SCENARIOS = ("initialize", "move", "stop", "temperature", "thermal", "sensors", "jitter")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def summary(values):
+    if not values:
+        return {"count": 0}
+    return {"count": len(values),
+            "mean": sum(values) / len(values),
+            "min": min(values),
+            "median": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": max(values)}
+
+
+def load_script(name):
+    # the scripts keep the arm in a module global that the handlers use
+    module = importlib.import_module(name)
+    return module
+
+
+def new_arm(module, seed=0, io_latency=roboarmsim.IO_LATENCY):
+    roboarmsim.reset_world(seed=seed, io_latency=io_latency)
+    arm = module.LegoRoboArm()
+    module.roboarm = arm
+    return arm
+
+
+def make_app(module):
+    if hasattr(module, "MyApplication"):
+        return module.MyApplication()
+    return module.make_app()
+
+
+def bench_initialize(module, runs):
+    sim_times = []
+    wall_times = []
+    for seed in range(runs):
+        arm = new_arm(module, seed)
+        tic = roboarmsim.time.time()
+        wall = walltime.perf_counter()
+        arm.initialize()
+        wall_times.append(walltime.perf_counter() - wall)
+        sim_times.append(roboarmsim.time.time() - tic)
+    return {"seconds": summary(sim_times), "wall_seconds": summary(wall_times)}
+
+
+def bench_move(module, cycles):
+    arm = new_arm(module)
+    arm.initialize()
+    sim_times = []
+    wall_times = []
+    io_counts = []
+    for cycle in range(cycles):
+        direction = 1 if cycle % 2 == 0 else -1
+        io = roboarmsim.world.io_count
+        tic = roboarmsim.time.time()
+        wall = walltime.perf_counter()
+        arm.move(direction)
+        wall_times.append(walltime.perf_counter() - wall)
+        sim_times.append(roboarmsim.time.time() - tic)
+        io_counts.append(roboarmsim.world.io_count - io)
+    mean = sum(sim_times) / len(sim_times)
+    return {"seconds": summary(sim_times),
+            "wall_seconds": summary(wall_times),
+            "device_io_per_cycle": summary(io_counts),
+            "cycles_per_hour": 3600.0 / mean if mean > 0 else None,
+            "final_temperature": roboarmsim.world.temperature_c()}
+
+
+def serve(module):
+    # start the script's tornado application on a free local port
+    from tornado import httpserver
+    from tornado import testing
+
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(make_app(module))
+    server.add_sockets([sock])
+    return server, "http://127.0.0.1:" + str(port)
+
+
+def bench_stop(module, runs, run_time):
+    from tornado import gen
+    from tornado import httpclient
+    from tornado import ioloop
+
+    if not hasattr(module.LegoRoboArm, "create_infinite_movement"):
+        return {"skipped": "script has no /move_stop/ supervisor"}
+
+    arm = new_arm(module)
+    arm.initialize()
+    halted = []
+    original_stop = arm.stop
+
+    def timed_stop():
+        original_stop()
+        halted.append(roboarmsim.time.time())
+
+    arm.stop = timed_stop
+    # the supervisor waits on real events, so follow the wall clock from here
+    roboarmsim.world.clock.set_speedup(1.0)
+    latencies = []
+    responses = []
+
+    @gen.coroutine
+    def scenario(url):
+        client = httpclient.AsyncHTTPClient()
+        for run in range(runs):
+            yield client.fetch(url + "/move_start/", request_timeout=60)
+            yield gen.sleep(run_time)
+            del halted[:]
+            tic = roboarmsim.time.time()
+            yield client.fetch(url + "/move_stop/", request_timeout=60)
+            responses.append(roboarmsim.time.time() - tic)
+            while not halted or arm.arm_in_movement:
+                yield gen.sleep(0.01)
+            latencies.append(halted[0] - tic)
+
+    server, url = serve(module)
+    try:
+        ioloop.IOLoop.current().run_sync(lambda: scenario(url), timeout=runs * (run_time + 30))
+    finally:
+        server.stop()
+        roboarmsim.world.clock.set_speedup(None)
+    return {"halt_seconds": summary(latencies), "response_seconds": summary(responses)}
+
+
+def bench_temperature(module, requests_per_level, levels):
+    from tornado import gen
+    from tornado import httpclient
+    from tornado import ioloop
+
+    if not hasattr(module, "GetTemperature"):
+        return {"skipped": "script has no /get_temperature/ route"}
+
+    new_arm(module)
+    results = {}
+
+    @gen.coroutine
+    def level(url, concurrency):
+        client = httpclient.AsyncHTTPClient(max_clients=max(10, concurrency))
+        latencies = []
+        remaining = [requests_per_level]
+
+        @gen.coroutine
+        def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                tic = walltime.perf_counter()
+                yield client.fetch(url + "/get_temperature/", request_timeout=60)
+                latencies.append(walltime.perf_counter() - tic)
+
+        tic = walltime.perf_counter()
+        yield [worker() for _ in range(concurrency)]
+        elapsed = walltime.perf_counter() - tic
+        return {"latency_seconds": summary(latencies),
+                "requests_per_second": len(latencies) / elapsed if elapsed > 0 else None}
+
+    server, url = serve(module)
+    try:
+        for concurrency in levels:
+            results[str(concurrency)] = ioloop.IOLoop.current().run_sync(
+                lambda: level(url, concurrency))
+    finally:
+        server.stop()
+    return {"concurrency": results}
+
+
+def bench_thermal(module, hours, heat_gain):
+    # scripts with a thermal governor pause between moves as it asks, the
+    # others stop for good when the temperature reaches TEMP_LIMIT
+    arm = new_arm(module)
+    roboarmsim.world.HEAT_GAIN = heat_gain
+    try:
+        arm.initialize()
+        governed = hasattr(arm, "thermal_pause")
+        start = roboarmsim.time.time()
+        cycles = 0
+        peak = 0
+        stopped_after = None
+        while roboarmsim.time.time() < start + hours * 3600:
+            arm.move(1 if cycles % 2 == 0 else -1)
+            cycles += 1
+            temperature = arm.temperature_sensor.value()
+            peak = max(peak, temperature)
+            if governed:
+                arm.thermal_pause()
+            elif temperature >= module.TEMP_LIMIT:
+                stopped_after = roboarmsim.time.time() - start
+                break
+            else:
+                roboarmsim.time.sleep(1)
+        return {"cycles_per_hour": cycles / hours,
+                "peak_temperature": peak / 10.0,
+                "temperature_limit": module.TEMP_LIMIT / 10.0,
+                "stopped_after_seconds": stopped_after}
+    finally:
+        del roboarmsim.world.HEAT_GAIN
+
+
+def bench_sensors(module, reads):
+    # the color and temperature sensors of the arm, read by a SensorReader of
+    # each path; color_rgb: the color sensor in the 3 values RGB-RAW mode
+    arm = new_arm(module)
+    results = {}
+    for name, sensor, mode in (("color", arm.lift_limit_sensor, "COL-REFLECT"),
+                               ("temperature", arm.temperature_sensor, "NXT-TEMP-C"),
+                               ("color_rgb", arm.lift_limit_sensor, "RGB-RAW")):
+        sensor.mode = mode
+        results[name] = {}
+        for path in roboarmsensors.BIN_DATA, roboarmsensors.TEXT:
+            reader = roboarmsensors.SensorReader(sensor, roboarmsim.time, path)
+            reader.read()
+            wall_times = []
+            io = roboarmsim.world.io_count
+            tic = roboarmsim.time.time()
+            for _ in range(reads):
+                wall = walltime.perf_counter()
+                reader.read()
+                wall_times.append(walltime.perf_counter() - wall)
+            results[name][path] = {"wall_seconds": summary(wall_times),
+                                   "device_io_per_reading": (roboarmsim.world.io_count - io) / float(reads),
+                                   "seconds_per_reading": (roboarmsim.time.time() - tic) / reads,
+                                   "values": reader.count,
+                                   "path_used": reader.path}
+    return results
+
+
+def control_loop(period, seconds, realtime, results):
+    # the movement process: a loop due every period, its wake up times sent to results
+    roboarmrealtime.ENABLED = realtime
+    fifo = roboarmrealtime.control()
+    wakes = []
+    due = walltime.perf_counter() + period
+    end = due + seconds
+    while due < end:
+        pause = due - walltime.perf_counter()
+        if pause > 0:
+            walltime.sleep(pause)
+        wakes.append((due, walltime.perf_counter()))
+        due += period
+    results.put((fifo, wakes))
+
+
+def busy_process(realtime, stopped):
+    # the web and IoT processes: request sized chunks of work, all the time
+    roboarmrealtime.ENABLED = realtime
+    roboarmrealtime.serve()
+    payload = {"temperature": [22.5] * 64, "arm": "arm", "cycles": list(range(64))}
+    while not stopped.is_set():
+        for _ in range(100):
+            json.loads(json.dumps(payload))
+
+
+def bench_jitter(period, seconds, load):
+    results = {"period": period,
+               "cores": len(roboarmrealtime.CPUS),
+               "control_cpu": roboarmrealtime.cpus()[0],
+               "load_processes": load or len(roboarmrealtime.CPUS)}
+    for mode, realtime in (("default", False), ("realtime", True)):
+        stopped = multiprocessing.Event()
+        queue = multiprocessing.Queue()
+        busy = [multiprocessing.Process(target=busy_process, args=(realtime, stopped))
+                for _ in range(results["load_processes"])]
+        for process in busy:
+            process.start()
+        control = multiprocessing.Process(target=control_loop, args=(period, seconds, realtime, queue))
+        control.start()
+        fifo, wakes = queue.get()
+        control.join()
+        stopped.set()
+        for process in busy:
+            process.join()
+        periods = [wakes[n][1] - wakes[n - 1][1] for n in range(1, len(wakes))]
+        lateness = [woke - due for due, woke in wakes]
+        results[mode] = {"period_seconds": summary(periods),
+                         "lateness_seconds": summary(lateness),
+                         "late_periods": sum(1 for late in lateness if late > period),
+                         "fifo": fifo}
+    return results
+
+
+def run(args):
+    module = load_script(args.script)
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+    report = {"script": args.script,
+              "created": walltime.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "io_latency": roboarmsim.IO_LATENCY,
+              "results": {}}
+    scenarios = args.scenarios or SCENARIOS
+    for name in scenarios:
+        tic = walltime.perf_counter()
+        if name in ("initialize", "move", "thermal") and inspect.iscoroutinefunction(module.LegoRoboArm.move):
+            # its pauses await on the wall clock, which the simulated clock does not follow
+            result = {"skipped": "script moves the arm with coroutines"}
+        elif name == "initialize":
+            result = bench_initialize(module, args.runs)
+        elif name == "move":
+            result = bench_move(module, args.cycles)
+        elif name == "stop":
+            result = bench_stop(module, args.stop_runs, args.stop_after)
+        elif name == "thermal":
+            result = bench_thermal(module, args.thermal_hours, args.heat_gain)
+        elif name == "sensors":
+            result = bench_sensors(module, args.sensor_reads)
+        elif name == "jitter":
+            result = bench_jitter(args.jitter_period, args.jitter_seconds, args.jitter_load)
+        else:
+            result = bench_temperature(module, args.requests, args.concurrency)
+        result["bench_wall_seconds"] = walltime.perf_counter() - tic
+        report["results"][name] = result
+        print(name + ": " + json.dumps(result, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return report
+
+
+def flatten(value, prefix=""):
+    items = {}
+    if isinstance(value, dict):
+        for key in value:
+            items.update(flatten(value[key], prefix + "." + key if prefix else key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        items[prefix] = value
+    return items
+
+
+def compare(old_file, new_file):
+    with open(old_file) as old, open(new_file) as new:
+        old_report = json.load(old)
+        new_report = json.load(new)
+    old_values = flatten(old_report["results"])
+    new_values = flatten(new_report["results"])
+    print("%-60s %14s %14s %9s" % ("metric", old_report["script"][:14], new_report["script"][:14], "change"))
+    for key in sorted(set(old_values) & set(new_values)):
+        if not any(key.endswith(stat) for stat in ("median", "p90", "p99", "cycles_per_hour", "requests_per_second")):
+            continue
+        before = old_values[key]
+        after = new_values[key]
+        change = "%+.1f%%" % ((after - before) * 100.0 / before) if before else "-"
+        print("%-60s %14.6g %14.6g %9s" % (key, before, after, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Robot Arm H25 controller benchmarks (simulated hardware)")
+    parser.add_argument("--script", default="legoroboarmtornadoBPv5", help="controller module to benchmark")
+    parser.add_argument("--scenarios", nargs="*", choices=SCENARIOS, help="scenarios to run (default all)")
+    parser.add_argument("--runs", type=int, default=5, help="initialize() runs")
+    parser.add_argument("--cycles", type=int, default=50, help="move() cycles")
+    parser.add_argument("--stop-runs", type=int, default=3, help="/move_start/ + /move_stop/ rounds")
+    parser.add_argument("--stop-after", type=float, default=2.0, help="seconds of movement before stopping")
+    parser.add_argument("--requests", type=int, default=200, help="/get_temperature/ requests per level")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 8, 32], help="concurrent clients")
+    parser.add_argument("--thermal-hours", type=float, default=1.0, help="simulated hours of the thermal scenario")
+    parser.add_argument("--heat-gain", type=float, default=0.5, help="motor heating of the thermal scenario (C/s at full duty)")
+    parser.add_argument("--sensor-reads", type=int, default=2000, help="readings of every sensor and path")
+    parser.add_argument("--jitter-period", type=float, default=0.001, help="seconds between control loop wake ups")
+    parser.add_argument("--jitter-seconds", type=float, default=5.0, help="seconds of control loop in every mode")
+    parser.add_argument("--jitter-load", type=int, default=0, help="busy processes (default one per core)")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(args.compare[0], args.compare[1])
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# SPI bus arbitration of the BrickPi3 devices.
+#
+# On the BrickPi3 every motor and sensor attribute access (value(0), state,
+# position, speed_sp...) is an SPI transaction through the brickpi3 driver.
+# The motion wait loops and the watchdog (movement process), the IoT sampler
+# (IoT process) and the web handlers (web process, one per arm of a fleet)
+# all use the bus without knowing about each other.
+#
+# install() wraps the device classes of a script (like roboarmtrace) so every
+# access goes through one Bus:
+#
+# - one pass at a time over the bus, across the processes (a POSIX lock on a
+#   file, which the kernel drops when a terminated process held it)
+# - the accesses that come while a pass runs are batched into the next pass
+#   of the same process, and identical reads of one pass share a transaction
+# - motion accesses go first in a pass, and a telemetry pass waits (up to
+#   MAX_DEFER) while a motion pass of another process waits for the bus.
+#   Devices are motion devices unless set_priority() says otherwise
+#
+# The transactions, passes, the time the bus was held (its rate is the bus
+# utilization) and the time every access waited for its pass are in
+# roboarmmetrics, on the wall clock.
+#
+
+import fcntl
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time as walltime
+
+import roboarmmetrics
+
+logger = logging.getLogger(__name__)
+
+MOTION, TELEMETRY = range(2)
+PRIORITIES = roboarmmetrics.BUS_PRIORITIES
+MAX_DEFER = 0.02            # seconds a telemetry pass gives way to the motion passes
+DEFER_SLICE = 0.001         # seconds between the checks of a deferred pass
+
+# calls whose return value is a device reading; their arguments are part of the key
+READ_CALLS = ("value", "bin_data")
+
+BUS_CLASSES = ("LargeMotor", "MediumMotor", "Motor", "Sensor", "TouchSensor", "ColorSensor", "LegoPort",
+               "PowerSupply")
+
+
+class Access:
+    # one device access waiting for its pass
+
+    def __init__(self, priority, order, key, function):
+        self.priority = priority
+        self.order = order
+        # key of a read, None for writes and commands (never shared)
+        self.key = key
+        self.function = function
+        self.submitted = walltime.monotonic()
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class Bus:
+
+    def __init__(self):
+        self.lock_file = tempfile.TemporaryFile(prefix="roboarm-bus-")
+        # monotonic deadline while a motion pass of some process waits for the bus
+        self._motion_waiting = multiprocessing.RawValue("d", 0.0)
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # the passes of a forked process start from an idle bus
+        self.condition = threading.Condition()
+        self.pending = []
+        self.serving = False
+        self.order = 0
+
+    def transfer(self, priority, key, function):
+        # function() as one transaction of a pass; returns its result
+        with self.condition:
+            self.order += 1
+            access = Access(priority, self.order, key, function)
+            self.pending.append(access)
+            while self.serving and not access.done:
+                self.condition.wait()
+            if not access.done:
+                # this thread runs the pass of everything pending
+                self.serving = True
+                batch = self.pending
+                self.pending = []
+        if not access.done:
+            try:
+                self._pass(batch)
+            finally:
+                with self.condition:
+                    self.serving = False
+                    self.condition.notify_all()
+        if access.error is not None:
+            raise access.error
+        return access.result
+
+    def _defer(self):
+        deadline = walltime.monotonic() + MAX_DEFER
+        while walltime.monotonic() < min(deadline, self._motion_waiting.value):
+            walltime.sleep(DEFER_SLICE)
+
+    def _pass(self, batch):
+        if len(batch) > 1:
+            batch.sort(key=lambda access: (access.priority, access.order))
+        motion = batch[0].priority == MOTION
+        if motion:
+            self._motion_waiting.value = walltime.monotonic() + MAX_DEFER
+        else:
+            self._defer()
+        fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+        start = walltime.monotonic()
+        if motion:
+            self._motion_waiting.value = 0.0
+        reads = {}
+        shared = []
+        try:
+            for access in batch:
+                if access.key is not None and access.key in reads:
+                    access.result, access.error = reads[access.key]
+                    shared.append(access)
+                    continue
+                try:
+                    access.result = access.function()
+                except BaseException:
+                    access.error = sys.exc_info()[1]
+                if access.key is None:
+                    # a write or command: the reads after it must see its effect
+                    reads.clear()
+                else:
+                    reads[access.key] = (access.result, access.error)
+        finally:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+            busy = walltime.monotonic() - start
+            for access in batch:
+                access.done = True
+        roboarmmetrics.BUS_PASSES.inc()
+        roboarmmetrics.BUS_BUSY_SECONDS.inc(amount=busy)
+        for access in batch:
+            roboarmmetrics.BUS_QUEUE_SECONDS.observe(start - access.submitted, PRIORITIES[access.priority])
+            if access in shared:
+                roboarmmetrics.BUS_SHARED_READS.inc(PRIORITIES[access.priority])
+            else:
+                roboarmmetrics.BUS_TRANSACTIONS.inc(PRIORITIES[access.priority])
+
+
+class BusDevice(object):
+    # proxy around an ev3dev device that makes every access a bus transaction
+
+    def __init__(self, device, address, bus):
+        object.__setattr__(self, "_device", device)
+        object.__setattr__(self, "_address", address)
+        object.__setattr__(self, "_bus", bus)
+        object.__setattr__(self, "_priority", MOTION)
+
+    def __getattr__(self, name):
+        device = self._device
+        attribute = getattr(type(device), name, None)
+        if name[:1].isupper() or name.startswith("_") \
+                or not (isinstance(attribute, property) or callable(attribute)):
+            # class constants (STATE_HOLDING, MODE_TOUCH...) and plain attributes are not device I/O
+            return getattr(device, name)
+        if isinstance(attribute, property):
+            return self._bus.transfer(self._priority, (self._address, name), lambda: getattr(device, name))
+        return self._bus_call(name, getattr(device, name))
+
+    def __setattr__(self, name, value):
+        device = self._device
+        if isinstance(getattr(type(device), name, None), property):
+            self._bus.transfer(self._priority, None, lambda: setattr(device, name, value))
+        else:
+            setattr(device, name, value)
+
+    def _bus_call(self, name, method):
+        bus = self._bus
+        address = self._address
+
+        def call(*args, **kwargs):
+            key = None
+            if name in READ_CALLS and not kwargs:
+                key = (address, name, args)
+            return bus.transfer(self._priority, key, lambda: method(*args, **kwargs))
+        return call
+
+
+def bus_class(cls, bus):
+
+    def factory(address=None, *args, **kwargs):
+        return BusDevice(cls(address, *args, **kwargs), str(address), bus)
+
+    factory.__name__ = cls.__name__
+    return factory
+
+
+def set_priority(device, priority):
+    # the bus priority of the accesses of a device; a no-op without install()
+    if isinstance(device, BusDevice):
+        object.__setattr__(device, "_priority", priority)
+
+
+def install(namespace):
+    # wrap the device classes imported by a script (its globals()) so the
+    # devices it creates from now on share one arbitrated bus
+    bus = Bus()
+    for name in BUS_CLASSES:
+        if name in namespace:
+            namespace[name] = bus_class(namespace[name], bus)
+    logger.info("[BUS] device I/O goes through the bus scheduler")
+    return bus
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+#
+# Cycle analytics of the Robot Arm.
+#
+# Every move() cycle (the recorded() decorator) is kept in a local SQLite
+# store, in WAL mode so /stats reads while the movement processes write: its
+# start time, direction, duration of every motion phase, overloads, timeouts,
+# the temperature at the start and at the end, and how it ended:
+#
+#    completed - move() returned
+#    stopped   - preempted by a more urgent command (a stop)
+#    fault     - a motor fault or an error ended it
+#
+# A failure is a cycle that ended on a fault or had an overload or a timeout.
+#
+# The cycles are queued and a writer thread of the process inserts them in
+# batches (after FLUSH_INTERVAL or BATCH_SIZE cycles), so the motion loops never
+# wait for the disk. The same transaction updates the per-minute and per-hour
+# rollups of the arm: the counts of the bucket plus the running totals since
+# the first cycle. The counts of any window are the difference of two running
+# totals, so stats() takes two index lookups per arm whatever the window. A
+# cycle older than the last bucket (a batch another process flushed late) adds
+# to the running totals of the buckets after it as well.
+#
+# The times are on the clock of the hardware backend (the scripts set clock).
+#
+
+import collections
+import functools
+import json
+import logging
+import multiprocessing.util
+import os
+import threading
+import time as walltime
+
+import roboarmmetrics
+import roboarmscheduler
+import roboarmstartup
+
+# imported by the first connection, off the start of the controller
+sqlite3 = roboarmstartup.lazy_import("sqlite3")
+
+logger = logging.getLogger(__name__)
+
+COMPLETED, STOPPED, FAULT = "completed", "stopped", "fault"
+COUNTS = ("cycles", "completed", "failures", "overloads", "timeouts", "busy_seconds")
+ROLLUPS = (("minute", 60), ("hour", 3600))
+FLUSH_INTERVAL = 1.0        # seconds a recorded cycle waits for its insert at most
+BATCH_SIZE = 64             # cycles inserted in one transaction at most
+BUSY_TIMEOUT = 5.0          # seconds a connection waits for the lock of another process
+MAX_POINTS = 1440           # buckets of a stats() series at most
+
+SCHEMA = ["CREATE TABLE IF NOT EXISTS cycles (id INTEGER PRIMARY KEY, arm TEXT NOT NULL, started REAL NOT NULL, "
+          "seconds REAL NOT NULL, direction INTEGER NOT NULL, outcome TEXT NOT NULL, overloads INTEGER NOT NULL, "
+          "timeouts INTEGER NOT NULL, temperature_start REAL, temperature_end REAL, phases TEXT NOT NULL)",
+          "CREATE INDEX IF NOT EXISTS cycles_started ON cycles (arm, started)",
+          "CREATE TABLE IF NOT EXISTS arms (arm TEXT PRIMARY KEY)"]
+for _table, _width in ROLLUPS:
+    SCHEMA.append("CREATE TABLE IF NOT EXISTS rollup_" + _table + " (arm TEXT NOT NULL, bucket INTEGER NOT NULL, " +
+                  ", ".join(name + " REAL NOT NULL" for name in COUNTS) + ", " +
+                  ", ".join("total_" + name + " REAL NOT NULL" for name in COUNTS) +
+                  ", PRIMARY KEY (arm, bucket)) WITHOUT ROWID")
+    SCHEMA.append("CREATE INDEX IF NOT EXISTS rollup_" + _table + "_bucket ON rollup_" + _table + " (bucket)")
+
+INSERT_CYCLE = "INSERT INTO cycles (arm, started, seconds, direction, outcome, overloads, timeouts, " \
+               "temperature_start, temperature_end, phases) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+ADD_COUNTS = ", ".join(name + " = " + name + " + ?" for name in COUNTS)
+ADD_TOTALS = ", ".join("total_" + name + " = total_" + name + " + ?" for name in COUNTS)
+TOTALS = ", ".join("total_" + name for name in COUNTS)
+
+# clock of the cycle times; the scripts set it to the time of their hardware backend
+clock = walltime
+# the Store of the process, open_store() sets it; without one nothing is recorded
+store = None
+_local = threading.local()
+
+
+class Cycle:
+
+    def __init__(self, arm, direction, started, temperature):
+        self.arm = arm
+        self.direction = direction
+        self.started = started
+        self.seconds = 0.0
+        self.outcome = None
+        self.phases = {}        # phase -> seconds, the phases that ran twice added up
+        self.overloads = 0
+        self.timeouts = 0
+        self.temperature_start = temperature
+        self.temperature_end = None
+
+    @property
+    def failed(self):
+        return self.outcome == FAULT or self.overloads > 0 or self.timeouts > 0
+
+    def counts(self):
+        # the values of COUNTS
+        return [1, int(self.outcome == COMPLETED), int(self.failed), self.overloads, self.timeouts, self.seconds]
+
+    def row(self):
+        return (self.arm, self.started, self.seconds, self.direction, self.outcome, self.overloads, self.timeouts,
+                self.temperature_start, self.temperature_end, json.dumps(self.phases, sort_keys=True))
+
+
+def _observe_phase(phase, seconds, timed_out):
+    cycle = getattr(_local, "cycle", None)
+    if cycle is not None:
+        cycle.phases[phase] = cycle.phases.get(phase, 0.0) + seconds
+        cycle.timeouts += int(timed_out)
+
+
+roboarmmetrics.phase_observers.append(_observe_phase)
+
+
+def overload():
+    # a motor overload of the cycle running in this thread, if any
+    cycle = getattr(_local, "cycle", None)
+    if cycle is not None:
+        cycle.overloads += 1
+
+
+def _temperature(temperature, arm):
+    try:
+        return temperature(arm)
+    except Exception:
+        return None
+
+
+def recorded(temperature):
+    # decorator of move(self, direction); temperature(arm): degrees C now, or None
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(arm, direction, *args, **kwargs):
+            if store is None:
+                return function(arm, direction, *args, **kwargs)
+            cycle = Cycle(arm.name or "arm", direction, clock.time(), _temperature(temperature, arm))
+            _local.cycle = cycle
+            try:
+                result = function(arm, direction, *args, **kwargs)
+            except roboarmscheduler.Preempted:
+                cycle.outcome = STOPPED
+                raise
+            except BaseException:
+                cycle.outcome = FAULT
+                raise
+            finally:
+                _local.cycle = None
+                cycle.seconds = clock.time() - cycle.started
+                if cycle.outcome is not None:
+                    store.put(cycle)
+            cycle.outcome = COMPLETED
+            cycle.temperature_end = _temperature(temperature, arm)
+            store.put(cycle)
+            return result
+        return wrapper
+    return decorator
+
+
+class Store:
+
+    def __init__(self, path):
+        self.path = path
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # the writer thread and the connections of a process are its own
+        self.condition = threading.Condition()
+        self.queue = []
+        self.closing = False
+        self.thread = None
+        self.local = threading.local()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        # the tables are created by the first connection to the file
+        for statement in SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def put(self, cycle):
+        # queue a finished cycle for the writer thread
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="roboarm-cycles")
+                self.thread.daemon = True
+                self.thread.start()
+                # the processes of multiprocessing do not run atexit
+                multiprocessing.util.Finalize(None, self.close, exitpriority=10)
+            self.queue.append(cycle)
+            if len(self.queue) >= BATCH_SIZE:
+                self.condition.notify()
+
+    def close(self):
+        # insert the cycles still queued, at the exit of the process
+        with self.condition:
+            if self.thread is None:
+                return
+            self.closing = True
+            self.condition.notify()
+        self.thread.join(2 * BUSY_TIMEOUT)
+
+    def _run(self):
+        connection = self._connect()
+        while True:
+            with self.condition:
+                while not self.queue and not self.closing:
+                    self.condition.wait()
+                deadline = walltime.monotonic() + FLUSH_INTERVAL
+                while len(self.queue) < BATCH_SIZE and not self.closing and walltime.monotonic() < deadline:
+                    self.condition.wait(deadline - walltime.monotonic())
+                batch = self.queue[:BATCH_SIZE]
+                del self.queue[:BATCH_SIZE]
+                done = self.closing and not self.queue
+            if batch:
+                try:
+                    self._insert(connection, batch)
+                except sqlite3.Error as error:
+                    logger.error("[CYCLES] " + str(len(batch)) + " cycles not stored - " + str(error))
+            if done:
+                connection.close()
+                return
+
+    def _insert(self, connection, batch):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(INSERT_CYCLE, [cycle.row() for cycle in batch])
+            connection.executemany("INSERT OR IGNORE INTO arms (arm) VALUES (?)",
+                                   [(arm,) for arm in set(cycle.arm for cycle in batch)])
+            for table, width in ROLLUPS:
+                deltas = collections.OrderedDict()
+                for cycle in sorted(batch, key=lambda cycle: cycle.started):
+                    key = (cycle.arm, int(cycle.started // width))
+                    deltas[key] = [total + count for total, count in
+                                   zip(deltas.get(key, [0] * len(COUNTS)), cycle.counts())]
+                for (arm, bucket), delta in deltas.items():
+                    self._add(connection, "rollup_" + table, arm, bucket, delta)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _add(self, connection, table, arm, bucket, delta):
+        if connection.execute("UPDATE " + table + " SET " + ADD_COUNTS + ", " + ADD_TOTALS +
+                              " WHERE arm = ? AND bucket = ?", delta + delta + [arm, bucket]).rowcount == 0:
+            totals = [total + count for total, count in zip(self._totals(connection, table, arm, bucket), delta)]
+            connection.execute("INSERT INTO " + table + " VALUES (" + ", ".join(["?"] * (2 + 2 * len(COUNTS))) + ")",
+                               [arm, bucket] + delta + totals)
+        # a late cycle: the buckets after it
+        connection.execute("UPDATE " + table + " SET " + ADD_TOTALS + " WHERE arm = ? AND bucket > ?",
+                           delta + [arm, bucket])
+
+    def _totals(self, connection, table, arm, bucket):
+        # running totals of the arm before the bucket
+        row = connection.execute("SELECT " + TOTALS + " FROM " + table + " WHERE arm = ? AND bucket < ? "
+                                 "ORDER BY bucket DESC LIMIT 1", (arm, bucket)).fetchone()
+        return list(row) if row else [0] * len(COUNTS)
+
+    def _reader(self):
+        # a connection of the thread for the queries
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = self._connect()
+        return self.local.connection
+
+    def arms(self):
+        return [row[0] for row in self._reader().execute("SELECT arm FROM arms ORDER BY arm")]
+
+    def stats(self, since, until, arm=None, step=None):
+        # counts of the cycles started from since until until (whole minutes) of
+        # one arm or all of them (None), the throughput and failure rate; step:
+        # "minute" or "hour" adds the counts of every bucket of that rollup
+        connection = self._reader()
+        start = int(since // 60)
+        end = max(start + 1, -int(-until // 60))
+        arms = [arm] if arm is not None else self.arms()
+        totals = [0] * len(COUNTS)
+        for name in arms:
+            before = self._totals(connection, "rollup_minute", name, start)
+            after = self._totals(connection, "rollup_minute", name, end)
+            totals = [total + now - then for total, now, then in zip(totals, after, before)]
+        result = {"since": start * 60, "until": end * 60, "arms": arms}
+        result.update(zip(COUNTS, totals))
+        window = (end - start) * 60.0
+        result["cycles_per_hour"] = result["completed"] * 3600.0 / window
+        result["failure_rate"] = result["failures"] / result["cycles"] if result["cycles"] else None
+        result["utilization"] = result["busy_seconds"] / window
+        if step is not None:
+            result["series"] = self.series(since, until, arm, step)
+        return result
+
+    def series(self, since, until, arm, step):
+        width = dict(ROLLUPS)[step]
+        query = "SELECT bucket, " + ", ".join("SUM(" + name + ")" for name in COUNTS) + " FROM rollup_" + step + \
+                " WHERE bucket >= ? AND bucket < ?"
+        parameters = [int(since // width), -int(-until // width)]
+        if arm is not None:
+            query += " AND arm = ?"
+            parameters.append(arm)
+        query += " GROUP BY bucket ORDER BY bucket LIMIT ?"
+        parameters.append(MAX_POINTS)
+        return [dict(zip(("start",) + COUNTS, [row[0] * width] + list(row[1:])))
+                for row in self._reader().execute(query, parameters)]
+
+
+def open_store(path):
+    # the store of the cycles of this process and the processes it forks
+    global store
+    store = Store(path)
+    logger.info("[CYCLES] recording the cycles in " + path)
+    return store
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Encoder drift detection for the Robot Arm axes.
+#
+# A landmark is the encoder position where a sensor changes while the axis
+# moves in one direction: the base touch sensor closing while the base swings
+# over its cam, the light sensor crossing LIFT_ARM_LIMIT while the lift rises.
+# The first pass after homing is the reference; every later pass measures the
+# drift of the encoder against it for free, during the normal movement.
+#
+# Small drifts are folded into a correction that the controller adds to the
+# axis targets. A drift over the limit, or a pass where the sensor should have
+# changed and did not, marks the axis as lost so that only that axis is homed
+# again.
+#
+
+import logging
+
+import roboarmmetrics
+
+logger = logging.getLogger(__name__)
+
+DRIFT_TOLERANCE = 2         # tacho counts of drift left alone (sensor jitter)
+DRIFT_LIMIT = 30            # tacho counts of drift that need the axis homed again
+
+
+class Landmark:
+
+    def __init__(self, axis, tolerance=DRIFT_TOLERANCE, limit=DRIFT_LIMIT, arm=roboarmmetrics.DEFAULT_ARM):
+        self.axis = axis
+        self.arm = arm
+        self.tolerance = tolerance
+        self.limit = limit
+        self.reset()
+
+    def reset(self):
+        # after the axis was homed
+        self.reference = {}     # direction -> landmark position without the correction
+        self.correction = 0     # tacho counts to add to the axis targets
+        self.drift = 0          # last drift measured
+        self.lost = False
+        roboarmmetrics.DRIFT.set(0, self.arm, self.axis)
+
+    def expected(self, direction):
+        # encoder position where the landmark should show up, None if not seen yet
+        if direction not in self.reference:
+            return None
+        return self.reference[direction] + self.correction
+
+    def observe(self, direction, position):
+        # the sensor changed at encoder position while moving in direction (+1/-1)
+        reference = self.reference.get(direction)
+        if reference is None:
+            self.reference[direction] = position - self.correction
+            return
+        self.drift = position - (reference + self.correction)
+        roboarmmetrics.DRIFT.set(self.drift, self.arm, self.axis)
+        if abs(self.drift) > self.limit:
+            logger.warning("[DRIFT] " + self.axis + " drift " + str(self.drift) + " over the limit, homing needed")
+            self.lost = True
+        elif abs(self.drift) > self.tolerance:
+            logger.debug("[DRIFT] " + self.axis + " drift " + str(self.drift) + " corrected")
+            self.correction += self.drift
+            roboarmmetrics.DRIFT_CORRECTIONS.inc(self.arm, self.axis)
+
+    def passed(self, direction, start, end):
+        # the axis went from start to end without the sensor changing
+        expected = self.expected(direction)
+        if expected is None:
+            return
+        if min(start, end) + self.limit < expected < max(start, end) - self.limit:
+            logger.warning("[DRIFT] " + self.axis + " landmark missed at " + str(expected) + ", homing needed")
+            self.lost = True
+
+    def homed(self, direction, position):
+        # the landmark was found again by a partial homing: keep the references
+        # and move the correction to where it is now
+        reference = self.reference.get(direction)
+        if reference is None:
+            self.reference[direction] = position - self.correction
+        else:
+            self.correction = position - reference
+        self.drift = 0
+        self.lost = False
+        roboarmmetrics.DRIFT.set(0, self.arm, self.axis)
+        roboarmmetrics.REHOMES.inc(self.arm, self.axis)
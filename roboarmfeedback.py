@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Sound and LED feedback of the EV3 Robot Arm scripts, off the motion path.
+#
+# sound.speak() starts espeak (and .wait() waits for the text to be spoken),
+# and every Leds.set_color() is two sysfs writes per LED, in the middle of the
+# startup, the homing and the failure handling. A Feedback object queues them
+# for a worker thread and returns at once:
+#
+# - LED colors are coalesced: the worker writes only the last color set for
+#   every LED group since its last pass, and nothing for a color already set
+# - the speech queue holds MAX_SPEECH texts and a full queue drops its oldest
+#   text; a text still queued max_age seconds after speak() is dropped as stale
+# - the worker speaks one text at a time, and keeps writing the LED colors
+#   while a text is spoken
+#
+# flush() waits (up to a timeout) until everything queued is done, for the
+# last words before the program exits. The worker is paced on the wall clock.
+#
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time as walltime
+
+logger = logging.getLogger(__name__)
+
+MAX_SPEECH = 4              # texts waiting to be spoken at most
+SPEECH_MAX_AGE = 5.0        # seconds a text may wait to be spoken, by default
+SPEECH_TIMEOUT = 15.0       # seconds a text may take to be spoken
+POLL = 0.05                 # seconds between two checks of the text being spoken
+
+
+class Feedback:
+
+    def __init__(self, sound, leds):
+        # sound: a Sound, leds: the Leds class (or object) of the backend
+        self.sound = sound
+        self.leds = leds
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # a forked process queues for a worker of its own, started at its first use
+        self.condition = threading.Condition()
+        self.speech = collections.deque()    # (text, deadline)
+        self.colors = {}                     # LED group -> (color, pct) to write
+        self.written = {}                    # LED group -> (color, pct) written
+        self.busy = False
+        self.thread = None
+
+    def set_color(self, group, color, pct=1):
+        # Leds.set_color(group, color, pct), by the worker
+        with self.condition:
+            self.colors[group] = (color, pct)
+            self._wake()
+
+    def speak(self, text, max_age=SPEECH_MAX_AGE):
+        # sound.speak(text), by the worker, unless it is still queued max_age seconds from now
+        with self.condition:
+            if len(self.speech) >= MAX_SPEECH:
+                logger.debug("[FEEDBACK] speech queue full, dropped: " + self.speech.popleft()[0])
+            self.speech.append((text, walltime.monotonic() + max_age))
+            self._wake()
+
+    def flush(self, timeout):
+        # wait until the feedback queued is done; False when timeout seconds were not enough
+        deadline = walltime.monotonic() + timeout
+        with self.condition:
+            while self.speech or self.colors or self.busy:
+                left = deadline - walltime.monotonic()
+                if left <= 0:
+                    return False
+                self.condition.wait(left)
+        return True
+
+    def _wake(self):
+        # with the condition held
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="roboarm-feedback")
+            self.thread.daemon = True
+            self.thread.start()
+        self.condition.notify_all()
+
+    def _write_colors(self):
+        with self.condition:
+            colors = self.colors
+            self.colors = {}
+        for group, color in colors.items():
+            if self.written.get(group) == color:
+                continue
+            try:
+                self.leds.set_color(group, color[0], color[1])
+                self.written[group] = color
+            except Exception:
+                logger.error("[FEEDBACK] LEDs not set - " + str(sys.exc_info()[1]))
+
+    def _say(self, text):
+        try:
+            process = self.sound.speak(text)
+        except Exception:
+            logger.error("[FEEDBACK] speech failed - " + str(sys.exc_info()[1]))
+            return
+        deadline = walltime.monotonic() + SPEECH_TIMEOUT
+        while process.poll() is None and walltime.monotonic() < deadline:
+            with self.condition:
+                if not self.colors:
+                    self.condition.wait(POLL)
+            self._write_colors()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.speech and not self.colors:
+                    self.busy = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+                self.busy = True
+                text, deadline = self.speech.popleft() if self.speech else (None, None)
+            self._write_colors()
+            if text is None:
+                continue
+            if walltime.monotonic() > deadline:
+                logger.debug("[FEEDBACK] stale speech dropped: " + text)
+                continue
+            self._say(text)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Fleet of Robot Arms run by one controller process.
+#
+# The fleet file (ROBOARM_FLEET) lists the arms with their name, the bot id
+# they send to the IoT server and the ports of their motors and sensors; the
+# ports not given are the default ones of the script:
+#
+#    {"arms": [{"name": "left", "bot": 1},
+#              {"name": "right", "bot": 2,
+#               "ports": {"grab": "spi0.1:MA", "lift": "spi0.1:MB", "base": "spi0.1:MD",
+#                         "color": "spi0.1:S1", "temperature": "spi0.1:S3", "touch": "spi0.1:S4"}}]}
+#
+# Every arm has its own command scheduler, so a command sent to all the arms
+# runs on all of them at the same time. The arms are also set up in parallel.
+#
+
+import collections
+import json
+import logging
+import re
+
+import roboarmstartup
+
+logger = logging.getLogger(__name__)
+
+ALL = "all"                 # arm name of the commands for every arm (ALL_ARMS of the controller)
+NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def _name(arm, index):
+    return str(arm.get("name", "arm" + str(index + 1)))
+
+
+def names(path):
+    # the arm names of the fleet file, in its order
+    with open(path) as fleet_file:
+        data = json.load(fleet_file)
+    return [_name(arm, index) for index, arm in enumerate(data["arms"])]
+
+
+def load(path, ports):
+    # [{"name", "bot", "ports"}] of the fleet file; ports: the default ports
+    with open(path) as fleet_file:
+        data = json.load(fleet_file)
+    arms = []
+    seen = set()
+    for index, arm in enumerate(data["arms"]):
+        name = _name(arm, index)
+        if not NAME.match(name) or name == ALL or name in seen:
+            raise ValueError("bad or repeated arm name " + repr(name) + " in " + path)
+        unknown = set(arm.get("ports", {})) - set(ports)
+        if unknown:
+            raise ValueError("unknown ports " + ", ".join(sorted(unknown)) + " of arm " + name)
+        arm_ports = dict(ports)
+        arm_ports.update(arm.get("ports", {}))
+        seen.add(name)
+        arms.append({"name": name, "bot": int(arm.get("bot", index + 1)), "ports": arm_ports})
+    if not arms:
+        raise ValueError("no arms in " + path)
+    return arms
+
+
+def create(factory, arms):
+    # {name: factory(**arm)} in the order of the file, all set up at the same time
+    setups = [(arm["name"], lambda arm=arm: factory(**arm)) for arm in arms]
+    created = roboarmstartup.discover(setups)
+    logger.info("[FLEET] " + str(len(created)) + " arms ready: " + ", ".join(arm["name"] for arm in arms))
+    return collections.OrderedDict((arm["name"], created[arm["name"]]) for arm in arms)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+#
+# Prometheus metrics for the Robot Arm controller.
+#
+# The values live in one shared memory array created at import, before the
+# movement and IoT processes are forked. Every process adds its counts to a
+# segment of its own, taken when it is forked (a free one, or the one of a
+# process that ended) and summed when /metrics is scraped, so there is no lock
+# across the processes: the controller terminates its children, and a child
+# terminated in the middle of an update loses nothing but that update. The
+# gauges are single writes to the first segment, the last one wins. Nothing
+# else is computed when /metrics is scraped except the text formatting and the
+# process CPU/RSS from /proc. Because the array is laid out at import, the
+# label values of every metric are declared up front; the arm label of the
+# per-arm metrics takes the arm names of the fleet file (ROBOARM_FLEET).
+#
+
+import bisect
+import contextlib
+import functools
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+
+import roboarmstartup
+
+# only needed with a fleet file
+roboarmfleet = roboarmstartup.lazy_import("roboarmfleet")
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SLOTS = 2048                # doubles in the segment of a process
+PROCESSES = 16              # segments of the shared memory array, processes updating the metrics at the same time
+
+DEFAULT_ARM = "arm"         # arm label of the single arm, without a fleet file
+AXES = ("lift", "grab", "base")
+PHASES = ("lift_move", "lift_move_calup", "lift_move_pos", "lift_move_abs", "grab_close", "grab_open",
+          "base_motor_touch", "base_motor_to_position")
+HANDLERS = ("GetTemperature", "StartMovement", "StopMovement", "EmergencyStop", "Initialize", "StatsController")
+CODES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+COMMAND_CLASSES = ("emergency_stop", "stop", "configuration", "motion", "telemetry")
+BUS_PRIORITIES = ("motion", "telemetry")
+SENSOR_PATHS = ("bin_data", "text")
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PHASE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0)
+CYCLE_BUCKETS = (5.0, 10.0, 12.5, 15.0, 17.5, 20.0, 30.0, 60.0)
+REACTION_BUCKETS = (0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0)
+BUS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+# clock of the arm durations; the scripts set it to the time of their hardware
+# backend (network and request latencies always use the wall clock)
+clock = time
+# functions called with (phase, seconds, timed out) after every motion
+# primitive that returned (roboarmcycles)
+phase_observers = []
+
+_lock = threading.Lock()    # the updates of the threads of this process
+_values = multiprocessing.RawArray("d", PROCESSES * SLOTS)
+_owners = multiprocessing.RawArray("l", PROCESSES)  # pid of the process of every segment, 0 when free
+_owners[0] = os.getpid()
+_base = 0                   # offset of the segment of this process
+_forking = None             # segment taken for the process being forked
+_used = 0
+_metrics = []
+
+
+def _alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _take_segment():
+    # before a fork: a segment for the child, kept with the pid of this process
+    # until the child writes its own
+    global _forking
+    _lock.acquire()
+    _forking = None
+    for index in range(1, PROCESSES):
+        if not _alive(_owners[index]):
+            _owners[index] = os.getpid()
+            _forking = index
+            return
+
+
+def _forked_parent():
+    _lock.release()
+
+
+def _forked_child():
+    global _lock, _base
+    _lock = threading.Lock()
+    if _forking is None:
+        # the counts of this process may overwrite some of its parent's
+        logger.warning("[METRICS] no free segment for process " + str(os.getpid()) + ", sharing the parent's")
+        return
+    _owners[_forking] = os.getpid()
+    _base = _forking * SLOTS
+
+
+os.register_at_fork(before=_take_segment, after_in_parent=_forked_parent, after_in_child=_forked_child)
+
+
+class Metric:
+
+    kind = None
+    width = 1
+
+    def __init__(self, name, documentation, labels=()):
+        # labels: ((label name, label values), ...)
+        global _used
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(label for label, values in labels)
+        self.slots = {}
+        for key in itertools.product(*[values for label, values in labels]):
+            self.slots[key] = _used
+            _used += self.width
+        if _used > SLOTS:
+            raise ValueError("no room for metric " + name + " in the shared memory array")
+        _metrics.append(self)
+
+    def get(self, *labels):
+        # the value of all the processes
+        slot = self.slots[labels]
+        return sum(_values[slot:PROCESSES * SLOTS:SLOTS])
+
+    def local(self, *labels):
+        # the value of this process
+        return _values[_base + self.slots[labels]]
+
+    def label_text(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % pair for pair in pairs) + "}"
+
+    def render(self, values):
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " " + self.kind]
+        for key, slot in sorted(self.slots.items()):
+            lines.append(self.name + self.label_text(key) + " " + _number(values[slot]))
+        return lines
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        slot = _base + self.slots[labels]
+        with _lock:
+            _values[slot] += amount
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        # in the first segment, the other segments keep 0 in the slots of the gauges
+        _values[self.slots[labels]] = value
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.buckets = tuple(buckets)
+        # one count per bucket plus +Inf, then the sum
+        self.width = len(self.buckets) + 2
+        Metric.__init__(self, name, documentation, labels)
+
+    def observe(self, value, *labels):
+        slot = _base + self.slots[labels]
+        with _lock:
+            _values[slot + bisect.bisect_left(self.buckets, value)] += 1
+            _values[slot + len(self.buckets) + 1] += value
+
+    def render(self, values):
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " " + self.kind]
+        for key, slot in sorted(self.slots.items()):
+            total = 0
+            for index, bound in enumerate(self.buckets + (None,)):
+                total += values[slot + index]
+                le = "+Inf" if bound is None else _number(bound)
+                lines.append(self.name + "_bucket" + self.label_text(key, ("le", le)) + " " + _number(total))
+            lines.append(self.name + "_sum" + self.label_text(key) + " " + _number(values[slot + len(self.buckets) + 1]))
+            lines.append(self.name + "_count" + self.label_text(key) + " " + _number(total))
+        return lines
+
+
+def _arm_names():
+    # values of the arm label: the arms of the fleet file, or the single arm
+    path = os.environ.get("ROBOARM_FLEET")
+    if not path:
+        return (DEFAULT_ARM,)
+    try:
+        return tuple(roboarmfleet.names(path))
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        # the controller reports the fleet file when it loads it
+        return (DEFAULT_ARM,)
+
+
+ARMS = _arm_names()
+ARM = ("arm", ARMS)
+
+
+def _number(value):
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+CYCLE_SECONDS = Histogram("roboarm_cycle_seconds", "Duration of the move() pick and place cycles.", CYCLE_BUCKETS)
+INITIALIZE_SECONDS = Histogram("roboarm_initialize_seconds", "Duration of initialize().", CYCLE_BUCKETS)
+PHASE_SECONDS = Histogram("roboarm_phase_seconds", "Duration of the motion primitives.", PHASE_BUCKETS,
+                          (("phase", PHASES),))
+OVERLOADS = Counter("roboarm_overloads_total", "Motor overloads detected.", (ARM, ("axis", AXES)))
+TIMEOUTS = Counter("roboarm_timeouts_total", "Motion primitives that hit WHILE_LOOP_TIMEOUT.", (ARM, ("axis", AXES)))
+MOTION_LOOPS = Counter("roboarm_motion_loop_iterations_total", "Iterations of the motion wait loops.",
+                       (ARM, ("axis", AXES)))
+MOTION_LOOP_RATE = Gauge("roboarm_motion_loop_iterations_per_second",
+                         "Wait loop iterations per second during the last motion primitive.", (ARM, ("axis", AXES)))
+WATCHDOG_SAMPLES = Counter("roboarm_watchdog_samples_total", "Motor samples taken by the stall watchdog.")
+WATCHDOG_OVERRUNS = Counter("roboarm_watchdog_overruns_total", "Watchdog samples that missed their period.")
+WATCHDOG_FAULTS = Counter("roboarm_watchdog_faults_total", "Stalls and overloads caught by the watchdog.",
+                          (ARM, ("axis", AXES)))
+WATCHDOG_REACTION = Histogram("roboarm_watchdog_reaction_seconds",
+                              "Time from the last good sample of a stalled axis until it was braked.",
+                              REACTION_BUCKETS)
+THERMAL_THROTTLE = Gauge("roboarm_thermal_throttle", "Thermal governor level, 0 full speed to 1 at the hard limit.",
+                         (ARM,))
+THERMAL_HALTED = Gauge("roboarm_thermal_halted", "1 while the arm waits to cool down under the resume limit.", (ARM,))
+THERMAL_PAUSE_SECONDS = Counter("roboarm_thermal_pause_seconds_total", "Cool-down pauses added by the thermal governor.",
+                                (ARM,))
+DRIFT = Gauge("roboarm_drift_counts", "Last encoder drift measured at the sensor landmark of the axis.",
+              (ARM, ("axis", AXES)))
+DRIFT_CORRECTIONS = Counter("roboarm_drift_corrections_total", "Drifts folded into the axis correction.",
+                            (ARM, ("axis", AXES)))
+HOMED = Gauge("roboarm_homed", "1 while the arm pose is known, homed or resumed from the state file.", (ARM,))
+REHOMES = Counter("roboarm_rehomes_total", "Partial homings of a single axis.", (ARM, ("axis", AXES)))
+LIFT_FALLBACKS = Counter("roboarm_lift_fallbacks_total",
+                         "Encoder lifts the light sensor disagreed with, followed by a sensor homing of the lift.",
+                         (ARM,))
+SENSOR_READS = Counter("roboarm_sensor_reads_total", "Sensor readings, by the sysfs attribute they were read from.",
+                       (("path", SENSOR_PATHS),))
+TEMPERATURE_TREND = Gauge("roboarm_temperature_trend_celsius_per_minute",
+                          "Temperature trend fitted by the thermal governor.", (ARM,))
+TIME_TO_LIMIT = Gauge("roboarm_temperature_time_to_limit_seconds",
+                      "Predicted time until TEMP_LIMIT at the current trend, NaN when not rising.", (ARM,))
+SUPPLY_VOLTS = Gauge("roboarm_supply_volts", "Supply voltage of the motors, smoothed.", (ARM,))
+SUPPLY_FACTOR = Gauge("roboarm_supply_compensation_factor",
+                      "Factor of the speed setpoints compensating the supply voltage, 1 at the nominal voltage.",
+                      (ARM,))
+TEMPERATURE = Gauge("roboarm_temperature_celsius", "Last temperature read from the sensor.", (ARM,))
+QUEUE_SECONDS = Histogram("roboarm_command_queue_seconds", "Time the commands waited in the scheduler queue.",
+                          REQUEST_BUCKETS, (("class", COMMAND_CLASSES),))
+PREEMPTIONS = Counter("roboarm_preemptions_total", "Commands and movements preempted, by class of the preempted one.",
+                      (("class", COMMAND_CLASSES),))
+PREEMPTION_SECONDS = Histogram("roboarm_preemption_seconds",
+                               "Time from the submit of a preempting command until the preempted code reached a "
+                               "safe point, by class of the preempting command.", REACTION_BUCKETS,
+                               (("class", COMMAND_CLASSES),))
+BUS_TRANSACTIONS = Counter("roboarm_bus_transactions_total", "Device accesses made on the bus.",
+                           (("priority", BUS_PRIORITIES),))
+BUS_SHARED_READS = Counter("roboarm_bus_shared_reads_total",
+                           "Device reads answered by an identical read of the same pass.",
+                           (("priority", BUS_PRIORITIES),))
+BUS_PASSES = Counter("roboarm_bus_passes_total", "Passes over the bus, each with the accesses batched until it started.")
+BUS_BUSY_SECONDS = Counter("roboarm_bus_busy_seconds_total",
+                           "Time the bus was held; its rate is the bus utilization.")
+BUS_QUEUE_SECONDS = Histogram("roboarm_bus_queue_seconds", "Time from a device access until its pass held the bus.",
+                              BUS_BUCKETS, (("priority", BUS_PRIORITIES),))
+IOT_SENDS = Counter("roboarm_iot_sends_total", "Temperature sends to the IoT server.",
+                    (("result", ("success", "failure")),))
+IOT_SECONDS = Histogram("roboarm_iot_send_seconds", "Latency of the temperature sends to the IoT server.",
+                        REQUEST_BUCKETS)
+REQUESTS = Counter("roboarm_http_requests_total", "HTTP requests handled.", (("handler", HANDLERS), ("code", CODES)))
+REQUEST_SECONDS = Histogram("roboarm_http_request_seconds", "HTTP request latency.", REQUEST_BUCKETS,
+                            (("handler", HANDLERS),))
+
+
+def timed(histogram, *labels):
+    # decorator: observe the duration of the function on the arm clock
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tic = clock.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(clock.time() - tic, *labels)
+        return wrapper
+    return decorator
+
+
+def phase(axis):
+    # decorator of the motion primitives (methods of an arm with an arm_label):
+    # duration, timeouts (the primitive returns False) and wait loop rate of the axis
+
+    def decorator(function):
+        name = function.__name__
+        if (name,) not in PHASE_SECONDS.slots:
+            raise ValueError("unknown motion phase " + name)
+
+        @functools.wraps(function)
+        def wrapper(arm, *args, **kwargs):
+            tic = clock.time()
+            loops = MOTION_LOOPS.local(arm.arm_label, axis)
+            try:
+                result = function(arm, *args, **kwargs)
+            finally:
+                elapsed = clock.time() - tic
+                PHASE_SECONDS.observe(elapsed, name)
+                loops = MOTION_LOOPS.local(arm.arm_label, axis) - loops
+                if loops and elapsed > 0:
+                    MOTION_LOOP_RATE.set(loops / elapsed, arm.arm_label, axis)
+            if result is False:
+                TIMEOUTS.inc(arm.arm_label, axis)
+            for observer in phase_observers:
+                observer(name, elapsed, result is False)
+            return result
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def iot_send():
+    tic = time.time()
+    try:
+        yield
+    except Exception:
+        IOT_SENDS.inc("failure")
+        raise
+    else:
+        IOT_SENDS.inc("success")
+    finally:
+        IOT_SECONDS.observe(time.time() - tic)
+
+
+def observe_request(handler, status, seconds):
+    if (handler,) in REQUEST_SECONDS.slots:
+        REQUESTS.inc(handler, str(status // 100) + "xx")
+        REQUEST_SECONDS.observe(seconds, handler)
+
+
+def process_lines(processes):
+    # CPU time and resident memory of the controller processes, from /proc
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    page = os.sysconf("SC_PAGE_SIZE")
+    cpu = ["# HELP roboarm_process_cpu_seconds_total User and system CPU time of the process.",
+           "# TYPE roboarm_process_cpu_seconds_total counter"]
+    rss = ["# HELP roboarm_process_resident_memory_bytes Resident memory of the process.",
+           "# TYPE roboarm_process_resident_memory_bytes gauge"]
+    for name in sorted(processes):
+        try:
+            with open("/proc/" + str(processes[name]) + "/stat") as stat:
+                # fields after the command name, which may contain spaces
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        cpu.append('roboarm_process_cpu_seconds_total{process="%s"} %s'
+                   % (name, _number((int(fields[11]) + int(fields[12])) / ticks)))
+        rss.append('roboarm_process_resident_memory_bytes{process="%s"} %d' % (name, int(fields[21]) * page))
+    return cpu + rss
+
+
+def exposition(processes=None):
+    # the sums of the segments; a histogram may be one observation ahead in
+    # its count or its sum, as a scrape does not wait for the updates
+    snapshot = _values[:]
+    values = [sum(snapshot[slot::SLOTS]) for slot in range(_used)]
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render(values))
+    if processes:
+        lines.extend(process_lines(processes))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Adaptive polling of the lift light sensor.
+#
+# The lift wait loops watch the reflected light for the LIFT_ARM_LIMIT
+# crossing, which happens at an encoder position known from the lift landmark
+# (roboarmdrift). A Poller plans the sensor reads of one loop from where the
+# lift starts, where the crossing is expected and the speed of the motor: one
+# read every MAX_STEP counts of lift travel while the lift is far from the
+# crossing, and a read on every iteration of the loop, as without a poller,
+# while it may be within WINDOW counts of it:
+#
+# - approaching: from the time the lift would reach the window at the speed
+#   given (a slower lift gets there later, so it is polled at the full rate
+#   earlier, never later), until the end of the loop
+# - moving away: until the lift has left the window, if it moved at least at
+#   SLOWEST times the speed given
+#
+# WINDOW is larger than roboarmdrift.DRIFT_LIMIT, so a crossing where the
+# landmark allows it is seen as fast as before. A crossing outside the window
+# (a lost axis) is seen at most MAX_STEP counts late, which keeps the lift
+# under the LIFT_ARM_LIMIT + 7 guard of lift_move_pos(). Without an expected
+# crossing (before the first one after homing) every iteration reads.
+#
+# The times are on the clock given, the time of the hardware backend.
+#
+
+WINDOW = 45                 # tacho counts around the expected crossing polled at the full rate
+MAX_STEP = 3                # tacho counts the lift moves between two sensor reads far from the crossing
+SLOWEST = 0.5               # fraction of the given speed the lift moves at least at
+
+
+class Poller:
+
+    def __init__(self, clock, position, expected, speed, approaching=True):
+        # position: encoder position now; expected: encoder position of the
+        # crossing (same polarity) or None; speed: tacho counts per second
+        self.clock = clock
+        now = clock.time()
+        self.next_read = now
+        # the full rate time span, None: to the end of the loop
+        self.near_from = now
+        self.near_until = None
+        self.step = 0.0
+        if expected is not None and speed:
+            self.step = MAX_STEP / float(abs(speed))
+            distance = abs(expected - position)
+            if approaching:
+                self.near_from = now + max(0.0, distance - WINDOW) / abs(speed)
+            else:
+                self.near_until = now + max(0.0, WINDOW - distance) / (abs(speed) * SLOWEST)
+
+    def interval(self, now):
+        # seconds from now until the read after the one made now
+        if now >= self.near_from and (self.near_until is None or now < self.near_until):
+            return 0.0
+        if now < self.near_from:
+            return min(self.step, self.near_from - now)
+        return self.step
+
+    def due(self):
+        # True when the sensor has to be read now, for the loops that do not
+        # wait (and plans the next read)
+        now = self.clock.time()
+        if now < self.next_read:
+            return False
+        self.next_read = now + self.interval(now)
+        return True
+
+    def wait(self, sleep):
+        # sleep(seconds) until the sensor has to be read (and plans the next read)
+        pause = self.next_read - self.clock.time()
+        if pause > 0:
+            sleep(pause)
+        now = self.clock.time()
+        self.next_read = now + self.interval(now)
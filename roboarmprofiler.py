@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+#
+# Low overhead sampling CPU profiler for the running Robot Arm controller.
+#
+# A background thread samples the stacks of every thread (sys._current_frames)
+# at a fixed rate. The movement and IoT child processes call listen() when they
+# start; the web process then toggles sampling in them with SIGUSR2 and merges
+# their samples, so one profile covers the web server, the motion loops and
+# the IoT sender.
+#
+# Results are a flamegraph collapsed-stack text (flamegraph.pl, speedscope) or
+# a pstats file built from the samples (python3 -m pstats, snakeviz).
+#
+# The /debug/profile/ endpoint is only enabled when ROBOARM_DEBUG_TOKEN is set
+# and the request carries the same token.
+#
+
+import collections
+import hmac
+import json
+import logging
+import marshal
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.01      # seconds between samples (100 Hz)
+MAX_SECONDS = 60            # longest profile allowed through the endpoint
+MAX_DEPTH = 64              # frames kept per stack
+CHILD_TIMEOUT = 2.0         # seconds to wait for the children samples
+# the child processes hand their samples over in files of this directory: the
+# working directory (where roboarm.log is) unless ROBOARM_PROFILE_DIR names another
+PROFILE_DIR = os.environ.get("ROBOARM_PROFILE_DIR") or os.getcwd()
+
+FORMATS = ("collapsed", "pstats")
+
+_busy = threading.Lock()
+
+
+def authorized(token):
+    expected = os.environ.get("ROBOARM_DEBUG_TOKEN")
+    if not expected or token is None:
+        return False
+    return hmac.compare_digest(str(token), expected)
+
+
+class StackSampler:
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = None
+        self.elapsed = 0.0
+
+    def start(self):
+        self.stopped.clear()
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run, name="roboarm-profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.elapsed = time.time() - self.started
+
+    def _run(self):
+        own = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            self.sample(own)
+
+    def sample(self, own=None):
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            self.counts[(names.get(ident, "thread-" + str(ident)), tuple(stack))] += 1
+        self.samples += 1
+
+    def dump(self, path):
+        # raw samples of a child process, written atomically for the parent
+        data = [[thread, [list(frame) for frame in stack], count]
+                for (thread, stack), count in self.counts.items()]
+        tmp = path + ".tmp"
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        # a new file of this user only, never through a link left at that path
+        descriptor = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        with os.fdopen(descriptor, "w") as output:
+            json.dump({"pid": os.getpid(), "interval": self.interval, "samples": data}, output)
+        os.rename(tmp, path)
+
+
+def child_profile_path(pid):
+    return os.path.join(PROFILE_DIR, "roboarm-profile-" + str(pid) + ".json")
+
+
+_child_sampler = None
+
+
+def _toggle(signum, frame):
+    global _child_sampler
+    if _child_sampler is None:
+        _child_sampler = StackSampler()
+        _child_sampler.start()
+    else:
+        sampler = _child_sampler
+        _child_sampler = None
+        sampler.stop()
+        sampler.dump(child_profile_path(os.getpid()))
+
+
+def listen():
+    # called at the start of a child process so the web process can profile it
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, _toggle)
+
+
+class Profile:
+    # one profiling session of this process and the given child processes
+
+    def __init__(self, children=None, interval=SAMPLE_INTERVAL):
+        self.children = dict((name, pid) for name, pid in (children or {}).items() if pid)
+        self.sampler = StackSampler(interval)
+
+    def start(self):
+        if not _busy.acquire(False):
+            raise RuntimeError("a profile is already running")
+        for pid in self.children.values():
+            self._signal(pid)
+        self.sampler.start()
+
+    def stop(self):
+        try:
+            self.sampler.stop()
+            counts = collections.Counter()
+            for (thread, stack), count in self.sampler.counts.items():
+                counts[("web", thread, stack)] += count
+            for name, pid in self.children.items():
+                path = child_profile_path(pid)
+                if os.path.exists(path):
+                    os.remove(path)
+                if not self._signal(pid):
+                    continue
+                deadline = time.time() + CHILD_TIMEOUT
+                while not os.path.exists(path) and time.time() < deadline:
+                    time.sleep(0.01)
+                if not os.path.exists(path):
+                    logger.warning("[PROFILER] no samples from " + name + " (" + str(pid) + ")")
+                    continue
+                with os.fdopen(os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))) as child_file:
+                    child = json.load(child_file)
+                os.remove(path)
+                for thread, stack, count in child["samples"]:
+                    counts[(name, thread, tuple(tuple(frame) for frame in stack))] += count
+            return counts
+        finally:
+            _busy.release()
+
+    def _signal(self, pid):
+        try:
+            os.kill(pid, signal.SIGUSR2)
+            return True
+        except (OSError, AttributeError):
+            return False
+
+
+def frame_label(frame):
+    filename, line, name = frame
+    return name + " (" + os.path.basename(filename) + ":" + str(line) + ")"
+
+
+def collapsed(counts):
+    lines = []
+    for (process, thread, stack), count in counts.items():
+        frames = [process, thread] + [frame_label(frame).replace(";", ":") for frame in stack]
+        lines.append(";".join(frames) + " " + str(count))
+    lines.sort()
+    return "\n".join(lines) + "\n"
+
+
+def pstats_data(counts, interval=SAMPLE_INTERVAL):
+    # pstats marshal format built from the samples: tt is self time, ct is
+    # the time the function was on the stack, nc the samples it was seen in
+    stats = {}
+    for (process, thread, stack), count in counts.items():
+        seen = set()
+        for depth, frame in enumerate(stack):
+            cc, nc, tt, ct, callers = stats.get(frame, (0, 0, 0.0, 0.0, {}))
+            if depth == len(stack) - 1:
+                tt += count * interval
+            if frame not in seen:
+                nc += count
+                cc += count
+                ct += count * interval
+                seen.add(frame)
+            if depth > 0:
+                caller = stack[depth - 1]
+                c_cc, c_nc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (c_cc + count, c_nc + count,
+                                   c_tt + (count * interval if depth == len(stack) - 1 else 0.0),
+                                   c_ct + count * interval)
+            stats[frame] = (cc, nc, tt, ct, callers)
+    return marshal.dumps(stats)
+
+
+def render(counts, output_format, interval=SAMPLE_INTERVAL):
+    if output_format == "pstats":
+        return pstats_data(counts, interval)
+    return collapsed(counts).encode("utf-8")
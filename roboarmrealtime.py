@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# Real-time deployment mode of the Robot Arm controller (ROBOARM_REALTIME=1).
+#
+# On the 4 core Raspberry Pi 3B the movement process, the Tornado web process,
+# the IoT process and the logging share the cores under the default scheduler,
+# and the lift wait loops see the light sensor cross LIFT_ARM_LIMIT late
+# whenever the web server is busy. In the real-time mode:
+#
+# - control(): the movement process runs on a core of its own (CONTROL_CPU,
+#   ROBOARM_CONTROL_CPU, default the last one), and with
+#   ROBOARM_FIFO_PRIORITY=<n> under SCHED_FIFO at priority n, at most
+#   MAX_PRIORITY: under the threaded interrupt handlers of the kernel (50), so
+#   the device I/O the loops wait on still goes first
+# - serve(): the web process runs on the other cores, and so do the IoT process
+#   and the threads it starts afterwards
+#
+# The cores are the ones the program was started with (taskset). A process and
+# a thread start with the affinity of the thread that starts them, so serve()
+# is called before the arms are created and control() first thing in the
+# movement process. SCHED_FIFO is set with SCHED_RESET_ON_FORK: whatever the
+# movement process forks runs under the default scheduler. The policy change
+# needs CAP_SYS_NICE (root, or an rtprio limit in /etc/security/limits.conf);
+# without it the movement process keeps the default scheduler, with a warning.
+# So does a movement process without a core of its own: on a single core its
+# wait loops would leave the web process (and /emergency_stop/) only the
+# throttling share below.
+# The kernel leaves the other tasks of the core 5% of every second
+# (kernel.sched_rt_runtime_us), which the wait loops that do not sleep would
+# otherwise starve. isolcpus=<core> on the kernel command line keeps the rest
+# of the system off the control core too. The arms of a fleet share the core.
+#
+# roboarmbench.py --scenarios jitter compares the periods of a control loop
+# with and without the mode.
+#
+
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("ROBOARM_REALTIME", "0") != "0"
+MAX_PRIORITY = 49           # SCHED_FIFO priority at most
+CONTROL_CPU = int(os.environ.get("ROBOARM_CONTROL_CPU", -1))  # core of the movement process, < 0: from the last one
+FIFO_PRIORITY = min(int(os.environ.get("ROBOARM_FIFO_PRIORITY", 0)), MAX_PRIORITY)  # 0: the default scheduler
+
+try:
+    CPUS = sorted(os.sched_getaffinity(0))
+except AttributeError:
+    # no affinity control on this platform
+    CPUS = []
+
+
+def cpus():
+    # (control core, [other cores]), the control core None when there is no other one
+    if len(CPUS) < 2:
+        return None, CPUS
+    control = CPUS[CONTROL_CPU] if CONTROL_CPU < 0 else CONTROL_CPU
+    return control, [cpu for cpu in CPUS if cpu != control]
+
+
+def _threads():
+    # ids of the threads of this process (the affinity is the one of a thread)
+    try:
+        return [int(tid) for tid in os.listdir("/proc/self/task")]
+    except OSError:
+        return [0]
+
+
+def _set_affinity(cores):
+    try:
+        for tid in _threads():
+            os.sched_setaffinity(tid, cores)
+    except (AttributeError, OSError, ValueError):
+        logger.warning("[REALTIME] affinity " + str(cores) + " not set - " + str(sys.exc_info()[1]))
+        return False
+    logger.info("[REALTIME] process " + str(os.getpid()) + " on cores " + str(cores))
+    return True
+
+
+def serve():
+    # the web process: off the control core. True when it was moved
+    if not ENABLED:
+        return False
+    control, others = cpus()
+    if control is None:
+        logger.warning("[REALTIME] a single core, no core for the movement process alone")
+        return False
+    return _set_affinity(others)
+
+
+def control(priority=None):
+    # the movement process: on the control core, under SCHED_FIFO with a
+    # priority. True when it runs under SCHED_FIFO
+    if not ENABLED:
+        return False
+    core, _ = cpus()
+    priority = FIFO_PRIORITY if priority is None else min(priority, MAX_PRIORITY)
+    if core is None:
+        logger.warning("[REALTIME] a single core, the movement process keeps the default scheduler")
+        return False
+    if not _set_affinity([core]):
+        logger.warning("[REALTIME] not on the control core, the movement process keeps the default scheduler")
+        return False
+    if priority <= 0:
+        return False
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO | os.SCHED_RESET_ON_FORK, os.sched_param(priority))
+    except (AttributeError, OSError):
+        logger.warning("[REALTIME] SCHED_FIFO " + str(priority) + " not set - " + str(sys.exc_info()[1]))
+        return False
+    logger.info("[REALTIME] process " + str(os.getpid()) + " under SCHED_FIFO " + str(priority))
+    return True
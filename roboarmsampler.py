@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Shared memory sampler of the temperature sensor.
+#
+# The I2C NXT temperature sensor is slow, and the movement process (thermal
+# governor, cycle records), the IoT process and the GetTemperature handler
+# all want its value. One Sampler thread of the web process reads the sensor
+# every PERIOD and publishes the reading in a multiprocessing.shared_memory
+# block, which the processes forked after it is created map as well:
+#
+#    sequence (uint64) | value (double) | timestamp (double) | crc32 (uint32)
+#
+# The writer packs the whole record at once, the CRC-32 of the other fields
+# last; a reader retries while the CRC does not match what it read. Python
+# gives no memory barrier, and on the ARM cores of the Pi another process may
+# see the stores of a record in any order, so a sequence number alone (a
+# seqlock) would not tell a half written record: the CRC does, whatever the
+# order. Readers take no lock and make no I2C transaction. The sequence is the
+# number of readings published.
+#
+# Sampling is paced on the wall clock; the timestamps are the ones of the
+# SensorReader (the time of the hardware backend). latest() is None before the
+# first reading and when the last one is older than STALE_PERIODS periods (the
+# sampler is not running or the sensor fails): the callers read the sensor
+# themselves then.
+#
+
+import atexit
+import logging
+import os
+import struct
+import sys
+import threading
+import zlib
+import time as walltime
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+PERIOD = 0.5                # seconds between two readings of the sensor
+STALE_PERIODS = 4           # periods after which the last reading is not used
+MAX_RETRIES = 100           # reads of a block the writer keeps changing before giving up
+
+RECORD = struct.Struct("<QddI")
+FIELDS = struct.Struct("<Qdd")
+SIZE = RECORD.size
+
+
+class Sampler:
+
+    def __init__(self, reader, period=PERIOD):
+        # reader: the roboarmsensors.SensorReader of the sensor
+        self.reader = reader
+        self.period = period
+        self.memory = shared_memory.SharedMemory(create=True, size=SIZE)
+        self.sequence = 0
+        self.publish(0.0, 0.0)
+        self.owner = os.getpid()
+        self.stopped = threading.Event()
+        self.thread = None
+        atexit.register(self.close)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, name="roboarm-sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        # the process that created the block removes it
+        self.stopped.set()
+        if os.getpid() != self.owner or self.memory is None:
+            return
+        if self.thread is not None:
+            self.thread.join(self.period)
+        memory = self.memory
+        self.memory = None
+        memory.close()
+        memory.unlink()
+
+    def publish(self, value, timestamp):
+        # only the sampler thread writes (and __init__, the empty record 0)
+        fields = FIELDS.pack(self.sequence, value, timestamp)
+        RECORD.pack_into(self.memory.buf, 0, self.sequence, value, timestamp, zlib.crc32(fields))
+        self.sequence += 1
+
+    def read(self):
+        # (value, timestamp, sequence) of the last reading published, None before the first one
+        buffer = self.memory.buf
+        for _ in range(MAX_RETRIES):
+            sequence, value, timestamp, crc = RECORD.unpack_from(buffer, 0)
+            if zlib.crc32(FIELDS.pack(sequence, value, timestamp)) != crc:
+                continue
+            if not sequence:
+                return None
+            return value, timestamp, sequence
+        return None
+
+    def latest(self):
+        # read() when the reading is fresh, None otherwise
+        reading = self.read()
+        if reading is None or self.reader.clock.time() - reading[1] > STALE_PERIODS * self.period:
+            return None
+        return reading
+
+    def _run(self):
+        next_reading = walltime.monotonic()
+        while not self.stopped.is_set():
+            try:
+                values, timestamp = self.reader.read()
+                self.publish(values[0], timestamp)
+            except Exception:
+                logger.warning("[SAMPLER] temperature sensor read failed - " + str(sys.exc_info()[1]))
+            next_reading += self.period
+            pause = next_reading - walltime.monotonic()
+            if pause <= 0:
+                # an overrun: read again now, then every period from now on
+                next_reading = walltime.monotonic()
+                pause = 0
+            self.stopped.wait(pause)
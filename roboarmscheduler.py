@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Priority command scheduler of the Robot Arm controller.
+#
+# The web handlers do not call LegoRoboArm themselves: they submit a command
+# with its priority class and one worker thread runs the commands one at a
+# time, the most urgent class first (then in order of arrival):
+#
+#    emergency stop > stop > configuration > motion > telemetry
+#
+# The worker starts with the first command, which continues the trace
+# (roboarmtracing) of the thread that submitted it.
+#
+# A command that is more urgent than the one running (or than the movement
+# process, which runs as a motion class activity) preempts it: check() raises
+# Preempted at the next safe point of the running code, the wait loops of the
+# motion primitives and the pauses between them (sleep()). The preemption
+# request lives in shared memory, so the movement process sees it as well.
+#
+# The time every command waits in the queue and the time from a preempting
+# submit until the preempted code reached a safe point are measured per class
+# (wall clock) in roboarmmetrics.
+#
+
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import multiprocessing
+import sys
+import threading
+import time as walltime
+
+import roboarmmetrics
+import roboarmtracing
+
+logger = logging.getLogger(__name__)
+
+EMERGENCY_STOP, STOP, CONFIGURATION, MOTION, TELEMETRY = range(5)
+CLASSES = roboarmmetrics.COMMAND_CLASSES
+IDLE = len(CLASSES)         # no preemption requested
+SLICE = 0.05                # seconds between the safe points of sleep()
+
+
+class Preempted(Exception):
+
+    def __init__(self, priority):
+        Exception.__init__(self, "preempted by a " + CLASSES[priority] + " command")
+        self.priority = priority
+
+
+class Scheduler:
+
+    def __init__(self, clock=walltime):
+        # clock: time of the hardware backend, for sleep()
+        self.clock = clock
+        self.queue = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        # class of the code running in this process, None outside of commands
+        self.running = None
+        # most urgent class queued or running, and when it was submitted; shared
+        # with the movement process forked after the scheduler is created
+        self._preempt = multiprocessing.RawValue("i", IDLE)
+        self._requested = multiprocessing.RawValue("d", 0.0)
+        self.thread = None
+
+    def start(self):
+        # the worker thread, also started by the first submit()
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name="roboarm-scheduler")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def submit(self, priority, function, *args):
+        # returns a concurrent.futures.Future of the result of function(*args)
+        # the command continues the trace of the caller
+        future = concurrent.futures.Future()
+        context = roboarmtracing.current()
+        with self.condition:
+            self.start()
+            heapq.heappush(self.queue, (priority, next(self.order), walltime.time(), context, future, function, args))
+            if priority < self._preempt.value:
+                self._requested.value = walltime.time()
+                self._preempt.value = priority
+            self.condition.notify()
+        return future
+
+    def run(self, priority, function, *args):
+        # submit() awaitable from the tornado handlers
+        return asyncio.wrap_future(self.submit(priority, function, *args))
+
+    def preempting(self):
+        return self.running is not None and self._preempt.value < self.running
+
+    def check(self):
+        # a safe point of the running code
+        if self.preempting():
+            priority = self._preempt.value
+            roboarmmetrics.PREEMPTIONS.inc(CLASSES[self.running])
+            roboarmmetrics.PREEMPTION_SECONDS.observe(walltime.time() - self._requested.value, CLASSES[priority])
+            logger.info("[SCHEDULER] " + CLASSES[self.running] + " preempted by " + CLASSES[priority])
+            raise Preempted(priority)
+
+    def sleep(self, seconds):
+        # clock.sleep() with a safe point every SLICE
+        deadline = self.clock.time() + seconds
+        self.check()
+        while True:
+            left = deadline - self.clock.time()
+            if left <= 0:
+                return
+            self.clock.sleep(min(SLICE, left))
+            self.check()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                priority, order, submitted, context, future, function, args = heapq.heappop(self.queue)
+            if not future.set_running_or_notify_cancel():
+                continue
+            roboarmmetrics.QUEUE_SECONDS.observe(walltime.time() - submitted, CLASSES[priority])
+            self.running = priority
+            roboarmtracing.attach(context)
+            try:
+                future.set_result(function(*args))
+            except BaseException:
+                future.set_exception(sys.exc_info()[1])
+            finally:
+                roboarmtracing.attach(None)
+                self.running = None
+                with self.condition:
+                    # the preemption (if any) was served
+                    self._preempt.value = min([queued[0] for queued in self.queue] or [IDLE])
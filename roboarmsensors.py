@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Binary readings of the ev3dev sensors.
+#
+# Sensor.value(n) reads one decimal value per call: a sysfs attribute read and
+# a text parse for every value of the mode. Sensor.bin_data() reads all the
+# values of the mode at once, in the binary layout given by bin_data_format
+# and num_values (learned at the first reading, and again after reset(), which
+# a mode change needs).
+#
+# A SensorReader copies the bin_data bytes into a buffer allocated once, and
+# the values are read through a memoryview of the buffer cast to the value
+# type (struct decodes the layouts memoryview cannot: big endian values, or a
+# big endian machine). Every reading keeps the time it was taken, on the clock
+# given (the time of the hardware backend).
+#
+# When bin_data cannot be read or decoded the reader falls back to the text
+# path of value(n), for good; ROBOARM_SENSOR_READ=text uses it from the start.
+#
+
+import logging
+import os
+import struct
+import sys
+import threading
+
+import roboarmmetrics
+
+logger = logging.getLogger(__name__)
+
+BIN_DATA, TEXT = roboarmmetrics.SENSOR_PATHS
+PATH = os.environ.get("ROBOARM_SENSOR_READ", BIN_DATA)
+
+# bin_data_format -> struct format of one value
+FORMATS = {"u8": "<B", "s8": "<b", "u16": "<H", "s16": "<h", "s16_be": ">h",
+           "s32": "<i", "s32_be": ">i", "float": "<f"}
+MAX_VALUES = 8              # values of a sensor mode at most (value0..value7)
+BUFFER_SIZE = 32            # bytes of the bin_data attribute at most
+
+
+class SensorReader:
+
+    def __init__(self, sensor, clock, path=PATH):
+        self.sensor = sensor
+        self.clock = clock
+        self.path = path
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        # values of the last reading: a memoryview of the buffer, or the list
+        # struct decodes into
+        self.values = [0] * MAX_VALUES
+        self.decode = None
+        self.count = None
+        self.size = 0
+        # clock time of the last reading, None before the first one
+        self.timestamp = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # a forked process reads with a lock of its own
+        self.lock = threading.Lock()
+
+    def reset(self):
+        # the layout of the values changes with the mode of the sensor
+        with self.lock:
+            self.count = None
+
+    def _layout(self):
+        value_format = FORMATS[self.sensor.bin_data_format]
+        self.count = min(self.sensor.num_values, MAX_VALUES)
+        self.size = struct.calcsize(value_format) * self.count
+        if self.size > BUFFER_SIZE:
+            raise ValueError(str(self.count) + " values of " + value_format + " do not fit the buffer")
+        if value_format[0] == "<" and sys.byteorder == "little":
+            self.decode = None
+            self.values = self.view[:self.size].cast(value_format[1])
+        else:
+            self.decode = struct.Struct(value_format[0] + str(self.count) + value_format[1])
+            self.values = [0] * MAX_VALUES
+
+    def _read_bin_data(self):
+        if self.count is None:
+            self._layout()
+        data = self.sensor.bin_data()
+        if len(data) < self.size:
+            raise ValueError("bin_data has " + str(len(data)) + " bytes, " + str(self.size) + " expected")
+        self.view[:self.size] = memoryview(data)[:self.size]
+        if self.decode is not None:
+            self.values[:self.count] = self.decode.unpack_from(self.buffer)
+
+    def _read_text(self):
+        if self.count is None:
+            self.count = min(self.sensor.num_values, MAX_VALUES)
+            self.values = [0] * MAX_VALUES
+        for n in range(self.count):
+            self.values[n] = self.sensor.value(n)
+
+    def _read(self):
+        if self.path == BIN_DATA:
+            try:
+                self._read_bin_data()
+            except (AttributeError, KeyError, IOError, OSError, ValueError, TypeError, struct.error):
+                logger.warning("[SENSOR] bin_data not usable, reading the text values - " + str(sys.exc_info()[1]))
+                self.path = TEXT
+                self.count = None
+        if self.path == TEXT:
+            self._read_text()
+        self.timestamp = self.clock.time()
+        roboarmmetrics.SENSOR_READS.inc(self.path)
+
+    def read(self):
+        # a new reading of all the values: [value0, value1...] and its timestamp
+        with self.lock:
+            self._read()
+            return list(self.values[:self.count]), self.timestamp
+
+    def value(self, n=0):
+        # value n of a new reading, like Sensor.value(n)
+        with self.lock:
+            self._read()
+            return self.values[n]
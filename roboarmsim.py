@@ -0,0 +1,869 @@
+#!/usr/bin/env python
+#
+# Simulated ev3dev / BrickPi3 hardware backend for the Robot Arm H25 model.
+#
+# It provides the subset of ev3dev-lang-python used by the legoroboarm*.py
+# scripts (motors, sensors, ports, sound, leds and buttons) on top of a small
+# physics model of the arm, driven by a virtual clock so homing and thousands
+# of move cycles run in seconds without an EV3 or a BrickPi3.
+#
+# Select it with the ROBOARM_BACKEND environment variable:
+#
+#    ROBOARM_BACKEND=sim python3 legoroboarmtornadoBPv5.py
+#
+# The EV3 scripts switch the simulated port wiring to their own layout.
+# ROBOARM_SIM_SPEEDUP=1 makes the clock follow the wall clock (scaled by the
+# factor), for code that paces itself on real time like the watchdog.
+#
+# ROBOARM_SIM_VOLTS=<volts> is the voltage of the simulated supply (default
+# NOMINAL_VOLTS); the motors turn slower or faster than their speed_sp in
+# proportion, like an unregulated motor on a sagging battery.
+#
+# ROBOARM_SIM_SPI=<seconds> makes every device access hold the simulated SPI
+# bus for that long (wall clock); accesses of two threads that overlap on the
+# bus are counted in world.bus.collisions.
+#
+# More arms (a fleet) are addressed with "<arm>." before the port name, e.g.
+# "arm2.outA": every arm gets its own joints, wired like the default one.
+#
+# The scripts do "from ev3dev.xxx import *", so this module also exports the
+# names they take from there (time, sys, log...). Its "time" is the virtual
+# clock, so every time.sleep()/time.time() in the scripts runs on sim time.
+#
+
+import logging
+import os
+import random
+import struct
+import sys
+import threading
+import time as _walltime
+
+log = logging.getLogger(__name__)
+
+OUTPUT_A = 'outA'
+OUTPUT_B = 'outB'
+OUTPUT_C = 'outC'
+OUTPUT_D = 'outD'
+
+INPUT_1 = 'in1'
+INPUT_2 = 'in2'
+INPUT_3 = 'in3'
+INPUT_4 = 'in4'
+
+# cost of one sysfs attribute access (units: seconds), charged to the virtual clock
+IO_LATENCY = 0.002
+# max integration step of the motor physics (units: seconds)
+PHYSICS_STEP = 0.005
+# supply voltage at which the motors turn at their speed_sp (units: V)
+NOMINAL_VOLTS = 9.0
+
+
+class DeviceNotFound(Exception):
+    pass
+
+
+class SimClock:
+    # Virtual clock. In "virtual" mode time only moves when somebody sleeps or
+    # touches a device, so spin loops and sleeps cost no wall time and runs are
+    # deterministic. With speedup set it follows the wall clock scaled by that
+    # factor, which keeps several threads (web server + motion) consistent.
+
+    def __init__(self, io_latency=IO_LATENCY, speedup=None):
+        self.lock = threading.RLock()
+        self.io_latency = io_latency
+        self.speedup = speedup
+        self.reset()
+
+    def reset(self, start=1000.0):
+        with self.lock:
+            self.now = start
+            self.wall_origin = _walltime.monotonic()
+
+    def set_speedup(self, speedup):
+        # switch between virtual (None) and wall-clock driven time without a jump
+        with self.lock:
+            self.now = self.time()
+            self.wall_origin = _walltime.monotonic()
+            self.speedup = speedup
+
+    def time(self):
+        if self.speedup:
+            return self.now + (_walltime.monotonic() - self.wall_origin) * self.speedup
+        return self.now
+
+    def advance(self, seconds):
+        if seconds > 0 and not self.speedup:
+            with self.lock:
+                self.now += seconds
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        if self.speedup:
+            _walltime.sleep(seconds / self.speedup)
+        else:
+            self.advance(seconds)
+            # let other threads run, as a real sleep would
+            _walltime.sleep(0)
+
+    def io(self):
+        self.advance(self.io_latency)
+
+
+class SimBus:
+    # SPI bus of the BrickPi3 seen from the devices: every access is one
+    # transaction, which holds the bus for hold wall clock seconds
+
+    def __init__(self, hold=0.0):
+        self.hold = hold
+        self.lock = threading.Lock()
+        self.active = 0
+        self.transactions = 0
+        self.collisions = 0
+        self.busy = 0.0
+
+    def transaction(self):
+        with self.lock:
+            self.active += 1
+            self.transactions += 1
+            if self.active > 1:
+                self.collisions += 1
+        tic = _walltime.monotonic()
+        if self.hold:
+            _walltime.sleep(self.hold)
+        with self.lock:
+            self.active -= 1
+            self.busy += _walltime.monotonic() - tic
+
+
+class SimTime:
+    # drop-in for the "time" module seen by the scripts
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def time(self):
+        return self.clock.time()
+
+    def monotonic(self):
+        return self.clock.time()
+
+    def perf_counter(self):
+        return self.clock.time()
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    def __getattr__(self, name):
+        return getattr(_walltime, name)
+
+
+class SimAxis:
+    # Physical joint driven by one motor. angle is the motor shaft angle in
+    # degrees with normal polarity; it is independent of the encoder zero.
+
+    def __init__(self, name, angle, min_stop, max_stop, max_speed):
+        self.name = name
+        self.angle = float(angle)
+        self.min_stop = min_stop
+        self.max_stop = max_stop
+        self.max_speed = max_speed
+        # external load as a fraction of the stall torque (1.0 = jammed)
+        self.load = 0.0
+        self.duty_cycle = 0
+
+
+class SimWorld:
+    # Arm geometry, sensors and environment shared by all simulated devices.
+    #
+    # lift: angle 0 is where the reflected light crosses LIFT_ARM_LIMIT,
+    #       positive angles lower the arm.
+    # base: angle 0 is the middle of the touch sensor cam.
+    # grab: angle 0 is the fully closed end stop.
+
+    TOUCH_WIDTH = 10          # half width of the base touch cam (units: degrees)
+    AMBIENT_TEMP = 22.0       # units: C
+    HEAT_GAIN = 0.0004        # C per second per (duty cycle / 100) ^ 2
+    COOL_TAU = 900.0          # thermal time constant (units: seconds)
+
+    def __init__(self):
+        self.clock = SimClock()
+        self.lock = threading.RLock()
+        self.platform = os.environ.get("ROBOARM_SIM_PLATFORM", "brickpi3")
+        self.speedup = float(os.environ.get("ROBOARM_SIM_SPEEDUP", 0)) or None
+        self.reset()
+
+    def reset(self, seed=0, io_latency=IO_LATENCY, speedup=None):
+        with self.lock:
+            self.clock.io_latency = io_latency
+            self.clock.speedup = speedup or self.speedup
+            self.clock.reset()
+            self.random = random.Random(seed)
+            self.axes = {
+                'lift': SimAxis('lift', 120, -25, 300, 1050),
+                'base': SimAxis('base', -150, -900, 900, 1050),
+                'grab': SimAxis('grab', -90, -200, 0, 1560),
+            }
+            self.temperature = self.AMBIENT_TEMP
+            self.temperature_override = None
+            self.reflect_noise = 1.0
+            self.buttons = set()
+            self.leds = {}
+            self.spoken = []
+            self.io_count = 0
+            self.bus = SimBus(float(os.environ.get("ROBOARM_SIM_SPI", 0)))
+            self.supply_volts = float(os.environ.get("ROBOARM_SIM_VOLTS", NOMINAL_VOLTS))
+            self.last_update = self.clock.time()
+            self.motors = []
+            # port -> device driver name; a port missing here has nothing attached
+            self.devices = {
+                OUTPUT_A: 'lego-ev3-l-motor',
+                OUTPUT_B: 'lego-ev3-l-motor',
+                OUTPUT_C: 'lego-ev3-l-motor',
+                OUTPUT_D: 'lego-ev3-l-motor',
+                INPUT_1: 'lego-ev3-touch',
+                INPUT_2: 'lego-ev3-color',
+                INPUT_3: 'lego-nxt-temp',
+                INPUT_4: 'lego-ev3-touch',
+            }
+            # port -> axis or sensor role, default wiring of legoroboarmtornadoBPv5.py
+            self.wiring = {
+                OUTPUT_A: 'grab',
+                OUTPUT_B: 'lift',
+                OUTPUT_D: 'base',
+                INPUT_1: 'reflect',
+                INPUT_3: 'temperature',
+                INPUT_4: 'touch',
+            }
+            if self.platform == "ev3":
+                self.use_ev3_wiring()
+
+    def set_platform(self, platform):
+        # "ev3" or "brickpi3"; kept across reset()
+        self.platform = platform
+        self.reset()
+
+    def use_ev3_wiring(self):
+        # port layout of legoroboarmtornado.py and legoroboarmweb.py
+        self.wiring = {
+            OUTPUT_D: 'grab',
+            OUTPUT_B: 'lift',
+            OUTPUT_C: 'base',
+            INPUT_1: 'touch',
+            INPUT_3: 'reflect',
+            INPUT_4: 'temperature',
+        }
+        self.devices[INPUT_1] = 'lego-ev3-touch'
+        self.devices[INPUT_3] = 'lego-ev3-color'
+        self.devices[INPUT_4] = 'lego-nxt-temp'
+
+    def add_arm(self, arm):
+        # joints of another arm, addressed with "<arm>." ports
+        with self.lock:
+            if arm + '.lift' not in self.axes:
+                self.axes[arm + '.lift'] = SimAxis(arm + '.lift', 120, -25, 300, 1050)
+                self.axes[arm + '.base'] = SimAxis(arm + '.base', -150, -900, 900, 1050)
+                self.axes[arm + '.grab'] = SimAxis(arm + '.grab', -90, -200, 0, 1560)
+
+    def _axis(self, arm, name):
+        return self.axes[arm + '.' + name if arm else name]
+
+    def detach(self, port):
+        self.devices.pop(port, None)
+
+    def attach(self, port, driver_name):
+        self.devices[port] = driver_name
+
+    def jam(self, axis, load=1.0):
+        self.axes[axis].load = load
+
+    def press(self, button):
+        self.buttons.add(button)
+
+    def release(self, button):
+        self.buttons.discard(button)
+
+    def io(self):
+        self.io_count += 1
+        self.bus.transaction()
+        self.clock.io()
+
+    def update(self):
+        # advance every motor and the thermal model up to the current time
+        with self.lock:
+            now = self.clock.time()
+            elapsed = now - self.last_update
+            if elapsed <= 0:
+                return
+            t = self.last_update
+            while t < now:
+                dt = min(PHYSICS_STEP, now - t)
+                t += dt
+                for motor in self.motors:
+                    motor.step(dt, t)
+            heat = 0.0
+            for axis in self.axes.values():
+                heat += (axis.duty_cycle / 100.0) ** 2
+            self.temperature += elapsed * (self.HEAT_GAIN * heat
+                                           - (self.temperature - self.AMBIENT_TEMP) / self.COOL_TAU)
+            self.last_update = now
+
+    def reflect(self, arm=''):
+        height = -self._axis(arm, 'lift').angle
+        if height >= 0:
+            value = 41 + height * 1.5
+        else:
+            value = 40 + height * 35.0 / 40.0
+        value += self.random.uniform(-self.reflect_noise, self.reflect_noise)
+        return int(max(2, min(90, value)))
+
+    def touch(self, arm=''):
+        return int(abs(self._axis(arm, 'base').angle) <= self.TOUCH_WIDTH)
+
+    def temperature_c(self):
+        if self.temperature_override is not None:
+            return self.temperature_override
+        return self.temperature
+
+
+world = SimWorld()
+time = SimTime(world.clock)
+
+
+def reset_world(seed=0, io_latency=IO_LATENCY, speedup=None):
+    world.reset(seed, io_latency, speedup)
+    return world
+
+
+class Device:
+
+    def __init__(self, address=None, driver_names=None):
+        self.address = address
+        arm, port = '', address
+        if address is not None and '.' in str(address):
+            arm, port = str(address).rsplit('.', 1)
+        role = world.wiring.get(port)
+        if role is None and port is not None and ':' in str(port):
+            role = world.wiring.get(str(port).split(':')[0])
+        if port is None or str(port).split(':')[0] not in world.devices or role is None:
+            raise DeviceNotFound("no device found on " + str(address))
+        # kind: the role in the arm, role: the joint or sensor in the world
+        self.arm = arm
+        self.kind = role
+        if arm:
+            world.add_arm(arm)
+            role = arm + '.' + role
+        self.role = role
+        self.connected = True
+        world.io()
+
+
+class Motor(Device):
+
+    COMMAND_RUN_FOREVER = 'run-forever'
+    COMMAND_RUN_TO_ABS_POS = 'run-to-abs-pos'
+    COMMAND_RUN_TO_REL_POS = 'run-to-rel-pos'
+    COMMAND_RUN_TIMED = 'run-timed'
+    COMMAND_STOP = 'stop'
+    COMMAND_RESET = 'reset'
+
+    POLARITY_NORMAL = 'normal'
+    POLARITY_INVERSED = 'inversed'
+
+    STATE_RUNNING = 'running'
+    STATE_RAMPING = 'ramping'
+    STATE_HOLDING = 'holding'
+    STATE_OVERLOADED = 'overloaded'
+    STATE_STALLED = 'stalled'
+
+    STOP_ACTION_COAST = 'coast'
+    STOP_ACTION_BRAKE = 'brake'
+    STOP_ACTION_HOLD = 'hold'
+
+    def __init__(self, address=None):
+        Device.__init__(self, address)
+        self.axis = world.axes[self.role]
+        self.count_per_rot = 360
+        self.max_speed = self.axis.max_speed
+        self._offset = self.axis.angle
+        self._clear()
+        with world.lock:
+            for motor in list(world.motors):
+                if motor.address == self.address:
+                    # the tacho count and the settings live in the driver: a restarted
+                    # controller finds them as the previous one left them
+                    self.__dict__.update((name, value) for name, value in motor.__dict__.items()
+                                         if name.startswith("_"))
+                    world.motors.remove(motor)
+            world.motors.append(self)
+
+    def _clear(self):
+        self._polarity = self.POLARITY_NORMAL
+        self._stop_action = self.STOP_ACTION_COAST
+        self._speed_sp = 0
+        self._position_sp = 0
+        self._time_sp = 0
+        self._ramp_up_sp = 0
+        self._ramp_down_sp = 0
+        self._mode = None
+        self._target = None
+        self._until = None
+        self._velocity = 0.0
+        self._holding = False
+        self._stalled = False
+
+    def _sign(self):
+        return -1 if self._polarity == self.POLARITY_INVERSED else 1
+
+    def _command(self, command):
+        world.update()
+        world.io()
+        with world.lock:
+            self._stalled = False
+            self._holding = False
+            if command == self.COMMAND_RUN_FOREVER:
+                self._mode = command
+            elif command == self.COMMAND_RUN_TO_ABS_POS:
+                self._mode = command
+                self._target = self._offset + self._sign() * self._position_sp
+            elif command == self.COMMAND_RUN_TO_REL_POS:
+                self._mode = command
+                self._target = self.axis.angle + self._sign() * self._position_sp
+            elif command == self.COMMAND_RUN_TIMED:
+                self._mode = command
+                self._until = world.clock.time() + self._time_sp / 1000.0
+            elif command == self.COMMAND_STOP:
+                self._finish()
+            elif command == self.COMMAND_RESET:
+                self._offset = self.axis.angle
+                self._clear()
+
+    def _finish(self):
+        self._mode = None
+        self._target = None
+        self._until = None
+        self._holding = self._stop_action == self.STOP_ACTION_HOLD
+        if self._stop_action != self.STOP_ACTION_COAST:
+            self._velocity = 0.0
+
+    def _limit_speed(self):
+        if not self.axis.load:
+            return self.max_speed
+        return self.max_speed * max(0.0, 1.0 - self.axis.load)
+
+    def _supply_scale(self):
+        return world.supply_volts / NOMINAL_VOLTS
+
+    def step(self, dt, now):
+        axis = self.axis
+        if self._mode is None and self._velocity == 0.0:
+            axis.duty_cycle = 0
+            return
+        if axis.load >= 1.0 and self._mode is not None:
+            self._velocity = 0.0
+            self._stalled = True
+            axis.duty_cycle = 100 * (1 if self._commanded_velocity() >= 0 else -1)
+            return
+        wanted = self._commanded_velocity() * self._supply_scale()
+        limit = self._limit_speed() * self._supply_scale()
+        wanted = max(-limit, min(limit, wanted))
+        self._velocity = self._ramp(self._velocity, wanted, dt)
+        new_angle = axis.angle + self._velocity * dt
+        if self._mode in (self.COMMAND_RUN_TO_ABS_POS, self.COMMAND_RUN_TO_REL_POS):
+            if (self._target - axis.angle) * (self._target - new_angle) <= 0:
+                new_angle = self._target
+                axis.angle = new_angle
+                self._finish()
+                axis.duty_cycle = 0
+                return
+        if self._mode == self.COMMAND_RUN_TIMED and now >= self._until:
+            self._finish()
+        self._stalled = False
+        if new_angle > axis.max_stop or new_angle < axis.min_stop:
+            new_angle = max(axis.min_stop, min(axis.max_stop, new_angle))
+            self._velocity = 0.0
+            self._stalled = self._mode is not None
+        axis.angle = new_angle
+        if self._stalled:
+            axis.duty_cycle = 100 * (1 if wanted >= 0 else -1)
+        elif self._mode is None:
+            axis.duty_cycle = 0
+        else:
+            axis.duty_cycle = int(100 * min(1.0, abs(self._velocity) / self.max_speed + axis.load)) \
+                * (1 if self._velocity >= 0 else -1)
+
+    def _commanded_velocity(self):
+        speed = abs(self._speed_sp)
+        if self._mode == self.COMMAND_RUN_FOREVER or self._mode == self.COMMAND_RUN_TIMED:
+            return self._sign() * self._speed_sp
+        if self._mode in (self.COMMAND_RUN_TO_ABS_POS, self.COMMAND_RUN_TO_REL_POS):
+            return speed if self._target >= self.axis.angle else -speed
+        return 0.0
+
+    def _ramp(self, current, wanted, dt):
+        ramp_ms = self._ramp_up_sp if abs(wanted) > abs(current) else self._ramp_down_sp
+        if ramp_ms <= 0:
+            return wanted
+        delta = self.max_speed / (ramp_ms / 1000.0) * dt
+        if abs(wanted - current) <= delta:
+            return wanted
+        return current + delta if wanted > current else current - delta
+
+    def _read(self):
+        world.update()
+        world.io()
+
+    @property
+    def state(self):
+        self._read()
+        states = []
+        if self._mode is not None:
+            states.append(self.STATE_RUNNING)
+            if (self._ramp_up_sp or self._ramp_down_sp) and not self._stalled \
+                    and abs(self._velocity) < abs(self._commanded_velocity()):
+                states.append(self.STATE_RAMPING)
+        elif self._holding:
+            states.append(self.STATE_HOLDING)
+        if self._stalled:
+            states.append(self.STATE_STALLED)
+        if self._stalled or (self._holding and self.axis.load >= 1.0):
+            states.append(self.STATE_OVERLOADED)
+        return states
+
+    @property
+    def position(self):
+        self._read()
+        return int(round(self._sign() * (self.axis.angle - self._offset)))
+
+    @position.setter
+    def position(self, value):
+        self._read()
+        with world.lock:
+            self._offset = self.axis.angle - self._sign() * value
+            if self._target is not None and self._mode == self.COMMAND_RUN_TO_ABS_POS:
+                self._target = self._offset + self._sign() * self._position_sp
+
+    @property
+    def speed(self):
+        self._read()
+        return int(self._sign() * self._velocity)
+
+    @property
+    def duty_cycle(self):
+        self._read()
+        return self._sign() * self.axis.duty_cycle
+
+    @property
+    def command(self):
+        raise Exception("command is write only")
+
+    @command.setter
+    def command(self, value):
+        self._command(value)
+
+    @property
+    def polarity(self):
+        self._read()
+        return self._polarity
+
+    @polarity.setter
+    def polarity(self, value):
+        self._read()
+        self._polarity = value
+
+    @property
+    def stop_action(self):
+        self._read()
+        return self._stop_action
+
+    @stop_action.setter
+    def stop_action(self, value):
+        self._read()
+        self._stop_action = value
+
+    @property
+    def speed_sp(self):
+        self._read()
+        return self._speed_sp
+
+    @speed_sp.setter
+    def speed_sp(self, value):
+        self._read()
+        self._speed_sp = int(value)
+
+    @property
+    def position_sp(self):
+        self._read()
+        return self._position_sp
+
+    @position_sp.setter
+    def position_sp(self, value):
+        self._read()
+        self._position_sp = int(value)
+
+    @property
+    def time_sp(self):
+        self._read()
+        return self._time_sp
+
+    @time_sp.setter
+    def time_sp(self, value):
+        self._read()
+        self._time_sp = int(value)
+
+    @property
+    def ramp_up_sp(self):
+        self._read()
+        return self._ramp_up_sp
+
+    @ramp_up_sp.setter
+    def ramp_up_sp(self, value):
+        self._read()
+        self._ramp_up_sp = int(value)
+
+    @property
+    def ramp_down_sp(self):
+        self._read()
+        return self._ramp_down_sp
+
+    @ramp_down_sp.setter
+    def ramp_down_sp(self, value):
+        self._read()
+        self._ramp_down_sp = int(value)
+
+    def _run(self, command, kwargs):
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+        self.command = command
+
+    def run_forever(self, **kwargs):
+        self._run(self.COMMAND_RUN_FOREVER, kwargs)
+
+    def run_to_abs_pos(self, **kwargs):
+        self._run(self.COMMAND_RUN_TO_ABS_POS, kwargs)
+
+    def run_to_rel_pos(self, **kwargs):
+        self._run(self.COMMAND_RUN_TO_REL_POS, kwargs)
+
+    def run_timed(self, **kwargs):
+        self._run(self.COMMAND_RUN_TIMED, kwargs)
+
+    def stop(self, **kwargs):
+        self._run(self.COMMAND_STOP, kwargs)
+
+    def reset(self, **kwargs):
+        self._run(self.COMMAND_RESET, kwargs)
+
+
+class LargeMotor(Motor):
+    pass
+
+
+class MediumMotor(Motor):
+    pass
+
+
+class Sensor(Device):
+
+    def __init__(self, address=None):
+        Device.__init__(self, address)
+        self._mode = None
+        self.decimals = 0
+
+    @property
+    def mode(self):
+        world.io()
+        return self._mode
+
+    @mode.setter
+    def mode(self, value):
+        world.io()
+        self._mode = value
+        self.decimals = 1 if self.kind == 'temperature' else 0
+
+    @property
+    def num_values(self):
+        world.io()
+        return 3 if self._mode == 'RGB-RAW' else 1
+
+    def _raw(self):
+        world.update()
+        if self.kind == 'reflect':
+            return world.reflect(self.arm)
+        if self.kind == 'touch':
+            return world.touch(self.arm)
+        if self.kind == 'temperature':
+            return int(round(world.temperature_c() * 10))
+        return 0
+
+    def _raw_values(self):
+        if self._mode == 'RGB-RAW':
+            # red, green and blue of the reflected light, 0..1020
+            reflect = self._raw()
+            return [reflect * 10, reflect * 9, reflect * 8]
+        return [self._raw()]
+
+    def value(self, n=0):
+        world.io()
+        values = self._raw_values()
+        if n >= len(values):
+            return 0
+        return values[n]
+
+    @property
+    def bin_data_format(self):
+        world.io()
+        return 's16' if self.kind == 'temperature' or self._mode == 'RGB-RAW' else 's8'
+
+    def bin_data(self, fmt=None):
+        world.io()
+        values = self._raw_values()
+        if self.kind == 'temperature' or self._mode == 'RGB-RAW':
+            raw = struct.pack('<' + str(len(values)) + 'h', *values)
+        else:
+            raw = struct.pack('<' + str(len(values)) + 'b', *values)
+        if fmt is None:
+            return raw
+        return struct.unpack(fmt, raw)
+
+
+class TouchSensor(Sensor):
+
+    MODE_TOUCH = 'TOUCH'
+
+    @property
+    def is_pressed(self):
+        return self.value() == 1
+
+
+class ColorSensor(Sensor):
+
+    MODE_COL_REFLECT = 'COL-REFLECT'
+    MODE_COL_AMBIENT = 'COL-AMBIENT'
+    MODE_COL_COLOR = 'COL-COLOR'
+    MODE_RGB_RAW = 'RGB-RAW'
+
+    @property
+    def reflected_light_intensity(self):
+        self.mode = self.MODE_COL_REFLECT
+        return self.value(0)
+
+
+class PowerSupply:
+    # the supply input of the BrickPi3 (or the EV3 battery)
+
+    def __init__(self, address=None, *args, **kwargs):
+        world.io()
+        self.address = address or ('lego-ev3-battery' if world.platform == 'ev3' else 'brickpi3-battery')
+
+    @property
+    def measured_voltage(self):
+        # units: microvolts
+        world.io()
+        return int(world.supply_volts * 1000000)
+
+    @property
+    def measured_volts(self):
+        return self.measured_voltage / 1000000.0
+
+
+class LegoPort:
+
+    def __init__(self, address=None):
+        self.address = address
+        self.mode = None
+        world.io()
+
+    @property
+    def set_device(self):
+        raise Exception("set_device is write only")
+
+    @set_device.setter
+    def set_device(self, value):
+        world.io()
+        world.attach(self.address, value.split(' ')[0])
+
+
+class _SoundProcess:
+    # stand-in for the Popen object returned by ev3dev's Sound
+
+    def __init__(self, duration):
+        self.done_at = world.clock.time() + duration
+
+    def wait(self):
+        world.clock.sleep(max(0.0, self.done_at - world.clock.time()))
+        return 0
+
+    def poll(self):
+        return 0 if world.clock.time() >= self.done_at else None
+
+
+class Sound:
+
+    @staticmethod
+    def speak(text, espeak_opts='-a 200 -s 130', volume=100):
+        world.spoken.append(text)
+        return _SoundProcess(0.08 * len(text))
+
+    @staticmethod
+    def beep(args=''):
+        return _SoundProcess(0.1)
+
+    @staticmethod
+    def tone(*args):
+        return _SoundProcess(0.2)
+
+    @staticmethod
+    def play(wav_file):
+        return _SoundProcess(1.0)
+
+
+class Leds:
+
+    LEFT = ('left',)
+    RIGHT = ('right',)
+
+    BLACK = (0, 0)
+    RED = (1, 0)
+    GREEN = (0, 1)
+    AMBER = (1, 1)
+    ORANGE = (1, 0.5)
+    YELLOW = (0.1, 1)
+
+    @staticmethod
+    def set_color(group, color, pct=1):
+        for led in group:
+            # one write per color channel
+            world.io()
+            world.io()
+            world.leds[led] = tuple(c * pct for c in color)
+
+    @staticmethod
+    def all_off():
+        Leds.set_color(Leds.LEFT, Leds.BLACK)
+        Leds.set_color(Leds.RIGHT, Leds.BLACK)
+
+
+class ButtonBase:
+
+    @property
+    def buttons_pressed(self):
+        world.io()
+        return sorted(world.buttons)
+
+    def any(self):
+        return bool(self.buttons_pressed)
+
+    @property
+    def backspace(self):
+        return 'backspace' in self.buttons_pressed
+
+    @property
+    def enter(self):
+        return 'enter' in self.buttons_pressed
+
+
+class Button(ButtonBase):
+    pass
+
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Cold start helpers for the Robot Arm controller.
+#
+# On the EV3 most of the start time goes to importing modules and to finding
+# the motors and sensors, where every sensor that is not detected on its own
+# costs a LegoPort mode change and a 0.5 s wait. This module provides:
+#
+# - lazy_import(): a module that is only imported when it is first used
+# - discover(): runs the device setup functions of the ports in parallel
+# - stage() / report(): wall clock time of every start stage, from the start
+#   of the process, for the timing report printed when the arm is ready
+#
+# The timings use the wall clock even on the simulated backend, where the
+# scripts' time is virtual.
+#
+
+import contextlib
+import importlib
+import os
+import sys
+import threading
+import time
+
+_imported = _started = time.time()
+_stages = []                # (name, seconds, parallel)
+_stages_lock = threading.Lock()
+
+
+def process_age():
+    # seconds since the process started (the interpreter start included), None
+    # when /proc is not there
+    try:
+        with open("/proc/self/stat") as stat:
+            start_ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime:
+            now = float(uptime.read().split()[0])
+        return now - start_ticks / float(os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+class LazyModule:
+    # stands for a module until an attribute is used, then imports it (once,
+    # also when the first uses come from several threads)
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                with stage("lazy import " + self._name):
+                    self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._module or self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._module or self._load(), attribute, value)
+
+
+def lazy_import(name):
+    # the module is imported when it is first used
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def record(name, seconds, parallel=False):
+    with _stages_lock:
+        _stages.append((name, seconds, parallel))
+
+
+@contextlib.contextmanager
+def stage(name, parallel=False):
+    # with stage("name"): ... records how long the block took
+    tic = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - tic, parallel)
+
+
+def mark(name):
+    # records the time since the previous mark (or the start) as stage name
+    global _started
+    now = time.time()
+    record(name, now - _started)
+    _started = now
+
+
+def discover(setups, parallel=True):
+    # setups: [(name, function)]; runs every function, in its own thread when
+    # parallel, and returns {name: result}. A function that fails (or calls
+    # sys.exit()) makes discover() raise the same exception, after all of them
+    # finished, for the first failing one in the given order.
+    results = {}
+    errors = {}
+
+    def run(name, function):
+        with stage("  " + name, parallel):
+            try:
+                results[name] = function()
+            except BaseException:
+                errors[name] = sys.exc_info()[1]
+
+    if parallel:
+        threads = [threading.Thread(target=run, args=(name, function), name="roboarm-setup-" + name)
+                   for name, function in setups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        for name, function in setups:
+            run(name, function)
+            if name in errors:
+                break
+    for name, function in setups:
+        if name in errors:
+            raise errors[name]
+    return results
+
+
+def report():
+    # the timing report, one line per stage
+    with _stages_lock:
+        stages = list(_stages)
+    elapsed = time.time() - _imported
+    age = process_age()
+    lines = ["startup timing:"]
+    if age is not None:
+        lines.append("  %-28s %8.3f s" % ("interpreter", age - elapsed))
+    for name, seconds, parallel in stages:
+        lines.append("  %-28s %8.3f s%s" % (name, seconds, " (parallel)" if parallel else ""))
+    lines.append("  %-28s %8.3f s" % ("total", elapsed if age is None else age))
+    return "\n".join(lines)
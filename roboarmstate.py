@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# Crash-safe persisted pose and calibration of the Robot Arm.
+#
+# The controller saves what it knows about the arm (encoder positions and
+# polarity, base target, holding motors, drift corrections and landmarks, and
+# whether it is homed or in the middle of a move) to a small memory-mapped
+# file after every homing and every move. A restarted controller loads it and,
+# when the encoders and sensors still read what was saved, resumes without
+# homing the arm again.
+#
+# The file has two slots written in turn. Every slot carries a sequence number
+# and a CRC32, so a save torn by a crash is detected and load() falls back to
+# the previous slot: an update is either fully there or not at all.
+#
+# The tacho counters only survive while the brick (its motor drivers) stays
+# up, so the boot id of the kernel is saved too.
+#
+
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RAST"
+VERSION = 2
+POSITION_TOLERANCE = 3      # tacho counts the encoders may differ from the saved pose
+REFLECT_TOLERANCE = 5       # reflected light (%) the lift sensor may differ from the saved pose
+NONE = -2 ** 31             # int field without a value
+
+# saved fields, in the slot layout order
+FIELDS = (("saved", "d"),                   # wall clock time of the save
+          ("homed", "B"),
+          ("moving", "B"),
+          ("holding", "B"),                 # bit mask of the holding motors, MOTOR_BITS
+          ("touch", "B"),                   # base touch sensor pressed
+          ("reflect", "h"),                 # lift light sensor value
+          ("lift_inversed", "B"),
+          ("grab_inversed", "B"),
+          ("base_inversed", "B"),
+          ("lift_position", "i"),
+          ("grab_position", "i"),
+          ("base_position", "i"),
+          ("base_target", "i"),
+          ("lift_initial_position", "i"),
+          ("lift_limit_position", "i"),     # encoder position (normal polarity) of the lift light sensor limit
+          ("base_correction", "i"),
+          ("base_reference_up", "i"),
+          ("base_reference_down", "i"),
+          ("lift_correction", "i"),
+          ("lift_reference", "i"))
+MOTOR_BITS = (("lift", 1), ("grab", 2), ("base", 4))
+
+_header = struct.Struct("<4sHQI16s")        # magic, version, sequence, crc32, boot id
+_payload = struct.Struct("<" + "".join(kind for name, kind in FIELDS))
+SLOT_SIZE = _header.size + _payload.size
+
+
+def boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as boot:
+            return bytes.fromhex(boot.read().strip().replace("-", ""))
+    except (IOError, OSError, ValueError):
+        return b"\0" * 16
+
+
+class ArmState:
+
+    def __init__(self, path, boot=None):
+        self.path = path
+        self.boot = boot_id() if boot is None else boot
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < 2 * SLOT_SIZE:
+                os.ftruncate(fd, 2 * SLOT_SIZE)
+            self.map = mmap.mmap(fd, 2 * SLOT_SIZE)
+        finally:
+            os.close(fd)
+
+    def _slot(self, index):
+        # (sequence, boot, payload) of a valid slot, None for an empty or torn one
+        offset = index * SLOT_SIZE
+        magic, version, sequence, crc, boot = _header.unpack_from(self.map, offset)
+        payload = self.map[offset + _header.size:offset + SLOT_SIZE]
+        if magic != MAGIC or version != VERSION \
+                or zlib.crc32(struct.pack("<Q16s", sequence, boot) + payload) != crc:
+            return None
+        return sequence, boot, payload
+
+    def _newest(self):
+        slots = [slot for slot in (self._slot(0), self._slot(1)) if slot is not None]
+        return max(slots) if slots else None
+
+    def load(self):
+        # {field: value} of the newest valid save of this boot, None if there is none
+        newest = self._newest()
+        if newest is None:
+            logger.info("[STATE] no saved state in " + self.path)
+            return None
+        sequence, boot, payload = newest
+        if boot != self.boot:
+            logger.info("[STATE] saved state is from another boot")
+            return None
+        values = dict(zip([name for name, kind in FIELDS], _payload.unpack(payload)))
+        for name, value in values.items():
+            if value == NONE:
+                values[name] = None
+        return values
+
+    def save(self, **values):
+        # the fields missing from values are saved as None / 0
+        newest = self._newest()
+        sequence = newest[0] + 1 if newest is not None else 1
+        values["saved"] = time.time()
+        payload = _payload.pack(*[NONE if values.get(name) is None and kind == "i" else values.get(name) or 0
+                                  for name, kind in FIELDS])
+        crc = zlib.crc32(struct.pack("<Q16s", sequence, self.boot) + payload)
+        # overwrite the older slot, the newest one stays valid until this is complete
+        offset = (sequence % 2) * SLOT_SIZE
+        self.map[offset + _header.size:offset + SLOT_SIZE] = payload
+        _header.pack_into(self.map, offset, MAGIC, VERSION, sequence, crc, self.boot)
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+
+
+def holding_mask(motors):
+    # motors: {axis: motor}
+    mask = 0
+    for axis, bit in MOTOR_BITS:
+        if motors[axis].STATE_HOLDING in motors[axis].state:
+            mask |= bit
+    return mask
+
+
+def mismatch(saved, observed):
+    # why the arm is not where the saved state says, None when it is;
+    # observed has the same fields as saved, read from the arm now
+    if saved is None:
+        return "no saved state"
+    if not saved["homed"]:
+        return "the arm was not homed"
+    if saved["moving"]:
+        return "the arm stopped in the middle of a move"
+    for axis, bit in MOTOR_BITS:
+        if saved[axis + "_inversed"] != observed[axis + "_inversed"]:
+            return axis + " motor polarity changed"
+        difference = observed[axis + "_position"] - saved[axis + "_position"]
+        if abs(difference) > POSITION_TOLERANCE:
+            return axis + " encoder moved " + str(difference) + " counts"
+    if saved["touch"] != observed["touch"]:
+        return "base touch sensor changed"
+    if abs(saved["reflect"] - observed["reflect"]) > REFLECT_TOLERANCE:
+        return "lift light sensor changed"
+    return None
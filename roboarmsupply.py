@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Supply voltage compensation of the Robot Arm motors.
+#
+# The BrickPi3 runs from an 8xAA battery pack or a universal supply. As the
+# voltage sags the same speed_sp turns the motors slower (and with less
+# torque), so the motion timings and the WHILE_LOOP_TIMEOUT margins drift.
+# The telemetry sampler reads the supply voltage and a SupplyMonitor keeps it
+# smoothed in shared memory, so the movement process compensates from the
+# readings of the IoT process. With factor = NOMINAL_VOLTS / volts:
+#
+# - speed(): speed setpoints times the factor, up to the max speed of the motor
+# - duration(): the time based phases (the grab closing) longer by the part of
+#   the factor the speed setpoint could not take (at the max speed)
+# - timeout(): the wait loop timeouts longer at a low voltage, never shorter
+#
+# Without a reading (no power supply device) the factor is 1.
+#
+
+import multiprocessing
+import os
+
+import roboarmmetrics
+
+NOMINAL_VOLTS = float(os.environ.get("ROBOARM_NOMINAL_VOLTS", 9.0))  # supply voltage the speeds were tuned at
+LOW_VOLTS = 7.0             # supply voltage under which the batteries need a change (units: V)
+MAX_FACTOR = 1.5            # compensation factor at most (and 1 / MAX_FACTOR at least)
+SMOOTHING = 0.3             # weight of a new reading in the smoothed voltage
+
+
+class SupplyMonitor:
+
+    def __init__(self, nominal=NOMINAL_VOLTS, arm=roboarmmetrics.DEFAULT_ARM):
+        self.nominal = nominal
+        self.arm = arm
+        # smoothed voltage, 0.0 before the first reading; shared with the
+        # processes forked after the monitor is created
+        self._volts = multiprocessing.RawValue("d", 0.0)
+
+    @property
+    def volts(self):
+        return self._volts.value or None
+
+    @property
+    def low(self):
+        return self.volts is not None and self.volts < LOW_VOLTS
+
+    def sample(self, volts):
+        # a voltage reading (units: V); returns the smoothed voltage
+        if volts <= 0:
+            return self.volts
+        smoothed = self._volts.value
+        smoothed = volts if not smoothed else smoothed + SMOOTHING * (volts - smoothed)
+        self._volts.value = smoothed
+        roboarmmetrics.SUPPLY_VOLTS.set(smoothed, self.arm)
+        roboarmmetrics.SUPPLY_FACTOR.set(self.factor(), self.arm)
+        return smoothed
+
+    def factor(self):
+        volts = self._volts.value
+        if not volts:
+            return 1.0
+        return max(1.0 / MAX_FACTOR, min(MAX_FACTOR, self.nominal / volts))
+
+    def speed(self, speed, max_speed):
+        # speed_sp that turns the motor at speed with the supply now
+        compensated = int(round(speed * self.factor()))
+        return max(-max_speed, min(max_speed, compensated))
+
+    def duration(self, seconds, speed, max_speed):
+        # seconds of a phase run at speed(speed, max_speed) that travel as far as
+        # seconds at speed with the nominal voltage
+        compensated = self.speed(speed, max_speed)
+        if not compensated:
+            return seconds
+        return seconds * speed * self.factor() / compensated
+
+    def timeout(self, timeout):
+        # a wait loop timeout (any unit), None for none
+        if timeout is None:
+            return None
+        return timeout * max(1.0, self.factor())
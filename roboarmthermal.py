@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Thermal governor for the Robot Arm movement loop.
+#
+# Between the soft and the hard limit the arm keeps working but slower: the
+# motor speeds are scaled down and a cool-down pause is added after every move,
+# both in proportion to how far the temperature is into that band. At the hard
+# limit the arm halts until the temperature is back under the resume limit.
+#
+# The governor also keeps a trend of the temperature (TemperatureTrend) and
+# throttles on the temperature predicted for its next reading, so a quickly
+# heating arm starts pausing before it gets close to the limit. The trend and
+# the predicted time to the hard limit are shared with the other processes
+# for the telemetry.
+#
+# Temperatures are raw sensor values (tenths of C), like TEMP_LIMIT.
+#
+
+import math
+import multiprocessing
+
+import roboarmmetrics
+
+MIN_SPEED_SCALE = 0.5       # speed factor at the hard limit
+MAX_PAUSE = 60.0            # cool-down pause after a move at the hard limit (units: seconds)
+TREND_HALF_LIFE = 300.0     # age at which a reading counts half in the trend (units: seconds)
+MIN_SLOPE = 1e-4            # slower rises are treated as flat (units: tenths of C per second)
+
+
+class TemperatureTrend:
+    # Exponentially weighted least squares line through the readings. The sums
+    # are kept relative to the newest reading and decayed on every add(), so an
+    # update is O(1) and no history is stored.
+
+    def __init__(self, half_life=TREND_HALF_LIFE):
+        self.half_life = half_life
+        self.last_time = None
+        self.s0 = self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+    def add(self, now, value):
+        if self.last_time is not None:
+            shift = now - self.last_time
+            decay = 0.5 ** (shift / self.half_life)
+            # move the origin to now, then age the old readings
+            self.sxx = (self.sxx - 2 * shift * self.sx + shift * shift * self.s0) * decay
+            self.sxy = (self.sxy - shift * self.sy) * decay
+            self.sx = (self.sx - shift * self.s0) * decay
+            self.sy *= decay
+            self.s0 *= decay
+        self.last_time = now
+        self.s0 += 1.0
+        self.sy += value
+
+    def slope(self):
+        # per second, 0.0 until there are two readings apart in time
+        denominator = self.s0 * self.sxx - self.sx * self.sx
+        if denominator <= 1e-9:
+            return 0.0
+        return (self.s0 * self.sxy - self.sx * self.sy) / denominator
+
+    def value(self):
+        # fitted value at the newest reading
+        if not self.s0:
+            return None
+        return (self.sy - self.slope() * self.sx) / self.s0
+
+    def predict(self, seconds):
+        current = self.value()
+        if current is None:
+            return None
+        return current + self.slope() * seconds
+
+    def time_to(self, limit):
+        # seconds until the trend reaches limit, None if it is not rising
+        current = self.value()
+        if current is None:
+            return None
+        if current >= limit:
+            return 0.0
+        slope = self.slope()
+        if slope < MIN_SLOPE:
+            return None
+        return (limit - current) / slope
+
+
+class ThermalGovernor:
+
+    def __init__(self, soft_limit, hard_limit, resume_limit=None,
+                 min_speed_scale=MIN_SPEED_SCALE, max_pause=MAX_PAUSE, half_life=TREND_HALF_LIFE,
+                 arm=roboarmmetrics.DEFAULT_ARM):
+        if hard_limit <= soft_limit:
+            raise ValueError("hard limit must be above the soft limit")
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.resume_limit = soft_limit if resume_limit is None else resume_limit
+        self.min_speed_scale = min_speed_scale
+        self.max_pause = max_pause
+        self.arm = arm
+        self.trend = TemperatureTrend(half_life)
+        self.horizon = 0.0
+        # shared with the processes forked after it is created, for the telemetry
+        self._level = multiprocessing.RawValue("d", 0.0)
+        self._halted = multiprocessing.RawValue("b", 0)
+        self._slope = multiprocessing.RawValue("d", 0.0)
+        self._time_to_limit = multiprocessing.RawValue("d", float("nan"))
+
+    @property
+    def level(self):
+        # 0.0 full speed ... 1.0 at the hard limit
+        return self._level.value
+
+    @property
+    def halted(self):
+        return bool(self._halted.value)
+
+    @property
+    def trend_per_minute(self):
+        # temperature trend in C per minute
+        return round(self._slope.value * 60 / 10.0, 3)
+
+    @property
+    def time_to_limit(self):
+        # seconds until the hard limit at the current trend, None if not rising
+        seconds = self._time_to_limit.value
+        if math.isnan(seconds):
+            return None
+        return round(seconds, 1)
+
+    def update(self, temperature, now=None):
+        # new reading (at time now, to follow the trend); returns the
+        # cool-down pause to add after the next move
+        if temperature is None:
+            return 0.0
+        predicted = temperature
+        if now is not None:
+            if self.trend.last_time is not None:
+                # the next reading comes about as much later as this one did
+                self.horizon = now - self.trend.last_time
+            self.trend.add(now, temperature)
+            predicted = max(temperature, self.trend.predict(self.horizon))
+            time_to_limit = self.trend.time_to(self.hard_limit)
+            self._slope.value = self.trend.slope()
+            self._time_to_limit.value = float("nan") if time_to_limit is None else time_to_limit
+            roboarmmetrics.TEMPERATURE_TREND.set(self.trend_per_minute, self.arm)
+            roboarmmetrics.TIME_TO_LIMIT.set(self._time_to_limit.value, self.arm)
+        level = (predicted - self.soft_limit) / float(self.hard_limit - self.soft_limit)
+        level = max(0.0, min(1.0, level))
+        if temperature >= self.hard_limit:
+            self._halted.value = 1
+        elif temperature <= self.resume_limit:
+            self._halted.value = 0
+        self._level.value = level
+        roboarmmetrics.THERMAL_THROTTLE.set(level, self.arm)
+        roboarmmetrics.THERMAL_HALTED.set(self._halted.value, self.arm)
+        pause = level * self.max_pause
+        if pause:
+            roboarmmetrics.THERMAL_PAUSE_SECONDS.inc(self.arm, amount=pause)
+        return pause
+
+    def speed(self, speed):
+        return int(round(speed * (1.0 - self.level * (1.0 - self.min_speed_scale))))
@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+#
+# Record and replay of the device I/O made by LegoRoboArm.
+#
+# Recording: with ROBOARM_TRACE=<file> the scripts wrap the ev3dev device
+# classes so every attribute read/write and method call on a motor, sensor or
+# port is stored with its timestamp in a compact binary trace.
+#
+#    ROBOARM_TRACE=/tmp/arm.trace python3 legoroboarmtornadoBPv5.py
+#
+# Child processes (the movement and IoT processes) write to <file>.<pid>.
+#
+# Replay: ROBOARM_BACKEND=replay ROBOARM_REPLAY=<file> gives the scripts a
+# backend whose devices answer reads with the recorded values on a virtual
+# clock (sample and hold: the value recorded last before the current replay
+# time), so the same initialize()/move() run can be re-executed and timed off
+# the hardware and compared across code versions:
+#
+#    python3 roboarmtrace.py summary /tmp/arm.trace
+#    python3 roboarmtrace.py replay /tmp/arm.trace --script legoroboarmtornadoBPv5 --moves 4
+#
+# Trace format: b"RBTRACE1", uint32 header length, JSON header, then records
+#    uint8 op, uint16 key id, uint32 microseconds since previous record, value
+# Keys ("<address>.<attribute>") are declared once with an OP_KEY record.
+#
+
+import atexit
+import bisect
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time as _walltime
+
+import roboarmsim
+from roboarmsim import DeviceNotFound, SimClock, SimTime, Sound, Leds, ButtonBase, Button, log
+from roboarmsim import OUTPUT_A, OUTPUT_B, OUTPUT_C, OUTPUT_D, INPUT_1, INPUT_2, INPUT_3, INPUT_4
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RBTRACE1"
+
+OP_KEY = 0
+OP_NEW = 1
+OP_READ = 2
+OP_WRITE = 3
+OP_CALL = 4
+
+# calls whose return value is a device reading; their arguments are part of the key
+READ_CALLS = ("value", "bin_data")
+
+TRACED_CLASSES = ("LargeMotor", "MediumMotor", "Motor", "Sensor", "TouchSensor", "ColorSensor", "LegoPort",
+                  "PowerSupply")
+
+FLUSH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 1.0
+
+_record = struct.Struct("<BHI")
+_key = struct.Struct("<BH")
+
+
+class ReplayMiss(Exception):
+    pass
+
+
+class ReplayDeviceError(Exception):
+    pass
+
+
+def encode_value(value):
+    if value is None:
+        return b"n"
+    if isinstance(value, bool):
+        return b"b" + struct.pack("<?", value)
+    if isinstance(value, int) and -2 ** 31 <= value < 2 ** 31:
+        return b"i" + struct.pack("<i", value)
+    if isinstance(value, float):
+        return b"f" + struct.pack("<d", value)
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+        return b"s" + struct.pack("<H", len(data)) + data
+    if isinstance(value, bytes):
+        return b"x" + struct.pack("<H", len(value)) + value
+    if isinstance(value, (list, tuple, set)):
+        items = [encode_value(item) for item in value]
+        return (b"l" if isinstance(value, list) else b"t") + struct.pack("<B", len(items)) + b"".join(items)
+    if isinstance(value, BaseException):
+        data = (type(value).__name__ + ": " + str(value)).encode("utf-8")
+        return b"e" + struct.pack("<H", len(data)) + data
+    return encode_value(repr(value))
+
+
+def decode_value(buf, offset):
+    tag = buf[offset:offset + 1]
+    offset += 1
+    if tag == b"n":
+        return None, offset
+    if tag == b"b":
+        return struct.unpack_from("<?", buf, offset)[0], offset + 1
+    if tag == b"i":
+        return struct.unpack_from("<i", buf, offset)[0], offset + 4
+    if tag == b"f":
+        return struct.unpack_from("<d", buf, offset)[0], offset + 8
+    if tag in (b"s", b"x", b"e"):
+        size = struct.unpack_from("<H", buf, offset)[0]
+        data = bytes(buf[offset + 2:offset + 2 + size])
+        offset += 2 + size
+        if tag == b"s":
+            return data.decode("utf-8"), offset
+        if tag == b"e":
+            return ReplayDeviceError(data.decode("utf-8")), offset
+        return data, offset
+    if tag in (b"l", b"t"):
+        count = buf[offset]
+        offset += 1
+        items = []
+        for _ in range(count):
+            item, offset = decode_value(buf, offset)
+            items.append(item)
+        return (items if tag == b"l" else tuple(items)), offset
+    raise ValueError("bad value tag " + repr(tag) + " at " + str(offset - 1))
+
+
+class TraceRecorder:
+
+    def __init__(self, path, header=None, clock=_walltime):
+        self.path = path
+        self.header = header or {}
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pid = None
+        self.file = None
+        self.keys = {}
+        self.buffer = bytearray()
+        self.last = 0.0
+        self.flushed = 0.0
+        atexit.register(self.close)
+
+    def _open(self):
+        # a forked child must not share the parent's file and key table
+        path = self.path if self.pid is None else self.path + "." + str(os.getpid())
+        self.pid = os.getpid()
+        self.file = open(path, "wb")
+        self.keys = {}
+        self.buffer = bytearray()
+        self.last = self.clock.time()
+        header = dict(self.header)
+        header["start"] = self.last
+        header["pid"] = self.pid
+        data = json.dumps(header, sort_keys=True).encode("utf-8")
+        self.file.write(MAGIC + struct.pack("<I", len(data)) + data)
+
+    def record(self, op, key, value=None):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._open()
+            key_id = self.keys.get(key)
+            if key_id is None:
+                key_id = len(self.keys)
+                self.keys[key] = key_id
+                name = key.encode("utf-8")
+                self.buffer += _key.pack(OP_KEY, key_id) + struct.pack("<H", len(name)) + name
+            now = self.clock.time()
+            delta = int(max(0.0, now - self.last) * 1000000)
+            self.last = now
+            self.buffer += _record.pack(op, key_id, min(delta, 0xffffffff)) + encode_value(value)
+            # flush often: the movement processes are ended with terminate()
+            if len(self.buffer) >= FLUSH_SIZE or now - self.flushed >= FLUSH_INTERVAL:
+                self.flush()
+                self.flushed = now
+
+    def flush(self):
+        if self.file is not None and self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and self.pid == os.getpid():
+                self.flush()
+                self.file.close()
+                self.file = None
+
+
+def read_call_key(address, name, args):
+    return address + "." + name + "(" + ",".join(repr(arg) for arg in args) + ")"
+
+
+class TracedDevice(object):
+    # proxy around an ev3dev device that records every access
+
+    def __init__(self, device, address, recorder):
+        object.__setattr__(self, "_device", device)
+        object.__setattr__(self, "_address", address)
+        object.__setattr__(self, "_recorder", recorder)
+
+    def __getattr__(self, name):
+        device = self._device
+        if name[:1].isupper() or name.startswith("_"):
+            # class constants (STATE_HOLDING, MODE_TOUCH...) are not device I/O
+            return getattr(device, name)
+        key = self._address + "." + name
+        try:
+            value = getattr(device, name)
+        except Exception as error:
+            self._recorder.record(OP_READ, key, error)
+            raise
+        if callable(value):
+            return self._traced_call(name, value)
+        self._recorder.record(OP_READ, key, value)
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._device, name, value)
+        self._recorder.record(OP_WRITE, self._address + "." + name, value)
+
+    def _traced_call(self, name, method):
+        recorder = self._recorder
+        address = self._address
+
+        def call(*args, **kwargs):
+            if name in READ_CALLS:
+                key = read_call_key(address, name, args)
+                try:
+                    result = method(*args, **kwargs)
+                except Exception as error:
+                    recorder.record(OP_READ, key, error)
+                    raise
+                recorder.record(OP_READ, key, result)
+                return result
+            recorder.record(OP_CALL, address + "." + name,
+                            ",".join([repr(arg) for arg in args] +
+                                     [key + "=" + repr(kwargs[key]) for key in sorted(kwargs)]))
+            return method(*args, **kwargs)
+        return call
+
+
+def traced_class(cls, recorder):
+
+    def factory(address=None, *args, **kwargs):
+        key = str(address)
+        try:
+            device = cls(address, *args, **kwargs)
+        except Exception as error:
+            recorder.record(OP_NEW, key, error)
+            raise
+        recorder.record(OP_NEW, key, cls.__name__)
+        return TracedDevice(device, key, recorder)
+
+    factory.__name__ = cls.__name__
+    return factory
+
+
+def install(namespace, path):
+    # wrap the device classes imported by a script (its globals()) so the
+    # devices it creates from now on are recorded into path
+    header = {"script": os.path.basename(str(namespace.get("__file__", ""))),
+              "ports": dict((name, str(namespace[name])) for name in namespace
+                            if name.startswith("OUTPUT_") or name.startswith("INPUT_"))}
+    # timestamps follow the script's clock (virtual time on the simulated backend)
+    recorder = TraceRecorder(path, header, namespace.get("time", _walltime))
+    for name in TRACED_CLASSES:
+        if name in namespace:
+            namespace[name] = traced_class(namespace[name], recorder)
+    logger.info("[TRACE] recording device I/O to " + str(path))
+    return recorder
+
+
+class Trace:
+
+    def __init__(self, path):
+        with open(path, "rb") as trace_file:
+            buf = trace_file.read()
+        if buf[:len(MAGIC)] != MAGIC:
+            raise ValueError(str(path) + " is not a roboarm trace")
+        offset = len(MAGIC)
+        size = struct.unpack_from("<I", buf, offset)[0]
+        offset += 4
+        self.header = json.loads(buf[offset:offset + size].decode("utf-8"))
+        offset += size
+        names = {}
+        self.records = []
+        now = 0.0
+        end = len(buf)
+        while offset < end:
+            op, key_id = _key.unpack_from(buf, offset)
+            if op == OP_KEY:
+                size = struct.unpack_from("<H", buf, offset + 3)[0]
+                names[key_id] = buf[offset + 5:offset + 5 + size].decode("utf-8")
+                offset += 5 + size
+                continue
+            delta = _record.unpack_from(buf, offset)[2]
+            offset += _record.size
+            value, offset = decode_value(buf, offset)
+            now += delta / 1000000.0
+            self.records.append((now, op, names[key_id], value))
+        self.duration = now
+        self.size = len(buf)
+
+    def index(self):
+        # key -> (times, values) of its reads, address -> construction outcomes,
+        # key -> times of its writes and calls
+        reads = {}
+        news = {}
+        commands = {}
+        for stamp, op, key, value in self.records:
+            if op == OP_READ:
+                entry = reads.setdefault(key, ([], []))
+                entry[0].append(stamp)
+                entry[1].append(value)
+            elif op == OP_NEW:
+                news.setdefault(key, []).append(value)
+            else:
+                commands.setdefault(key, []).append(stamp)
+        return reads, news, commands
+
+    def summary(self):
+        counts = {}
+        for _, op, key, _ in self.records:
+            name = {OP_NEW: "new", OP_READ: "read", OP_WRITE: "write", OP_CALL: "call"}[op]
+            counts.setdefault(key, {}).setdefault(name, 0)
+            counts[key][name] += 1
+        return {"header": self.header,
+                "records": len(self.records),
+                "bytes": self.size,
+                "duration": self.duration,
+                "keys": counts}
+
+
+# -- replay backend --------------------------------------------------------
+
+replay_clock = SimClock()
+time = SimTime(replay_clock)
+
+
+class Replay:
+    # Reads return the value recorded last before the current trace time.
+    # Trace time follows the virtual clock and is re-aligned on every motor
+    # command or attribute write to the time that command had in the trace,
+    # so idle gaps (e.g. waiting for /initialize/) do not shift the replay.
+    # Values recorded before the last such command are never returned after it.
+
+    def __init__(self, trace, io_latency=roboarmsim.IO_LATENCY):
+        self.trace = trace
+        self.reads, self.news, self.commands = trace.index()
+        self.constructed = {}
+        self.cursor = {}
+        self.origin = None
+        self.sync = 0.0
+        self.misses = 0
+        self.commands_replayed = 0
+        self.commands_unmatched = 0
+        replay_clock.io_latency = io_latency
+        replay_clock.speedup = None
+        replay_clock.reset(trace.header.get("start", 0.0))
+
+    def elapsed(self):
+        if self.origin is None:
+            return 0.0
+        return replay_clock.time() - self.origin
+
+    def construct(self, address):
+        if self.origin is None:
+            # the trace starts with the first device access
+            self.origin = replay_clock.time()
+        replay_clock.io()
+        outcomes = self.news.get(address)
+        if not outcomes:
+            # traces of a forked child have no construction records
+            prefix = address + "."
+            if any(key.startswith(prefix) for key in self.reads):
+                return
+            raise DeviceNotFound("no device " + str(address) + " in trace")
+        count = self.constructed.get(address, 0)
+        self.constructed[address] = count + 1
+        outcome = outcomes[min(count, len(outcomes) - 1)]
+        if isinstance(outcome, Exception):
+            raise DeviceNotFound(str(outcome))
+
+    def command(self, key):
+        replay_clock.io()
+        self.commands_replayed += 1
+        times = self.commands.get(key, ())
+        index = self.cursor.get(key, 0)
+        if index >= len(times):
+            self.commands_unmatched += 1
+            return
+        self.cursor[key] = index + 1
+        self.sync = times[index]
+        self.origin = replay_clock.time() - self.sync
+
+    def read(self, key):
+        replay_clock.io()
+        entry = self.reads.get(key)
+        if entry is None:
+            self.misses += 1
+            raise ReplayMiss("no recorded reads of " + key)
+        times, values = entry
+        index = max(bisect.bisect_right(times, self.elapsed()) - 1,
+                    bisect.bisect_left(times, self.sync))
+        value = values[max(0, min(index, len(values) - 1))]
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+replay = None
+
+
+def load_replay(path, io_latency=roboarmsim.IO_LATENCY):
+    global replay
+    replay = Replay(Trace(path), io_latency)
+    _export_ports(replay.trace.header.get("ports", {}))
+    return replay
+
+
+def _export_ports(ports):
+    # the port names the trace was recorded with (e.g. "spi0.1:MA" on a BrickPi3)
+    module = sys.modules[__name__]
+    for name in ports:
+        setattr(module, name, ports[name])
+
+
+def _command(name):
+
+    def call(self, *args, **kwargs):
+        replay.command(self._address + "." + name)
+    call.__name__ = name
+    return call
+
+
+class ReplayDevice(object):
+
+    def __init__(self, address=None, *args, **kwargs):
+        object.__setattr__(self, "_address", str(address))
+        replay.construct(self._address)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return replay.read(self._address + "." + name)
+
+    def __setattr__(self, name, value):
+        replay.command(self._address + "." + name)
+
+    run_forever = _command("run_forever")
+    run_to_abs_pos = _command("run_to_abs_pos")
+    run_to_rel_pos = _command("run_to_rel_pos")
+    run_timed = _command("run_timed")
+    run_direct = _command("run_direct")
+    stop = _command("stop")
+    reset = _command("reset")
+
+    def value(self, *args):
+        return replay.read(read_call_key(self._address, "value", args))
+
+    def bin_data(self, *args):
+        return replay.read(read_call_key(self._address, "bin_data", args))
+
+
+class Motor(ReplayDevice):
+    COMMAND_RUN_FOREVER = roboarmsim.Motor.COMMAND_RUN_FOREVER
+    COMMAND_RUN_TO_ABS_POS = roboarmsim.Motor.COMMAND_RUN_TO_ABS_POS
+    COMMAND_RUN_TO_REL_POS = roboarmsim.Motor.COMMAND_RUN_TO_REL_POS
+    COMMAND_RUN_TIMED = roboarmsim.Motor.COMMAND_RUN_TIMED
+    COMMAND_STOP = roboarmsim.Motor.COMMAND_STOP
+    COMMAND_RESET = roboarmsim.Motor.COMMAND_RESET
+    POLARITY_NORMAL = roboarmsim.Motor.POLARITY_NORMAL
+    POLARITY_INVERSED = roboarmsim.Motor.POLARITY_INVERSED
+    STATE_RUNNING = roboarmsim.Motor.STATE_RUNNING
+    STATE_RAMPING = roboarmsim.Motor.STATE_RAMPING
+    STATE_HOLDING = roboarmsim.Motor.STATE_HOLDING
+    STATE_OVERLOADED = roboarmsim.Motor.STATE_OVERLOADED
+    STATE_STALLED = roboarmsim.Motor.STATE_STALLED
+    STOP_ACTION_COAST = roboarmsim.Motor.STOP_ACTION_COAST
+    STOP_ACTION_BRAKE = roboarmsim.Motor.STOP_ACTION_BRAKE
+    STOP_ACTION_HOLD = roboarmsim.Motor.STOP_ACTION_HOLD
+
+
+class LargeMotor(Motor):
+    pass
+
+
+class MediumMotor(Motor):
+    pass
+
+
+class Sensor(ReplayDevice):
+    pass
+
+
+class TouchSensor(Sensor):
+    MODE_TOUCH = roboarmsim.TouchSensor.MODE_TOUCH
+
+
+class ColorSensor(Sensor):
+    MODE_COL_REFLECT = roboarmsim.ColorSensor.MODE_COL_REFLECT
+    MODE_COL_AMBIENT = roboarmsim.ColorSensor.MODE_COL_AMBIENT
+    MODE_COL_COLOR = roboarmsim.ColorSensor.MODE_COL_COLOR
+
+
+class LegoPort(ReplayDevice):
+    pass
+
+
+class PowerSupply(ReplayDevice):
+    pass
+
+
+if os.environ.get("ROBOARM_BACKEND") == "replay" and os.environ.get("ROBOARM_REPLAY") and replay is None:
+    load_replay(os.environ["ROBOARM_REPLAY"])
+
+
+def replay_run(path, script, moves, io_latency):
+    import importlib
+
+    os.environ["ROBOARM_BACKEND"] = "replay"
+    state = load_replay(path, io_latency)
+    module = importlib.import_module(script)
+    logging.getLogger().setLevel(logging.WARNING)
+    result = {"script": script, "trace": path}
+    wall = _walltime.perf_counter()
+    arm = module.LegoRoboArm()
+    tic = time.time()
+    arm.initialize()
+    result["initialize_seconds"] = time.time() - tic
+    move_times = []
+    for move in range(moves):
+        tic = time.time()
+        arm.move(1 if move % 2 == 0 else -1)
+        move_times.append(time.time() - tic)
+    result["move_seconds"] = move_times
+    result["wall_seconds"] = _walltime.perf_counter() - wall
+    result["trace_seconds"] = state.trace.duration
+    result["misses"] = state.misses
+    result["commands"] = state.commands_replayed
+    result["commands_unmatched"] = state.commands_unmatched
+    return result
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Robot Arm H25 device I/O traces")
+    commands = parser.add_subparsers(dest="command")
+    summary = commands.add_parser("summary", help="print the contents of a trace")
+    summary.add_argument("trace")
+    run = commands.add_parser("replay", help="re-execute initialize() and move() against a trace")
+    run.add_argument("trace")
+    run.add_argument("--script", default="legoroboarmtornadoBPv5")
+    run.add_argument("--moves", type=int, default=2)
+    run.add_argument("--io-latency", type=float, default=roboarmsim.IO_LATENCY)
+    args = parser.parse_args(argv)
+    if args.command == "summary":
+        print(json.dumps(Trace(args.trace).summary(), indent=2, sort_keys=True))
+    elif args.command == "replay":
+        # run in the importable module, which is the one the script's star import sees
+        import roboarmtrace
+        result = roboarmtrace.replay_run(args.trace, args.script, args.moves, args.io_latency)
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# Lightweight latency tracing for the Robot Arm controller.
+#
+# Spans are opened with "with span(name):" or the @traced decorator and nest
+# through a per-thread context. The context of a request is handed explicitly
+# to the supervisor thread and the forked movement processes (current() and
+# attach()), so one trace goes from the tornado handler down to the motion
+# primitives running in another process.
+#
+# Finished spans are kept in a bounded in-memory buffer; child processes send
+# theirs to the parent through a multiprocessing queue. chrome_trace() exports
+# the buffer in Chrome trace-event format (chrome://tracing, Perfetto).
+#
+
+import collections
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 20000         # spans kept in memory
+QUEUE_SIZE = 5000           # spans in flight from the child processes
+
+# clock of the spans; the scripts set it to the time of their hardware backend
+clock = time
+
+_buffer = collections.deque(maxlen=BUFFER_SIZE)
+_local = threading.local()
+_ids = itertools.count(1)
+_queue = None
+_owner = os.getpid()
+dropped = 0
+
+
+class Span:
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "pid", "tid", "thread", "args")
+
+    def __init__(self, name, trace_id, parent_id, args):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%x-%x" % (os.getpid(), next(_ids))
+        self.parent_id = parent_id
+        self.pid = os.getpid()
+        self.tid = threading.current_thread().ident
+        self.thread = threading.current_thread().name
+        self.args = args
+        self.end = None
+        self.start = clock.time()
+
+    def as_tuple(self):
+        return (self.name, self.trace_id, self.span_id, self.parent_id, self.start, self.end,
+                self.pid, self.tid, self.thread, self.args)
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def current():
+    # (trace_id, span_id) to hand to another thread or process, or None
+    stack = _stack()
+    if stack:
+        return stack[-1].trace_id, stack[-1].span_id
+    return getattr(_local, "attached", None)
+
+
+def attach(context):
+    # continue the trace of context in this thread (also drops the spans a
+    # forked process inherited from the thread that forked it)
+    _local.stack = []
+    _local.attached = context
+
+
+def start_span(name, **args):
+    parent = current()
+    if parent is None:
+        trace_id = "%016x" % random.getrandbits(64)
+        parent_id = None
+    else:
+        trace_id, parent_id = parent
+    new = Span(name, trace_id, parent_id, args)
+    _stack().append(new)
+    return new
+
+
+def end_span(finished):
+    finished.end = clock.time()
+    stack = _stack()
+    if finished in stack:
+        stack.remove(finished)
+    _record(finished.as_tuple())
+
+
+class span:
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.span = None
+
+    def __enter__(self):
+        self.span = start_span(self.name, **self.args)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.span.args["error"] = exc_type.__name__
+        end_span(self.span)
+        return False
+
+
+def traced(name=None):
+
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _record(item):
+    global dropped
+    if os.getpid() == _owner:
+        _buffer.append(item)
+    elif _queue is not None:
+        try:
+            _queue.put_nowait(item)
+        except Exception:
+            dropped += 1
+
+
+def share():
+    # call in the web process before forking the movement processes
+    global _queue
+    if _queue is None and os.getpid() == _owner:
+        _queue = multiprocessing.Queue(QUEUE_SIZE)
+        collector = threading.Thread(target=_collect, name="roboarm-tracing")
+        collector.daemon = True
+        collector.start()
+
+
+def _collect():
+    while True:
+        try:
+            _buffer.append(_queue.get())
+        except Exception:
+            logger.error("[TRACING] collector error", exc_info=True)
+            time.sleep(1)
+
+
+def clear():
+    _buffer.clear()
+
+
+def chrome_trace():
+    events = []
+    spans = list(_buffer)
+    by_id = dict((item[2], item) for item in spans)
+    for name, trace_id, span_id, parent_id, start, end, pid, tid, thread, args in spans:
+        event_args = dict(args)
+        event_args["trace_id"] = trace_id
+        event_args["span_id"] = span_id
+        if parent_id:
+            event_args["parent_id"] = parent_id
+        events.append({"name": name, "cat": "roboarm", "ph": "X",
+                       "ts": int(start * 1000000), "dur": int((end - start) * 1000000),
+                       "pid": pid, "tid": tid, "args": event_args})
+        parent = by_id.get(parent_id)
+        if parent is not None and (parent[6], parent[7]) != (pid, tid):
+            # arrow from the parent span to a child running in another thread or process
+            events.append({"name": "handoff", "cat": "roboarm", "ph": "s", "id": span_id,
+                           "ts": int(start * 1000000), "pid": parent[6], "tid": parent[7]})
+            events.append({"name": "handoff", "cat": "roboarm", "ph": "f", "bp": "e", "id": span_id,
+                           "ts": int(start * 1000000), "pid": pid, "tid": tid})
+    threads = set((item[6], item[7], item[8]) for item in spans)
+    for pid, tid, thread in threads:
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+    return {"traceEvents": events, "displayTimeUnit": "ms",
+            "otherData": {"spans": len(spans), "buffer_size": BUFFER_SIZE, "dropped": dropped}}
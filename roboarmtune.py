@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# Auto-tuner of the Robot Arm movement parameters (axis speeds).
+#
+# Runs move() trials with different speeds on the real arm or on the simulated
+# hardware (--sim) and measures, for every setting, the cycle time, the
+# positioning error of the base and lift at the stations and the overloads,
+# timeouts and watchdog faults. The fastest setting without any of those and
+# with the station error under --max-station-error is saved to the tuning
+# file, which legoroboarmtornadoBPv5.py loads at start.
+#
+# BASE_EXTRA moves the stations themselves (gear slop), so it is not searched:
+# the value given with --base-extra (default the script's) is saved with the
+# speeds.
+#
+# Usage:
+#    python3 roboarmtune.py --sim
+#    python3 roboarmtune.py --search grid --cycles 6 --output roboarm_tuning.json
+#
+
+import argparse
+import importlib
+import itertools
+import json
+import logging
+import os
+import sys
+import time as walltime
+
+import roboarmmetrics
+
+PARAMETERS = ("speed_base", "speed_lift", "speed_grab_close", "speed_grab_open", "base_extra")
+
+# values tried for every searched parameter
+SEARCH_SPACE = (("speed_base", (150, 250, 350, 450, 600)),
+                ("speed_lift", (150, 250, 350, 450, 600)),
+                ("speed_grab_open", (400, 600, 800, 1000)))
+
+MAX_STATION_ERROR = 10      # tacho counts
+
+logger = logging.getLogger(__name__)
+
+
+def load(path):
+    # tuned parameters saved by save(), {} when there are none
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as tuning_file:
+            data = json.load(tuning_file)
+        return dict((name, value) for name, value in data["parameters"].items() if name in PARAMETERS)
+    except (IOError, OSError, ValueError, KeyError, AttributeError):
+        logger.error("[TUNING] ignoring unreadable " + path + " - " + str(sys.exc_info()[1]))
+        return {}
+
+
+def save(path, parameters, result, backend):
+    data = {"parameters": parameters,
+            "cycle_seconds": result["cycle_seconds"],
+            "cycles_per_hour": 3600.0 / result["cycle_seconds"],
+            "station_error": result["station_error"],
+            "backend": backend,
+            "created": walltime.strftime("%Y-%m-%dT%H:%M:%S")}
+    tmp = path + ".tmp"
+    with open(tmp, "w") as output:
+        json.dump(data, output, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+class Tuner:
+
+    def __init__(self, module, arm, cycles, max_station_error=MAX_STATION_ERROR):
+        self.module = module
+        self.arm = arm
+        self.cycles = cycles
+        self.max_station_error = max_station_error
+        self.results = {}
+        self.station_errors = []
+        self._watch_station(arm, "base_motor_to_position", arm.base_motor)
+        self._watch_station(arm, "lift_move_pos", arm.lift_motor)
+
+    def _watch_station(self, arm, name, motor):
+        # record how far the motor ends from the position it was sent to
+        move_to = getattr(arm, name)
+
+        def watched(speed, position, timeout=None, **kwargs):
+            # both primitives move with normal polarity, the lift may be inversed before
+            start = motor.position
+            if motor.polarity == motor.POLARITY_INVERSED:
+                start = -start
+            result = move_to(speed, position, timeout, **kwargs)
+            self.station_errors.append(abs(motor.position - (start + position)))
+            return result
+        setattr(arm, name, watched)
+
+    def faults(self):
+        total = 0
+        arm = self.arm.arm_label
+        for axis in roboarmmetrics.AXES:
+            total += roboarmmetrics.OVERLOADS.get(arm, axis) + roboarmmetrics.TIMEOUTS.get(arm, axis) \
+                + roboarmmetrics.WATCHDOG_FAULTS.get(arm, axis)
+        return total
+
+    def recover(self):
+        # brake everything and home again after a failed trial
+        for motor in (self.arm.base_motor, self.arm.lift_motor, self.arm.grab_motor):
+            motor.stop_action = motor.STOP_ACTION_BRAKE
+            motor.stop()
+        self.arm.watchdog.fault = None
+        self.arm.initialize()
+
+    def trial(self, parameters):
+        key = tuple(sorted(parameters.items()))
+        if key in self.results:
+            return self.results[key]
+        self.arm.apply_tuning(parameters)
+        del self.station_errors[:]
+        faults = self.faults()
+        clock = self.module.time
+        times = []
+        error = None
+        for cycle in range(self.cycles):
+            tic = clock.time()
+            try:
+                self.arm.move(1 if cycle % 2 == 0 else -1)
+            except (Exception, SystemExit):
+                error = str(sys.exc_info()[1]) or sys.exc_info()[0].__name__
+                break
+            times.append(clock.time() - tic)
+        faults = int(self.faults() - faults)
+        result = {"parameters": dict(parameters),
+                  "cycle_seconds": sum(times) / len(times) if times else None,
+                  "station_error": max(self.station_errors) if self.station_errors else None,
+                  "faults": faults,
+                  "error": error}
+        result["safe"] = error is None and faults == 0 and times != [] \
+            and result["station_error"] is not None and result["station_error"] <= self.max_station_error
+        if error is not None or faults:
+            self.recover()
+        elif self.cycles % 2:
+            # leave the base in the center for the next trial
+            self.arm.move(-1)
+        self.results[key] = result
+        print("%-70s %8s %6s %6s %s" % (json.dumps(dict((name, parameters[name]) for name, values in SEARCH_SPACE)),
+                                        "%.2f" % result["cycle_seconds"] if times else "-",
+                                        result["station_error"], faults, "safe" if result["safe"] else error or "UNSAFE"))
+        return result
+
+    def better(self, result, best):
+        return result["safe"] and (best is None or result["cycle_seconds"] < best["cycle_seconds"])
+
+    def coordinate_search(self, start, space):
+        # one parameter at a time, keeping the best value found for the others
+        best = self.trial(start)
+        if not best["safe"]:
+            best = None
+        current = dict(start)
+        for name, values in space:
+            for value in values:
+                candidate = dict(current)
+                candidate[name] = value
+                result = self.trial(candidate)
+                if self.better(result, best):
+                    best = result
+            if best is not None:
+                current = dict(best["parameters"])
+        return best
+
+    def grid_search(self, start, space):
+        best = None
+        names = [name for name, values in space]
+        for values in itertools.product(*[values for name, values in space]):
+            candidate = dict(start)
+            candidate.update(zip(names, values))
+            result = self.trial(candidate)
+            if self.better(result, best):
+                best = result
+        return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Robot Arm H25 movement parameter tuner")
+    parser.add_argument("--sim", action="store_true", help="tune against the simulated hardware")
+    parser.add_argument("--script", default="legoroboarmtornadoBPv5", help="controller module")
+    parser.add_argument("--search", default="coordinate", choices=["coordinate", "grid"])
+    parser.add_argument("--cycles", type=int, default=4, help="move() cycles per setting")
+    for name, values in SEARCH_SPACE:
+        parser.add_argument("--" + name.replace("_", "-"), type=int, nargs="+", default=list(values),
+                            help="values tried (default %(default)s)")
+    parser.add_argument("--base-extra", type=float, help="BASE_EXTRA saved with the speeds (default the script's)")
+    parser.add_argument("--max-station-error", type=int, default=MAX_STATION_ERROR,
+                        help="largest safe positioning error (tacho counts)")
+    parser.add_argument("--no-watchdog", action="store_true", help="do not run the stall watchdog in the trials")
+    parser.add_argument("--output", help="tuning file to write (default the script's TUNING_FILE)")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args(argv)
+
+    if args.sim:
+        os.environ["ROBOARM_BACKEND"] = "sim"
+    module = importlib.import_module(args.script)
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+    output = args.output or module.TUNING_FILE
+    space = [(name, getattr(args, name)) for name, values in SEARCH_SPACE]
+
+    arm = module.LegoRoboArm()
+    if args.base_extra is not None:
+        arm.apply_tuning({"base_extra": args.base_extra})
+    # the watchdog samples on the wall clock, which the virtual clock of the simulator outruns
+    if not args.no_watchdog and not args.sim:
+        arm.watchdog.start()
+    arm.initialize()
+    tuner = Tuner(module, arm, args.cycles, args.max_station_error)
+    print("%-70s %8s %6s %6s %s" % ("setting", "cycle s", "error", "faults", "result"))
+    if args.search == "grid":
+        best = tuner.grid_search(arm.tuning(), space)
+    else:
+        best = tuner.coordinate_search(arm.tuning(), space)
+    arm.watchdog.stop()
+    if best is None:
+        print("no safe setting found, " + output + " not written")
+        return 1
+    save(output, best["parameters"], best, os.environ.get("ROBOARM_BACKEND", "ev3dev"))
+    print("fastest safe setting: " + json.dumps(best["parameters"], sort_keys=True) +
+          " - %.2f s per cycle (%.0f cycles per hour), saved to %s"
+          % (best["cycle_seconds"], 3600.0 / best["cycle_seconds"], output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
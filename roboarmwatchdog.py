@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Stall / overload watchdog for the Robot Arm motors.
+#
+# The motion primitives only look at the motor state in their own wait loops,
+# and some of them (base_motor_touch, lift_move_pos) not at all, so a jammed
+# axis could push against the obstacle until WHILE_LOOP_TIMEOUT. The watchdog
+# is a thread that samples the state of every motor at a fixed rate (and speed
+# and duty cycle of the running ones). When an axis stays stalled or
+# overloaded for STALL_SAMPLES samples, it brakes that axis, records the fault
+# and calls back into the controller; the wait loops then raise MotorFault
+# through check().
+#
+# Sampling is paced on the wall clock; the timestamps (and so the reaction
+# time) use the clock given to the watchdog, the time of the hardware backend.
+#
+
+import contextlib
+import logging
+import threading
+import time
+
+import roboarmmetrics
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 50            # samples per second of every motor
+STALL_SAMPLES = 2           # consecutive bad samples before the axis is braked
+STALL_DUTY = 80             # |duty cycle| (%) of a motor pushing hard
+STALL_SPEED = 20            # |speed| (tacho counts/s) under which a pushing motor is not moving
+
+
+class MotorFault(Exception):
+
+    def __init__(self, axis, reason):
+        Exception.__init__(self, axis + " motor " + reason)
+        self.axis = axis
+        self.reason = reason
+
+
+class Watchdog:
+
+    def __init__(self, motors, on_fault=None, clock=time, rate=SAMPLE_RATE, arm=roboarmmetrics.DEFAULT_ARM):
+        # motors: {axis name: motor}
+        self.motors = motors
+        self.arm = arm
+        self.on_fault = on_fault
+        self.clock = clock
+        self.interval = 1.0 / rate
+        self.fault = None
+        self.suspended = set()
+        self.bad_samples = dict.fromkeys(motors, 0)
+        self.last_good = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # clears a previous fault; a no-op when it is already running
+        self.fault = None
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.bad_samples = dict.fromkeys(self.motors, 0)
+        self.last_good = {}
+        self.thread = threading.Thread(target=self._run, name="roboarm-watchdog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def check(self):
+        # called from the motion wait loops
+        if self.fault is not None:
+            raise self.fault
+
+    @contextlib.contextmanager
+    def expect_stall(self, axis):
+        # for moves that drive an axis against its end stop on purpose
+        self.suspended.add(axis)
+        try:
+            yield
+        finally:
+            self.suspended.discard(axis)
+            self.bad_samples[axis] = 0
+            self.last_good.pop(axis, None)
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except Exception:
+                logger.error("[WATCHDOG] sample error", exc_info=True)
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                roboarmmetrics.WATCHDOG_OVERRUNS.inc()
+                deadline = time.monotonic()
+                delay = 0
+            self.stopped.wait(delay)
+
+    def sample(self):
+        roboarmmetrics.WATCHDOG_SAMPLES.inc()
+        for axis, motor in self.motors.items():
+            if axis in self.suspended or self.fault is not None:
+                continue
+            reason = self.diagnose(motor)
+            now = self.clock.time()
+            if reason is None:
+                self.bad_samples[axis] = 0
+                self.last_good[axis] = now
+                continue
+            self.bad_samples[axis] += 1
+            if self.bad_samples[axis] >= STALL_SAMPLES:
+                self.trip(axis, motor, reason, self.last_good.get(axis, now))
+
+    def diagnose(self, motor):
+        state = motor.state
+        if motor.STATE_OVERLOADED in state:
+            return "overloaded"
+        if motor.STATE_STALLED in state:
+            return "stalled"
+        if motor.STATE_RUNNING in state and motor.STATE_RAMPING not in state:
+            if abs(motor.duty_cycle) >= STALL_DUTY and abs(motor.speed) < STALL_SPEED:
+                return "not turning at full duty cycle"
+        return None
+
+    def trip(self, axis, motor, reason, last_good):
+        motor.stop_action = motor.STOP_ACTION_BRAKE
+        motor.stop()
+        reaction = self.clock.time() - last_good
+        self.fault = MotorFault(axis, reason)
+        roboarmmetrics.WATCHDOG_FAULTS.inc(self.arm, axis)
+        roboarmmetrics.WATCHDOG_REACTION.observe(reaction)
+        logger.error("[WATCHDOG] " + axis + " motor " + reason + ", braked in " + str(round(reaction * 1000)) + " ms")
+        if self.on_fault is not None:
+            self.on_fault(self.fault)
@@ -0,0 +1,8 @@
+# The tests run against the simulated hardware backend (roboarmsim.py), from
+# the repository root: python -m pytest tests
+
+import os
+import sys
+
+os.environ.setdefault("ROBOARM_BACKEND", "sim")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,133 @@
+import threading
+import time as walltime
+
+import pytest
+
+import roboarmbus
+import roboarmmetrics
+import roboarmsim
+
+TIMEOUT = 10
+
+
+@pytest.fixture
+def bus():
+    roboarmsim.reset_world()
+    namespace = {"LargeMotor": roboarmsim.LargeMotor, "Sensor": roboarmsim.Sensor}
+    bus = roboarmbus.install(namespace)
+    bus.lift = namespace["LargeMotor"]("outB")
+    bus.light = namespace["Sensor"]("in1")
+    bus.temperature = namespace["Sensor"]("in3")
+    roboarmbus.set_priority(bus.temperature, roboarmbus.TELEMETRY)
+    # the simulated SPI bus holds every transaction for 1 ms (ROBOARM_SIM_SPI=0.001),
+    # counted from here: one per device access
+    roboarmsim.world.bus = roboarmsim.SimBus(0.001)
+    return bus
+
+
+def queue(bus, *accesses):
+    # hold the bus with a pass of its own while the accesses (functions) are
+    # submitted one after the other from threads, then let them run in one pass;
+    # returns their results
+    release = threading.Event()
+    blocker = threading.Thread(target=bus.transfer, args=(roboarmbus.MOTION, None, lambda: release.wait(TIMEOUT)))
+    blocker.start()
+    wait_for(lambda: bus.serving)
+    results = [None] * len(accesses)
+    threads = []
+    for index, access in enumerate(accesses):
+        thread = threading.Thread(target=lambda index=index, access=access: results.__setitem__(index, access()))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: len(bus.pending) == index + 1)
+    release.set()
+    for thread in [blocker] + threads:
+        thread.join(TIMEOUT)
+    return results
+
+
+def wait_for(condition):
+    deadline = walltime.monotonic() + TIMEOUT
+    while not condition():
+        assert walltime.monotonic() < deadline
+        walltime.sleep(0.001)
+
+
+def test_accesses_during_a_pass_are_batched_into_the_next_one(bus):
+    passes = roboarmmetrics.BUS_PASSES.get()
+    queue(bus, lambda: bus.lift.position, lambda: bus.light.value(0), lambda: bus.temperature.value(),
+          lambda: setattr(bus.lift, "speed_sp", 100))
+    assert roboarmmetrics.BUS_PASSES.get() == passes + 2
+    assert roboarmsim.world.bus.transactions == 4
+    assert roboarmsim.world.bus.collisions == 0
+
+
+def test_identical_reads_of_a_pass_share_a_transaction(bus):
+    shared = roboarmmetrics.BUS_SHARED_READS.get("motion")
+    results = queue(bus, lambda: bus.light.value(0), lambda: bus.light.value(0), lambda: bus.light.value(0),
+                    lambda: bus.lift.position)
+    assert roboarmsim.world.bus.transactions == 2
+    assert results[0] == results[1] == results[2]
+    assert roboarmmetrics.BUS_SHARED_READS.get("motion") == shared + 2
+
+
+def test_a_write_ends_the_sharing_of_the_reads_before_it(bus):
+    results = queue(bus, lambda: bus.lift.position, lambda: bus.lift.position,
+                    lambda: setattr(bus.lift, "position", 500), lambda: bus.lift.position)
+    assert roboarmsim.world.bus.transactions == 3
+    assert results[0] == results[1] != 500
+    assert results[3] == 500
+
+
+def test_errors_are_shared_with_the_identical_reads(bus):
+    def failing():
+        raise IOError("no reading")
+
+    key = ("in1", "value", (0,))
+    results = queue(bus, lambda: pytest.raises(IOError, bus.transfer, roboarmbus.MOTION, key, failing),
+                    lambda: pytest.raises(IOError, bus.transfer, roboarmbus.MOTION, key, lambda: 0))
+    assert all(result.value.args == ("no reading",) for result in results)
+
+
+def test_motion_accesses_go_first_in_a_pass(bus):
+    order = []
+    queue(bus, lambda: bus.transfer(roboarmbus.TELEMETRY, None, lambda: order.append("telemetry")),
+          lambda: bus.transfer(roboarmbus.MOTION, None, lambda: order.append("motion 1")),
+          lambda: bus.transfer(roboarmbus.TELEMETRY, None, lambda: order.append("telemetry 2")),
+          lambda: bus.transfer(roboarmbus.MOTION, None, lambda: order.append("motion 2")))
+    assert order == ["motion 1", "motion 2", "telemetry", "telemetry 2"]
+
+
+def test_a_telemetry_pass_gives_way_to_a_waiting_motion_pass(bus):
+    # a motion pass of another process waits for the bus for longer than MAX_DEFER
+    bus._motion_waiting.value = walltime.monotonic() + 1.0
+    tic = walltime.monotonic()
+    bus.temperature.value()
+    deferred = walltime.monotonic() - tic
+    assert roboarmbus.MAX_DEFER <= deferred < 0.5
+    tic = walltime.monotonic()
+    bus.light.value(0)
+    assert walltime.monotonic() - tic < roboarmbus.MAX_DEFER
+    # and a motion pass that got the bus clears it
+    assert bus._motion_waiting.value == 0.0
+
+
+def test_threads_never_overlap_on_the_bus(bus):
+    stop = walltime.monotonic() + 0.3
+
+    def motion():
+        while walltime.monotonic() < stop:
+            bus.lift.position
+            bus.light.value(0)
+
+    def telemetry():
+        while walltime.monotonic() < stop:
+            bus.temperature.value()
+
+    threads = [threading.Thread(target=motion) for _ in range(3)] + [threading.Thread(target=telemetry)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert roboarmsim.world.bus.transactions > 0
+    assert roboarmsim.world.bus.collisions == 0
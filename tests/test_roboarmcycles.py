@@ -0,0 +1,73 @@
+import pytest
+
+import roboarmcycles
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = roboarmcycles.Store(str(tmp_path / "roboarm_cycles.db"))
+    store.connection = store._connect()
+    yield store
+    store.connection.close()
+
+
+def cycle(started, arm="arm", outcome=roboarmcycles.COMPLETED, seconds=10.0, overloads=0):
+    cycle = roboarmcycles.Cycle(arm, 1, started, 22.0)
+    cycle.outcome = outcome
+    cycle.seconds = seconds
+    cycle.overloads = overloads
+    return cycle
+
+
+def minute(index, second=0):
+    return 60 * index + second
+
+
+def test_the_counts_of_a_window(store):
+    store._insert(store.connection, [cycle(minute(10)), cycle(minute(10, 30)), cycle(minute(11), overloads=1),
+                                     cycle(minute(12), outcome=roboarmcycles.FAULT)])
+    stats = store.stats(minute(10), minute(12))
+    assert (stats["cycles"], stats["completed"], stats["failures"], stats["overloads"]) == (3, 3, 1, 1)
+    assert stats["cycles_per_hour"] == 3 * 30
+    assert stats["failure_rate"] == pytest.approx(1 / 3.0)
+    assert stats["utilization"] == pytest.approx(30 / 120.0)
+    assert store.stats(minute(12), minute(13))["failures"] == 1
+    assert store.stats(minute(20), minute(30))["failure_rate"] is None
+
+
+def test_the_windows_are_whole_minutes(store):
+    store._insert(store.connection, [cycle(minute(10, 59))])
+    stats = store.stats(minute(10, 30), minute(10, 40))
+    assert (stats["since"], stats["until"], stats["cycles"]) == (minute(10), minute(11), 1)
+
+
+def test_a_late_batch_updates_the_running_totals_after_it(store):
+    store._insert(store.connection, [cycle(minute(10)), cycle(minute(20))])
+    # another process flushes a cycle of an earlier minute, new and existing buckets
+    store._insert(store.connection, [cycle(minute(5))])
+    store._insert(store.connection, [cycle(minute(10, 20))])
+    assert store.stats(minute(0), minute(30))["cycles"] == 4
+    assert store.stats(minute(0), minute(6))["cycles"] == 1
+    assert store.stats(minute(6), minute(15))["cycles"] == 2
+    assert store.stats(minute(15), minute(30))["cycles"] == 1
+    totals = store.connection.execute("SELECT bucket, total_cycles FROM rollup_minute ORDER BY bucket").fetchall()
+    assert totals == [(5, 1), (10, 3), (20, 4)]
+    hours = store.connection.execute("SELECT bucket, cycles, total_cycles FROM rollup_hour").fetchall()
+    assert hours == [(0, 4, 4)]
+
+
+def test_the_arms_are_counted_apart_and_together(store):
+    store._insert(store.connection, [cycle(minute(10), "left"), cycle(minute(11), "right"),
+                                     cycle(minute(12), "right", outcome=roboarmcycles.STOPPED)])
+    assert store.arms() == ["left", "right"]
+    assert store.stats(minute(0), minute(30), "left")["cycles"] == 1
+    assert store.stats(minute(0), minute(30), "right")["completed"] == 1
+    assert store.stats(minute(0), minute(30))["cycles"] == 3
+
+
+def test_the_series_of_a_rollup(store):
+    store._insert(store.connection, [cycle(minute(10), "left"), cycle(minute(10, 5), "right"), cycle(minute(12))])
+    series = store.stats(minute(10), minute(13), step="minute")["series"]
+    assert [(point["start"], point["cycles"]) for point in series] == [(minute(10), 2), (minute(12), 1)]
+    series = store.series(minute(10), minute(13), "left", "minute")
+    assert [(point["start"], point["cycles"]) for point in series] == [(minute(10), 1)]
@@ -0,0 +1,66 @@
+import multiprocessing
+
+import roboarmmetrics
+
+fork = multiprocessing.get_context("fork")
+
+
+def count(times):
+    for _ in range(times):
+        roboarmmetrics.WATCHDOG_SAMPLES.inc()
+        roboarmmetrics.WATCHDOG_REACTION.observe(0.015)
+
+
+def count_forever(started):
+    started.set()
+    while True:
+        roboarmmetrics.WATCHDOG_SAMPLES.inc()
+
+
+def test_the_counts_of_the_processes_are_summed():
+    before = roboarmmetrics.WATCHDOG_SAMPLES.get()
+    children = [fork.Process(target=count, args=(1000,)) for _ in range(3)]
+    for child in children:
+        child.start()
+    count(10)
+    for child in children:
+        child.join()
+    assert roboarmmetrics.WATCHDOG_SAMPLES.get() == before + 3010
+    text = roboarmmetrics.exposition()
+    assert "roboarm_watchdog_samples_total " + str(int(before) + 3010) + "\n" in text
+
+
+def test_a_terminated_child_does_not_block_the_others():
+    # more children than segments: the segments of the terminated ones are taken again
+    for _ in range(roboarmmetrics.PROCESSES + 4):
+        started = fork.Event()
+        child = fork.Process(target=count_forever, args=(started,))
+        child.start()
+        assert started.wait(10)
+        child.terminate()
+        child.join()
+        before = roboarmmetrics.WATCHDOG_SAMPLES.local()
+        roboarmmetrics.WATCHDOG_SAMPLES.inc()
+        assert roboarmmetrics.WATCHDOG_SAMPLES.local() == before + 1
+        roboarmmetrics.exposition()
+
+
+def test_gauges_keep_the_last_value_set():
+    arm = roboarmmetrics.DEFAULT_ARM
+    child = fork.Process(target=roboarmmetrics.THERMAL_THROTTLE.set, args=(0.25, arm))
+    child.start()
+    child.join()
+    assert roboarmmetrics.THERMAL_THROTTLE.get(arm) == 0.25
+    roboarmmetrics.THERMAL_THROTTLE.set(0.5, arm)
+    assert 'roboarm_thermal_throttle{arm="arm"} 0.5\n' in roboarmmetrics.exposition()
+
+
+def test_the_arm_label_takes_the_names_of_the_fleet_file(tmp_path, monkeypatch):
+    fleet = tmp_path / "fleet.json"
+    fleet.write_text('{"arms": [{"name": "left"}, {"bot": 2, "ports": {"lift": "outC"}}]}')
+    monkeypatch.setenv("ROBOARM_FLEET", str(fleet))
+    assert roboarmmetrics._arm_names() == ("left", "arm2")
+    monkeypatch.setenv("ROBOARM_FLEET", str(tmp_path / "missing.json"))
+    assert roboarmmetrics._arm_names() == (roboarmmetrics.DEFAULT_ARM,)
+    monkeypatch.delenv("ROBOARM_FLEET")
+    assert roboarmmetrics._arm_names() == (roboarmmetrics.DEFAULT_ARM,)
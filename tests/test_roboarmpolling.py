@@ -0,0 +1,116 @@
+import pytest
+
+import roboarmpolling
+
+STEP = roboarmpolling.MAX_STEP / 100.0      # seconds between two reads far from the crossing at 100 counts/s
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def reads(poller, clock, seconds, period=0.001):
+    # the times (from now) of the reads of a loop of seconds that does not wait
+    start = clock.now
+    times = []
+    for iteration in range(int(round(seconds / period))):
+        clock.now = start + iteration * period
+        if poller.due():
+            times.append(round(clock.now - start, 6))
+    return times
+
+
+def test_without_an_expected_crossing_every_iteration_reads(clock):
+    poller = roboarmpolling.Poller(clock, 0, None, 100)
+    assert poller.interval(clock.now) == 0.0
+    assert len(reads(poller, clock, 0.1)) == 100
+    sleeps = []
+    poller.wait(sleeps.append)
+    assert sleeps == []
+
+
+def test_without_a_speed_every_iteration_reads(clock):
+    poller = roboarmpolling.Poller(clock, 0, 200, 0)
+    assert len(reads(poller, clock, 0.1)) == 100
+
+
+def test_approaching_the_full_rate_starts_at_the_window(clock):
+    start = clock.now
+    # the window starts 200 - WINDOW counts away, at 100 counts per second
+    poller = roboarmpolling.Poller(clock, 0, 200, -100)
+    near = (200 - roboarmpolling.WINDOW) / 100.0
+    assert poller.near_from == pytest.approx(start + near)
+    assert poller.interval(start) == pytest.approx(STEP)
+    # the last slow step ends at the window, not after it
+    assert poller.interval(start + near - 0.01) == pytest.approx(0.01)
+    assert poller.interval(start + near) == 0.0
+    # and the full rate lasts until the end of the loop
+    assert poller.interval(start + 100) == 0.0
+    times = reads(poller, clock, near + 0.1)
+    slow = [time for time in times if time < near]
+    assert len(slow) == pytest.approx(near / STEP, abs=2)
+    assert all(later - earlier <= STEP + 0.001 for earlier, later in zip(times, times[1:]))
+    assert len([time for time in times if time >= near]) == pytest.approx(100, abs=1)
+
+
+def test_approaching_inside_the_window_reads_at_once(clock):
+    poller = roboarmpolling.Poller(clock, 170, 200, 100)
+    assert poller.interval(clock.now) == 0.0
+    assert len(reads(poller, clock, 0.1)) == 100
+
+
+def test_moving_away_the_full_rate_lasts_until_the_window_is_left(clock):
+    start = clock.now
+    # 10 counts past the crossing: WINDOW - 10 counts to go, at SLOWEST times the speed at least
+    poller = roboarmpolling.Poller(clock, 210, 200, 100, approaching=False)
+    near = (roboarmpolling.WINDOW - 10) / (100 * roboarmpolling.SLOWEST)
+    assert poller.near_until == pytest.approx(start + near)
+    assert poller.interval(start) == 0.0
+    assert poller.interval(start + near - 0.001) == 0.0
+    assert poller.interval(start + near) == pytest.approx(STEP)
+    times = reads(poller, clock, near + 0.3)
+    assert len([time for time in times if time < near]) == pytest.approx(near * 1000, abs=1)
+    assert len([time for time in times if time >= near]) == pytest.approx(0.3 / STEP, abs=1)
+
+
+def test_moving_away_out_of_the_window_reads_slowly_at_once(clock):
+    poller = roboarmpolling.Poller(clock, 300, 200, 100, approaching=False)
+    assert poller.interval(clock.now) == pytest.approx(STEP)
+
+
+def test_wait_sleeps_until_the_next_read(clock):
+    start = clock.now
+    poller = roboarmpolling.Poller(clock, 0, 200, 100)
+    near = (200 - roboarmpolling.WINDOW) / 100.0
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock.sleep(seconds)
+
+    # the first read is now, then a read every STEP until the window
+    poller.wait(sleep)
+    assert sleeps == []
+    while clock.now < start + near:
+        poller.wait(sleep)
+    assert clock.now == pytest.approx(start + near)
+    assert all(seconds <= STEP + 1e-9 for seconds in sleeps)
+    assert len(sleeps) == pytest.approx(near / STEP, abs=1)
+    # in the window the loop does not sleep
+    count = len(sleeps)
+    for _ in range(10):
+        poller.wait(sleep)
+    assert len(sleeps) == count
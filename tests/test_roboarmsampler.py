@@ -0,0 +1,47 @@
+import types
+
+import pytest
+
+import roboarmsampler
+import roboarmsim
+
+
+@pytest.fixture
+def sampler():
+    # the sampler thread is not started: the tests publish the readings
+    sampler = roboarmsampler.Sampler(types.SimpleNamespace(clock=roboarmsim.time))
+    yield sampler
+    sampler.close()
+
+
+def test_no_reading_before_the_first_one(sampler):
+    assert sampler.read() is None
+    assert sampler.latest() is None
+
+
+def test_the_last_reading_is_read(sampler):
+    now = roboarmsim.time.time()
+    sampler.publish(31.5, now - 1)
+    sampler.publish(32.0, now)
+    assert sampler.read() == (32.0, now, 2)
+    assert sampler.latest() == (32.0, now, 2)
+
+
+def test_a_stale_reading_is_not_used(sampler):
+    now = roboarmsim.time.time()
+    sampler.publish(32.0, now - roboarmsampler.STALE_PERIODS * sampler.period - 1)
+    assert sampler.read() is not None
+    assert sampler.latest() is None
+
+
+def test_a_torn_record_is_not_read(sampler):
+    sampler.publish(32.0, roboarmsim.time.time())
+    # a value half written: the checksum does not match
+    sampler.memory.buf[8] ^= 0xff
+    assert sampler.read() is None
+
+
+def test_close_removes_the_block(sampler):
+    sampler.close()
+    assert sampler.memory is None
+    sampler.close()
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+import roboarmscheduler
+import roboarmsim
+import roboarmtracing
+
+TIMEOUT = 10
+
+
+def blocked(scheduler):
+    # a running command that waits for the returned event, so the next ones queue
+    started = threading.Event()
+    release = threading.Event()
+
+    def command():
+        started.set()
+        release.wait(TIMEOUT)
+
+    future = scheduler.submit(roboarmscheduler.MOTION, command)
+    assert started.wait(TIMEOUT)
+    return release, future
+
+
+def test_submit_starts_the_worker():
+    scheduler = roboarmscheduler.Scheduler(roboarmsim.time)
+    assert scheduler.thread is None
+    assert scheduler.submit(roboarmscheduler.TELEMETRY, lambda: 42).result(TIMEOUT) == 42
+    assert scheduler.thread.is_alive()
+
+
+def test_commands_run_by_priority_then_arrival():
+    scheduler = roboarmscheduler.Scheduler(roboarmsim.time)
+    release, first = blocked(scheduler)
+    order = []
+    futures = [scheduler.submit(priority, order.append, name)
+               for priority, name in ((roboarmscheduler.TELEMETRY, "telemetry"),
+                                      (roboarmscheduler.MOTION, "motion 1"),
+                                      (roboarmscheduler.STOP, "stop"),
+                                      (roboarmscheduler.MOTION, "motion 2"),
+                                      (roboarmscheduler.EMERGENCY_STOP, "emergency stop"))]
+    release.set()
+    for future in [first] + futures:
+        future.result(TIMEOUT)
+    assert order == ["emergency stop", "stop", "motion 1", "motion 2", "telemetry"]
+
+
+def test_errors_go_to_the_future():
+    scheduler = roboarmscheduler.Scheduler(roboarmsim.time)
+    with pytest.raises(ZeroDivisionError):
+        scheduler.submit(roboarmscheduler.CONFIGURATION, lambda: 1 / 0).result(TIMEOUT)
+    assert scheduler.submit(roboarmscheduler.CONFIGURATION, lambda: "next").result(TIMEOUT) == "next"
+
+
+def test_a_more_urgent_command_preempts_at_the_next_safe_point():
+    scheduler = roboarmscheduler.Scheduler(roboarmsim.time)
+    started = threading.Event()
+
+    def motion():
+        started.set()
+        while True:
+            scheduler.sleep(1)
+
+    running = scheduler.submit(roboarmscheduler.MOTION, motion)
+    assert started.wait(TIMEOUT)
+    stop = scheduler.submit(roboarmscheduler.STOP, lambda: "stopped")
+    with pytest.raises(roboarmscheduler.Preempted) as preempted:
+        running.result(TIMEOUT)
+    assert preempted.value.priority == roboarmscheduler.STOP
+    assert stop.result(TIMEOUT) == "stopped"
+    assert not scheduler.preempting()
+
+
+def test_a_less_urgent_command_does_not_preempt():
+    scheduler = roboarmscheduler.Scheduler(roboarmsim.time)
+    release, running = blocked(scheduler)
+    telemetry = scheduler.submit(roboarmscheduler.TELEMETRY, lambda: None)
+    assert scheduler.running == roboarmscheduler.MOTION
+    assert not scheduler.preempting()
+    release.set()
+    running.result(TIMEOUT)
+    telemetry.result(TIMEOUT)
+
+
+def test_commands_continue_the_trace_of_the_caller():
+    scheduler = roboarmscheduler.Scheduler(roboarmsim.time)
+    with roboarmtracing.span("GET /initialize/"):
+        caller = roboarmtracing.current()
+        context = scheduler.submit(roboarmscheduler.CONFIGURATION, roboarmtracing.current).result(TIMEOUT)
+    assert context == caller
+    # the worker does not keep the context for the next command
+    assert scheduler.submit(roboarmscheduler.CONFIGURATION, roboarmtracing.current).result(TIMEOUT) is None
@@ -0,0 +1,80 @@
+import pytest
+
+import roboarmstate
+
+BOOT = b"b" * 16
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "roboarm_state.bin")
+
+
+def pose(**values):
+    saved = dict(homed=1, moving=0, holding=7, touch=1, reflect=42,
+                 lift_inversed=1, grab_inversed=0, base_inversed=0,
+                 lift_position=-270, grab_position=-90, base_position=334)
+    saved.update(values)
+    return saved
+
+
+def test_a_new_file_has_no_state(path):
+    assert roboarmstate.ArmState(path, BOOT).load() is None
+
+
+def test_save_and_load_in_another_process_life(path):
+    state = roboarmstate.ArmState(path, BOOT)
+    state.save(**pose(base_target=0))
+    state.close()
+    loaded = roboarmstate.ArmState(path, BOOT).load()
+    for name, value in pose(base_target=0).items():
+        assert loaded[name] == value
+    # int fields not saved have no value
+    assert loaded["lift_limit_position"] is None
+
+
+def test_the_newest_save_wins(path):
+    state = roboarmstate.ArmState(path, BOOT)
+    for position in range(5):
+        state.save(**pose(lift_position=position))
+    assert state.load()["lift_position"] == 4
+
+
+def test_a_torn_save_falls_back_to_the_previous_one(path):
+    state = roboarmstate.ArmState(path, BOOT)
+    state.save(**pose(lift_position=1))
+    state.save(**pose(lift_position=2))
+    # sequence 2 is in slot 0: break a byte of its payload
+    offset = roboarmstate._header.size + 3
+    state.map[offset] ^= 0xff
+    assert state.load()["lift_position"] == 1
+    # and the next save overwrites the torn slot
+    state.save(**pose(lift_position=3))
+    assert state.load()["lift_position"] == 3
+
+
+def test_both_slots_torn(path):
+    state = roboarmstate.ArmState(path, BOOT)
+    state.save(**pose())
+    state.save(**pose())
+    for slot in range(2):
+        state.map[slot * roboarmstate.SLOT_SIZE] ^= 0xff
+    assert state.load() is None
+
+
+def test_a_save_of_another_boot_is_not_used(path):
+    roboarmstate.ArmState(path, BOOT).save(**pose())
+    assert roboarmstate.ArmState(path, b"c" * 16).load() is None
+
+
+def test_mismatch():
+    saved = pose()
+    assert roboarmstate.mismatch(saved, pose()) is None
+    tolerance = roboarmstate.POSITION_TOLERANCE
+    assert roboarmstate.mismatch(saved, pose(base_position=334 + tolerance)) is None
+    assert roboarmstate.mismatch(saved, pose(base_position=335 + tolerance)) == \
+        "base encoder moved " + str(1 + tolerance) + " counts"
+    assert roboarmstate.mismatch(saved, pose(lift_inversed=0)) == "lift motor polarity changed"
+    assert roboarmstate.mismatch(pose(moving=1), pose()) == "the arm stopped in the middle of a move"
+    assert roboarmstate.mismatch(pose(homed=0), pose()) == "the arm was not homed"
+    assert roboarmstate.mismatch(None, pose()) == "no saved state"